@@ -0,0 +1,216 @@
+import asyncio
+import datetime
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import codec
+import index
+import placement
+import storage
+import timer
+
+
+def _measure(func, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - begin) / repeat
+
+
+def bench_key_index(peers=16, sizes=(1000, 10000, 100000), lookups=2000):
+    print("key lookup: {peers} peers, {lookups} lookups per size".format(peers=peers, lookups=lookups))
+    print("{:>10} {:>16} {:>16} {:>16}".format("keys/node", "list scan (us)", "index (us)", "del+add (us)"))
+    nodes = [str(uuid.uuid1()) for _ in range(peers)]
+    for size in sizes:
+        node_key = {}
+        key_index = index.KeyIndex()
+        for node in nodes:
+            keys = ["{node}-{i}".format(node=node[:8], i=i) for i in range(size)]
+            node_key[node] = keys
+            key_index.replace(node, keys)
+        probes = [random.choice(node_key[random.choice(nodes)]) for _ in range(lookups)]
+
+        def scan():
+            for key in probes:
+                for node in nodes:
+                    if key in node_key[node]:
+                        break
+
+        def lookup():
+            for key in probes:
+                key_index.replicas(key)
+
+        def delete():
+            for key in probes:
+                for node in key_index.replicas(key).copy():
+                    key_index.discard(node, key)
+                    key_index.add(node, key)
+
+        # The list scan is quadratic; skip it where it would dominate the run.
+        scan_time = "{:.2f}".format(_measure(scan, 1) / lookups * 1e6) if size <= 10000 else "-"
+        print("{:>10} {:>16} {:>16.3f} {:>16.3f}".format(
+            size, scan_time, _measure(lookup, 5) / lookups * 1e6, _measure(delete, 5) / lookups * 1e6))
+
+
+def bench_placement(sizes=(10, 100, 1000), replicas=3, puts=2000):
+    print("replica placement: pick {replicas} of n, {puts} puts per size".format(replicas=replicas, puts=puts))
+    print("{:>10} {:>16} {:>16}".format("nodes", "sort (us)", "heap (us)"))
+    for size in sizes:
+        nodes = [str(uuid.uuid1()) for _ in range(size)]
+        peer_list = [(node, ("10.0.0.1", i)) for (i, node) in enumerate(nodes)]
+        counter = {node: random.randint(0, 1000) for node in nodes}
+        heap = placement.Placement()
+        for (node, addr) in peer_list:
+            heap.add(node, addr, counter[node])
+
+        def sort():
+            for _ in range(puts):
+                ordered = sorted(counter, key=counter.get)
+                for node in ordered[:replicas]:
+                    for (t_node, addr) in peer_list:
+                        if t_node == node:
+                            counter[node] += 1
+
+        def pick():
+            for _ in range(puts):
+                for (node, addr) in heap.pick(replicas):
+                    heap.adjust(node, 1)
+
+        print("{:>10} {:>16.2f} {:>16.2f}".format(
+            size, _measure(sort, 1) / puts * 1e6, _measure(pick, 1) / puts * 1e6))
+
+
+def bench_codec(repeat=20000):
+    node = str(uuid.uuid1())
+    messages = {
+        "heartbeat_ping": {"type": "heartbeat_ping", "uuid": node, "timestamp": time.time()},
+        "peer_list": {"type": "peer_list", "uuid": node, "timestamp": time.time(), "peer_index": 3,
+                      "peer_uuid": str(uuid.uuid1()), "peer_addr": ["10.0.0.7", 19999]},
+        "put_final": {"type": "put_final", "uuid": node, "cli_addr": ["10.0.0.4", 19999],
+                      "key": "user:42", "value": "x" * 64},
+        "get_success": {"type": "get_success", "uuid": node, "key": "user:42", "value": "x" * 64},
+    }
+    print("wire codec: {repeat} round trips per message".format(repeat=repeat))
+    print("{:>16} {:>8} {:>12} {:>12} {:>8} {:>12} {:>12}".format(
+        "message", "json B", "enc (us)", "dec (us)", "bin B", "enc (us)", "dec (us)"))
+    for (name, message) in messages.items():
+        row = [name]
+        for message_codec in (codec.JSON, codec.BINARY):
+            data = message_codec.encode(dict(message))
+            row.append(len(data))
+            row.append(_measure(lambda: message_codec.encode(dict(message)), repeat) * 1e6)
+            row.append(_measure(lambda: codec.decode(data), repeat) * 1e6)
+        print("{:>16} {:>8} {:>12.2f} {:>12.2f} {:>8} {:>12.2f} {:>12.2f}".format(*row))
+
+
+def bench_storage(writes=20000, sizes=(10000, 100000)):
+    print("storage: {writes} puts, fsync per put vs group commit".format(writes=writes))
+    print("{:>16} {:>12} {:>10}".format("mode", "put (us)", "fsyncs"))
+    path = tempfile.mkdtemp()
+    try:
+        store = storage.Storage(path + "/sync")
+        count = writes // 20
+        begin = time.perf_counter()
+        for i in range(count):
+            store.put("key%d" % i, "x" * 64)
+        print("{:>16} {:>12.2f} {:>10}".format("per put", (time.perf_counter() - begin) / count * 1e6, store.syncs))
+        store.close()
+
+        loop = asyncio.new_event_loop()
+        store = storage.Storage(path + "/group", loop)
+
+        async def put_all():
+            for i in range(writes):
+                store.put("key%d" % i, "x" * 64)
+                if i % 100 == 99:
+                    await asyncio.sleep(0)
+            store.sync()
+        begin = time.perf_counter()
+        loop.run_until_complete(put_all())
+        print("{:>16} {:>12.2f} {:>10}".format("group commit", (time.perf_counter() - begin) / writes * 1e6, store.syncs))
+        store.close()
+        loop.close()
+
+        print("{:>10} {:>16} {:>16}".format("keys", "log replay (ms)", "snapshot (ms)"))
+        for size in sizes:
+            store = storage.Storage(path + "/recover%d" % size, snapshot_records=size * 2)
+            store.sync = lambda: None
+            for i in range(size):
+                store.put("key%d" % i, "x" * 64)
+            store._log.flush()
+            replay = _measure(lambda: storage.Storage(path + "/recover%d" % size), 1)
+            store.snapshot()
+            load = _measure(lambda: storage.Storage(path + "/recover%d" % size), 1)
+            print("{:>10} {:>16.1f} {:>16.1f}".format(size, replay * 1e3, load * 1e3))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_timer(sizes=(100, 1000, 10000), rearms=10):
+    print("timers: arm n, re-arm each {rearms} times, cancel".format(rearms=rearms))
+    print("{:>10} {:>18} {:>18}".format("timers", "task/timeout (us)", "deadline heap (us)"))
+    delta = datetime.timedelta(seconds=60)
+
+    async def sleeper():
+        try:
+            await asyncio.sleep(delta.total_seconds())
+        except asyncio.CancelledError:
+            pass
+
+    for size in sizes:
+        loop = asyncio.new_event_loop()
+
+        async def tasks():
+            # What a heartbeat_pong used to cost: cancel the pending timeout task and start another.
+            pending = [asyncio.ensure_future(sleeper()) for _ in range(size)]
+            await asyncio.sleep(0)
+            for _ in range(rearms):
+                for i in range(size):
+                    pending[i].cancel()
+                    pending[i] = asyncio.ensure_future(sleeper())
+                await asyncio.sleep(0)
+            for task in pending:
+                task.cancel()
+            await asyncio.sleep(0)
+
+        timers = timer.Timer(loop)
+
+        async def heap():
+            pending = [timers.trigger(lambda: None, delta) for _ in range(size)]
+            await asyncio.sleep(0)
+            for _ in range(rearms):
+                for handle in pending:
+                    handle.reset(delta)
+                await asyncio.sleep(0)
+            for handle in pending:
+                handle.cancel()
+            await asyncio.sleep(0)
+
+        ops = size * (rearms + 2)
+        task_time = _measure(lambda: loop.run_until_complete(tasks()), 3) / ops
+        heap_time = _measure(lambda: loop.run_until_complete(heap()), 3) / ops
+        loop.close()
+        print("{:>10} {:>18.2f} {:>18.2f}".format(size, task_time * 1e6, heap_time * 1e6))
+
+
+BENCHMARKS = {
+    "key_index": bench_key_index,
+    "placement": bench_placement,
+    "codec": bench_codec,
+    "storage": bench_storage,
+    "timer": bench_timer,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,90 @@
 import asyncio
-import network
+import client
 import logging
-import random
+import sys
 logging.getLogger().setLevel("INFO")
 
 addrs = ["10.0.0.4", "10.0.0.7", "10.0.0.8", "10.0.0.10"] # gemini1, gemini3, Gemini4, gemini6
 PORT = 19999
 
-class CLI(network.Network):
+
+def parse_addr(text, port=PORT):
+    (host, _, p) = text.partition(":")
+    return (host, int(p) if p else port)
+
+
+class CLI:
     async def start(self):
-        args = input("INPUT (put key value/get key/remove key/stat): ")
-        args = args.split(' ')
-        addr = (addrs[random.randint(0,3)], PORT)
-        if args[0] == 'put' and len(args) == 3:
-            message = {
-                "type": "put",
-                "uuid": self.uuid,
-                "key": args[1],
-                "value": args[2],
-            }
-            self.send_message(message, addr)
-            asyncio.ensure_future(self.start(), loop = self._loop)
-        elif args[0] == 'get' and len(args) == 2:
-            message = {
-                "type": "get",
-                "uuid": self.uuid,
-                "key": args[1]
-            }
-            self.send_message(message, addr)
-        elif args[0] == 'remove' and len(args) == 2:
-            message = {
-                "type": "remove",
-                "uuid": self.uuid,
-                "key": args[1]
-            }
-            self.send_message(message, addr)
-            asyncio.ensure_future(self.start(), loop = self._loop)
-        elif args[0] == 'stat' and len(args) == 1:
-            message = {
-                "type": "stat",
-                "uuid": self.uuid,
-            }
-            self.send_message(message, addr)
-        else:
-            logging.info("Invalid input arguments.")
-            asyncio.ensure_future(self.start(), loop = self._loop)
-    def message_arrived(self, message, addr):
-        if message["type"] == "get_success":
-            if message["value"]:
-                logging.info("get success! The value for key {key} is {value}.".format(key=message["key"], value=message["value"]))
-            else:
-                logging.info("get failed! The key does not exist!")
-            asyncio.ensure_future(self.start(), loop = self._loop)
-        elif message["type"] == "stat_success":
-            stat = message["node_key"]
-            redundancy = {}
-            for uuid, keylist in stat.items():
-                for key in keylist:
-                    if key not in redundancy.keys():
-                        redundancy[key] = 1
+        try:
+            await self._client.refresh_members()
+        except client.DHTTimeout:
+            logging.info("Cannot fetch the member list; sending requests to random nodes.")
+        while True:
+            args = await self._loop.run_in_executor(None, input, "INPUT (put key value/get key/remove key/stat/keys [node] [replicas]): ")
+            args = args.split(' ')
+            try:
+                if args[0] == 'put' and len(args) == 3:
+                    await self._client.put(args[1], args[2])
+                    logging.info("put success!")
+                elif args[0] == 'get' and len(args) == 2:
+                    value = await self._client.get(args[1])
+                    if value:
+                        logging.info("get success! The value for key {key} is {value}.".format(key=args[1], value=value))
                     else:
-                        redundancy[key] += 1
-            index = 0
-            for uuid, keylist in stat.items():
-                logging.info("-----------------")
-                logging.info("<NODE {index}>".format(index=index))
-                logging.info("UUID: {uuid}".format(uuid=uuid))
-                logging.info("# of KEYs: {no}".format(no=len(keylist)))
-                logging.info("# of REDUNDANCIES")
-                for key in keylist:
-                    logging.info("KEY {key}: {red} times".format(key=key, red=redundancy[key]))
-                logging.info("-----------------")
-                index += 1
-            asyncio.ensure_future(self.start(), loop = self._loop)
-    def __init__(self, loop):
-        network.Network.__init__(self, loop)
-        self._loop = loop
+                        logging.info("get failed! The key does not exist!")
+                elif args[0] == 'remove' and len(args) == 2:
+                    await self._client.remove(args[1])
+                    logging.info("remove success!")
+                elif args[0] == 'stat' and len(args) == 1:
+                    self.print_stat(await self._client.stat())
+                elif args[0] == 'keys' and len(args) <= 3:
+                    node = args[1] if len(args) > 1 and args[1] != '-' else None
+                    try:
+                        replicas = int(args[2]) if len(args) > 2 else None
+                    except ValueError:
+                        logging.info("Invalid input arguments.")
+                        continue
+                    await self.print_keys(node, replicas)
+                else:
+                    logging.info("Invalid input arguments.")
+            except client.DHTTimeout as e:
+                logging.info("Request failed: " + str(e))
 
-        import uuid
-        self.uuid = str(uuid.uuid1())
+    def print_stat(self, stat):
+        logging.info("# of KEYs: {no} (replication {r})".format(no=stat["keys"], r=stat["replication"]))
+        logging.info("# of REDUNDANCIES")
+        for count, keys in sorted(stat["histogram"].items()):
+            logging.info("{count} times: {keys} keys".format(count=count, keys=keys))
+        index = 0
+        for uuid, node in stat["nodes"].items():
+            logging.info("-----------------")
+            logging.info("<NODE {index}>".format(index=index))
+            logging.info("UUID: {uuid}".format(uuid=uuid))
+            logging.info("# of KEYs: {no}".format(no=node["keys"]))
+            logging.info("BYTEs: {no}".format(no=node["bytes"]))
+            logging.info("-----------------")
+            index += 1
+
+    async def print_keys(self, node, replicas):
+        cursor = None
+        while True:
+            (entries, cursor) = await self._client.stat_keys(node, replicas, cursor)
+            for key, holders in entries:
+                logging.info("KEY {key}: {red} times {holders}".format(key=key, red=len(holders), holders=holders))
+            if cursor is None:
+                break
+
+    def __init__(self, loop, nodes):
+        self._loop = loop
+        self._client = client.DHTClient(loop, nodes)
         asyncio.ensure_future(self.start(), loop = self._loop)
 
 
 def interface():
     loop = asyncio.new_event_loop()
 
-    CLI(loop)
+    # Nodes to contact as host[:port] arguments; defaults to the testbed hosts.
+    CLI(loop, [parse_addr(arg) for arg in sys.argv[1:]] or [(addr, PORT) for addr in addrs])
 
     try:
         loop.run_forever()
@@ -0,0 +1,198 @@
+import asyncio
+import collections
+import logging
+import random
+
+import network
+import ring
+
+CLIENT_TIMEOUT = 1.0
+CLIENT_RETRIES = 3
+CLIENT_MAX_IN_FLIGHT = 4096
+# Key -> holder address entries remembered from responses; dropped wholesale when the epoch changes.
+CLIENT_CACHE_SIZE = 4096
+
+
+class DHTError(Exception):
+    pass
+
+
+class DHTTimeout(DHTError):
+    pass
+
+
+class DHTClient(network.Network):
+    def __init__(self, loop, nodes, timeout=CLIENT_TIMEOUT, retries=CLIENT_RETRIES,
+                 max_in_flight=CLIENT_MAX_IN_FLIGHT, cache_size=CLIENT_CACHE_SIZE, local_addr=None, transport=None):
+        network.Network.__init__(self, loop, local_addr or (network.NETWORK_LISTEN_ADDR, 0), transport)
+        self._loop = loop
+        self._nodes = [tuple(addr) for addr in nodes]
+        self._timeout = timeout
+        self._retries = retries
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._pending = {}
+        self._next_rid = random.getrandbits(31)
+        self._ring = ring.HashRing()
+        self._replication = 1
+        self._epoch = None
+        self._locations = collections.OrderedDict()
+        self._cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._timeouts = self._metrics.counter("client_timeouts_total", "Request attempts that timed out")
+
+        import uuid
+        self.uuid = str(uuid.uuid1())
+
+    async def get(self, key):
+        (response, addr) = await self.request({"type": "get", "key": key}, key)
+        if response["value"] is not None:
+            self.remember(key, addr)
+        return response["value"]
+
+    async def put(self, key, value):
+        (_, addr) = await self.request({"type": "put", "key": key, "value": value}, key)
+        self.remember(key, addr)
+
+    async def remove(self, key):
+        await self.request({"type": "remove", "key": key}, key)
+        self.forget(key)
+
+    async def mget(self, keys):
+        values = {}
+        for (keys, response) in await self.batch("mget", "keys", list(keys)):
+            values.update(zip(keys, response["values"]))
+        return values
+
+    async def mput(self, items):
+        items = [[key, value] for (key, value) in dict(items).items()]
+        return [key for (_, response) in await self.batch("mput", "items", items) for key in response["stored"]]
+
+    async def mremove(self, keys):
+        return [key for (_, response) in await self.batch("mremove", "keys", list(keys))
+                for key in response["removed"]]
+
+    async def batch(self, kind, field, entries):
+        """Send a batch request, then resend only the entries the cluster reports as unfinished.
+
+        Returns (entries, response) for every round, oldest first.
+        """
+        rounds = []
+        addr = None
+        for _ in range(self._retries + 1):
+            # The node that answered knows which of its peers went silent, so it gets the retry.
+            (response, addr) = await self.request({"type": kind, field: entries}, addr=addr)
+            rounds.append((entries, response))
+            pending = set(response.get("pending", []))
+            if not pending:
+                return rounds
+            entries = [entry for entry in entries if (entry[0] if field == "items" else entry) in pending]
+        raise DHTTimeout("{count} keys of {type} unfinished after {attempts} attempts".format(
+            count=len(entries), type=kind, attempts=self._retries + 1))
+
+    async def stat(self):
+        (response, _) = await self.request({"type": "stat"})
+        return {
+            "replication": response["replication"],
+            "keys": response["keys"],
+            "histogram": {count: keys for (count, keys) in response["histogram"]},
+            "nodes": {uuid: {"keys": keys, "bytes": size} for (uuid, keys, size) in response["node_stats"]},
+        }
+
+    async def stat_keys(self, node=None, replicas=None, cursor=None, limit=None):
+        message = {"type": "stat_keys", "node": node, "replicas": replicas, "cursor": cursor, "limit": limit}
+        (response, _) = await self.request(message)
+        return ([(key, holders) for (key, holders) in response["entries"]], response["cursor"])
+
+    async def metrics(self, addr=None):
+        (response, _) = await self.request({"type": "metrics"}, addr=addr)
+        return response["metrics"]
+
+    async def refresh_members(self):
+        (response, addr) = await self.request({"type": "members"})
+        members = []
+        for (uuid, member_addr) in response["members"]:
+            if member_addr is None:
+                member_addr = addr
+            members.append((uuid, tuple(member_addr)))
+        self._ring.rebuild(members)
+        self._replication = response.get("replication", 1)
+        return members
+
+    def remember(self, key, addr):
+        if self._cache_size <= 0:
+            return
+        self._locations[key] = tuple(addr)
+        self._locations.move_to_end(key)
+        while len(self._locations) > self._cache_size:
+            self._locations.popitem(last=False)
+
+    def forget(self, key):
+        self._locations.pop(key, None)
+
+    def update_epoch(self, timestamp, version=None):
+        if timestamp is None:
+            return
+        # Holders change on joins and leaves too, which bump the version but not the timestamp.
+        epoch = (timestamp, version if version is not None else -1)
+        if epoch == self._epoch:
+            return
+        if self._epoch is not None and epoch < self._epoch:
+            # A node that has not yet heard of the newer leader or membership.
+            return
+        if self._locations:
+            logging.debug("Epoch changed to {epoch}, dropping {count} cached locations".format(
+                epoch=epoch, count=len(self._locations)))
+        self._locations.clear()
+        self._epoch = epoch
+
+    def pick_node(self, key, attempt):
+        if key is not None:
+            if attempt == 0:
+                addr = self._locations.get(key)
+                if addr is not None:
+                    self._locations.move_to_end(key)
+                    self.cache_hits += 1
+                    return addr
+                self.cache_misses += 1
+            else:
+                # The cached holder did not answer.
+                self.forget(key)
+            if len(self._ring) > 0:
+                replicas = self._ring.lookup(key, self._replication)
+                if attempt < len(replicas):
+                    return replicas[attempt][1]
+        return self._nodes[random.randrange(len(self._nodes))]
+
+    async def request(self, message, key=None, addr=None):
+        latency = self._metrics.histogram("client_request_seconds", "Request latency including retries",
+                                          {"type": message["type"]})
+        begin = self._loop.time()
+        async with self._slots:
+            self._next_rid = (self._next_rid + 1) & 0x7FFFFFFF
+            rid = self._next_rid
+            message["uuid"] = self.uuid
+            message["rid"] = rid
+            try:
+                for attempt in range(self._retries + 1):
+                    future = self._loop.create_future()
+                    self._pending[rid] = future
+                    self.send_message(dict(message), addr if addr is not None else self.pick_node(key, attempt))
+                    try:
+                        result = await asyncio.wait_for(future, self._timeout)
+                        latency.observe(self._loop.time() - begin)
+                        return result
+                    except asyncio.TimeoutError:
+                        self._timeouts.inc()
+                        logging.debug("Request {rid} ({type}) timed out, attempt {attempt}".format(
+                            rid=rid, type=message["type"], attempt=attempt + 1))
+            finally:
+                self._pending.pop(rid, None)
+        raise DHTTimeout("No response to {type} after {count} attempts".format(
+            type=message["type"], count=self._retries + 1))
+
+    def message_arrived(self, message, addr):
+        self.update_epoch(message.get("timestamp"), message.get("version"))
+        future = self._pending.get(message.get("rid"))
+        if future is not None and not future.done():
+            future.set_result((message, addr))
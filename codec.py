@@ -0,0 +1,344 @@
+import json
+import socket
+import struct
+
+JSON_MAGIC_VALUE = "Sound body, sound code."
+BINARY_MAGIC_VALUE = b"\xd4\x7b"
+BINARY_VERSION = 1
+BATCH_TYPE = "_batch"
+
+# Wire tables for the binary codec. Codes are positions in these lists, so only ever append.
+MESSAGE_TYPES = [
+    "hello", "heartbeat_ping", "heartbeat_pong", "leader_is_here", "data_counter_and_keys", "peer_list",
+    "new_leader_election", "you_are_rejected",
+    "get", "get_relayed", "get_ask", "get_success",
+    "put", "put_relayed", "put_final", "put_response",
+    "remove", "remove_relayed", "remove_ask", "remove_response",
+    "stat", "stat_relay", "stat_success", "members", "members_success", "hello_relayed",
+    "put_success", "remove_success",
+    "mget", "mget_relayed", "mget_ask", "mget_reply", "mget_success",
+    "mput", "mput_relayed", "mput_ask", "mput_reply", "mput_success",
+    "mremove", "mremove_relayed", "mremove_ask", "mremove_reply", "mremove_success",
+    "sync_tree", "sync_keys", "sync_pull", "sync_push", "replicate",
+    "peer_delta", "membership_sync", "inventory_pull", "inventory_page",
+    "swim_ping", "swim_ping_req", "swim_ack",
+    "stat_keys", "stat_keys_relay", "stat_keys_success", "metrics", "metrics_success",
+    "handoff", "handoff_ack",
+    "put_ack", "remove_ack",
+]
+FIELDS = [
+    "uuid", "timestamp", "peer_count", "data_counter", "capacity", "key_list", "peer_index", "peer_uuid",
+    "peer_addr", "cli_addr", "key", "value", "routed", "node_key", "members", "replication",
+    "rid", "batch", "keys", "items", "values", "stored", "removed",
+    "version", "level", "nodes", "digests", "buckets", "entries", "op",
+    "digest", "pages", "page", "seq", "gossip", "incarnation",
+    "bytes", "histogram", "node_stats", "node", "replicas", "cursor", "limit", "echo", "metrics",
+    "direct", "write", "pending",
+]
+
+_HEADER = struct.Struct("!2sBB")
+_UNKNOWN_TYPE = 0xFF
+_BATCH_TYPE = 0xFE
+_NAMED_FIELD = 0xFF
+_TYPE_CODES = {name: code for (code, name) in enumerate(MESSAGE_TYPES)}
+_FIELD_CODES = {name: code for (code, name) in enumerate(FIELDS)}
+
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _UUID, _ADDR, _LIST, _DICT = range(10)
+_DOUBLE = struct.Struct("!d")
+_PORT = struct.Struct("!H")
+_JSON_BATCH_PREFIX = '{{"_magic": "{magic}", "type": "{type}", "messages": ['.format(
+    magic=JSON_MAGIC_VALUE, type=BATCH_TYPE).encode(encoding="utf-8")
+_JSON_BATCH_SUFFIX = b"]}"
+
+
+class CodecError(Exception):
+    pass
+
+
+class JsonCodec:
+    name = "json"
+    batch_overhead = len(_JSON_BATCH_PREFIX) + len(_JSON_BATCH_SUFFIX)
+
+    def encode(self, message):
+        if not "_magic" in message:
+            message["_magic"] = JSON_MAGIC_VALUE
+        return json.dumps(message).encode(encoding="utf-8", errors="strict")
+
+    def decode(self, data):
+        try:
+            message = json.loads(data.decode(encoding="utf-8", errors="strict"))
+        except ValueError as e:
+            raise CodecError("Cannot parse JSON message: " + str(e))
+        if not isinstance(message, dict) or not "_magic" in message:
+            raise CodecError("No magic value")
+        if not message["_magic"] == JSON_MAGIC_VALUE:
+            raise CodecError("Invalid magic value")
+        return message
+
+    def batch_item_size(self, size):
+        return size + 1
+
+    def encode_batch(self, frames):
+        return _JSON_BATCH_PREFIX + b",".join(frames) + _JSON_BATCH_SUFFIX
+
+    def decode_all(self, data):
+        message = self.decode(data)
+        if message.get("type") != BATCH_TYPE:
+            return [message]
+        messages = message.get("messages")
+        if not isinstance(messages, list) or not all(isinstance(m, dict) for m in messages):
+            raise CodecError("Invalid batch")
+        return messages
+
+
+class BinaryCodec:
+    name = "binary"
+    batch_overhead = _HEADER.size
+
+    def __init__(self, version=BINARY_VERSION):
+        self.version = version
+
+    def encode(self, message):
+        out = bytearray()
+        type_code = _TYPE_CODES.get(message.get("type"), _UNKNOWN_TYPE)
+        out += _HEADER.pack(BINARY_MAGIC_VALUE, self.version, type_code)
+        for (name, value) in message.items():
+            if name == "_magic" or name == "_codec" or (name == "type" and type_code != _UNKNOWN_TYPE):
+                continue
+            code = _FIELD_CODES.get(name)
+            if code is None:
+                out.append(_NAMED_FIELD)
+                _write_str(out, name)
+            else:
+                out.append(code)
+            _write_value(out, value)
+        return bytes(out)
+
+    def decode(self, data):
+        if len(data) < _HEADER.size:
+            raise CodecError("Truncated header")
+        (magic, version, type_code) = _HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC_VALUE:
+            raise CodecError("Invalid magic value")
+        if version > BINARY_VERSION:
+            raise CodecError("Unsupported binary version {version}".format(version=version))
+        message = {}
+        if type_code != _UNKNOWN_TYPE:
+            if type_code >= len(MESSAGE_TYPES):
+                raise CodecError("Unknown message type code {code}".format(code=type_code))
+            message["type"] = MESSAGE_TYPES[type_code]
+        view = memoryview(data)
+        pos = _HEADER.size
+        try:
+            while pos < len(data):
+                code = data[pos]
+                pos += 1
+                if code == _NAMED_FIELD:
+                    (name, pos) = _read_str(view, pos)
+                elif code < len(FIELDS):
+                    name = FIELDS[code]
+                else:
+                    raise CodecError("Unknown field code {code}".format(code=code))
+                (message[name], pos) = _read_value(view, pos)
+        except (IndexError, struct.error, UnicodeError, RecursionError) as e:
+            raise CodecError("Truncated or corrupt message: " + str(e))
+        return message
+
+    def batch_item_size(self, size):
+        return size + _varint_size(size)
+
+    def encode_batch(self, frames):
+        out = bytearray(_HEADER.pack(BINARY_MAGIC_VALUE, self.version, _BATCH_TYPE))
+        for frame in frames:
+            _write_varint(out, len(frame))
+            out += frame
+        return bytes(out)
+
+    def decode_all(self, data):
+        if len(data) < _HEADER.size or data[_HEADER.size - 1] != _BATCH_TYPE:
+            return [self.decode(data)]
+        (magic, version, _) = _HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC_VALUE or version > BINARY_VERSION:
+            raise CodecError("Invalid batch header")
+        messages = []
+        view = memoryview(data)
+        pos = _HEADER.size
+        try:
+            while pos < len(data):
+                (length, pos) = _read_varint(view, pos)
+                if pos + length > len(data):
+                    raise CodecError("Truncated batch")
+                messages.append(self.decode(bytes(view[pos:pos + length])))
+                pos += length
+        except IndexError as e:
+            raise CodecError("Truncated batch: " + str(e))
+        return messages
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+
+def is_binary(data):
+    return data[:len(BINARY_MAGIC_VALUE)] == BINARY_MAGIC_VALUE
+
+
+def decode(data):
+    if is_binary(data):
+        return BINARY.decode(data)
+    return JSON.decode(data)
+
+
+def decode_all(data):
+    if is_binary(data):
+        return BINARY.decode_all(data)
+    return JSON.decode_all(data)
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _varint_size(value):
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def _read_varint(view, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = view[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (result, pos)
+        shift += 7
+
+
+def _write_str(out, value):
+    b = value.encode(encoding="utf-8", errors="strict")
+    _write_varint(out, len(b))
+    out += b
+
+
+def _read_str(view, pos):
+    (length, pos) = _read_varint(view, pos)
+    if pos + length > len(view):
+        raise IndexError("string runs past the end of the message")
+    return (str(view[pos:pos + length], encoding="utf-8", errors="strict"), pos + length)
+
+
+def _as_uuid(value):
+    if len(value) != 36 or value[8] != "-" or value[13] != "-" or value[18] != "-" or value[23] != "-":
+        return None
+    try:
+        packed = bytes.fromhex(value[:8] + value[9:13] + value[14:18] + value[19:23] + value[24:])
+    except ValueError:
+        return None
+    return packed if _uuid_str(packed) == value else None
+
+
+def _uuid_str(packed):
+    h = packed.hex()
+    return "{}-{}-{}-{}-{}".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _as_addr(value):
+    if len(value) != 2 or not isinstance(value[0], str) or type(value[1]) is not int or not 0 <= value[1] < 65536:
+        return None
+    try:
+        packed = socket.inet_aton(value[0])
+    except OSError:
+        return None
+    return packed if socket.inet_ntoa(packed) == value[0] else None
+
+
+def _write_value(out, value):
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        parsed = _as_uuid(value)
+        if parsed is not None:
+            out.append(_UUID)
+            out += parsed
+        else:
+            out.append(_STR)
+            _write_str(out, value)
+    elif isinstance(value, (list, tuple, set)):
+        packed = _as_addr(value) if not isinstance(value, set) else None
+        if packed is not None:
+            out.append(_ADDR)
+            out += packed
+            out += _PORT.pack(value[1])
+        else:
+            out.append(_LIST)
+            _write_varint(out, len(value))
+            for item in value:
+                _write_value(out, item)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        for (name, item) in value.items():
+            _write_str(out, str(name))
+            _write_value(out, item)
+    else:
+        raise CodecError("Cannot encode value of type {type}".format(type=type(value).__name__))
+
+
+def _read_value(view, pos):
+    tag = view[pos]
+    pos += 1
+    if tag == _NONE:
+        return (None, pos)
+    elif tag == _TRUE:
+        return (True, pos)
+    elif tag == _FALSE:
+        return (False, pos)
+    elif tag == _INT:
+        (raw, pos) = _read_varint(view, pos)
+        return ((raw >> 1) ^ -(raw & 1), pos)
+    elif tag == _FLOAT:
+        return (_DOUBLE.unpack_from(view, pos)[0], pos + _DOUBLE.size)
+    elif tag == _STR:
+        return _read_str(view, pos)
+    elif tag == _UUID:
+        if pos + 16 > len(view):
+            raise IndexError("uuid runs past the end of the message")
+        return (_uuid_str(bytes(view[pos:pos + 16])), pos + 16)
+    elif tag == _ADDR:
+        if pos + 4 > len(view):
+            raise IndexError("address runs past the end of the message")
+        host = socket.inet_ntoa(bytes(view[pos:pos + 4]))
+        return ([host, _PORT.unpack_from(view, pos + 4)[0]], pos + 4 + _PORT.size)
+    elif tag == _LIST:
+        (count, pos) = _read_varint(view, pos)
+        items = []
+        for _ in range(count):
+            (item, pos) = _read_value(view, pos)
+            items.append(item)
+        return (items, pos)
+    elif tag == _DICT:
+        (count, pos) = _read_varint(view, pos)
+        items = {}
+        for _ in range(count):
+            (name, pos) = _read_str(view, pos)
+            (items[name], pos) = _read_value(view, pos)
+        return (items, pos)
+    raise CodecError("Unknown value tag {tag}".format(tag=tag))
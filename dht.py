@@ -1,10 +1,23 @@
 import asyncio
+import collections
+import heapq
+import json
 
+import dispatch
+import index
 import network
+import placement
+import merkle
+import metrics
+import ring
+import storage
+import swim
 import timer
 from enum import Enum
 import logging
 import datetime
+import os
+import random
 import time
 
 
@@ -14,6 +27,62 @@ _TIMER_LONG = datetime.timedelta(seconds=20)
 _MARGIN = 2
 _REPEAT = _MARGIN * (_LONG / _SHORT)
 
+DHT_RING_ROUTING = True
+DHT_REPLICATION_FACTOR = 3
+DHT_PLACEMENT_POLICY = "least_loaded"
+DHT_NODE_CAPACITY = 1
+# Below the client timeout, so a partial answer reaches the client before it gives up on the request.
+DHT_BATCH_TIMEOUT = datetime.timedelta(seconds=0.5)
+# Reads avoid a node that let a batch time out for this long, or until it answers again.
+DHT_SILENT_TIMEOUT = datetime.timedelta(seconds=10)
+# Replica acks a client write waits for before it is answered; None means a majority of the replicas written.
+DHT_WRITE_QUORUM = None
+# "replica" answers reads from any node holding the key, "master" routes every read through the master.
+DHT_READ_CONSISTENCY = "replica"
+# Directory holding each node's durable log and snapshots in a subdirectory named after its uuid;
+# None keeps data in memory only. Pass storage_path (or a fixed node_id) to reopen a node's data after a restart.
+DHT_STORAGE_PATH = None
+# Replicas compare Merkle digests of the keys they share with a random peer this often.
+DHT_ANTI_ENTROPY_INTERVAL = datetime.timedelta(seconds=30)
+# Removals are remembered this long so anti-entropy does not bring removed keys back.
+DHT_TOMBSTONE_TTL = datetime.timedelta(minutes=10)
+# Keys left under-replicated by a dead node are copied at most this many per interval.
+DHT_REREPLICATION_INTERVAL = datetime.timedelta(seconds=0.1)
+DHT_REREPLICATION_BATCH = 64
+# Keys this node no longer owns after a ring change move to their owners in paced batches,
+# and are dropped once every owner has acknowledged them.
+DHT_HANDOFF_INTERVAL = datetime.timedelta(seconds=0.2)
+DHT_HANDOFF_BATCH = 256
+# Slaves announce a key count and digest; the master pulls the key list in pages only on a mismatch.
+DHT_INVENTORY_PAGE_KEYS = 128
+DHT_INVENTORY_WINDOW = 4
+DHT_INVENTORY_TIMEOUT = datetime.timedelta(seconds=1)
+DHT_INVENTORY_RETRIES = 5
+# "heartbeat": the master pings every slave and every slave pings the master.
+# "swim": every node probes one random member per period, with indirect probes and suspicion.
+DHT_FAILURE_DETECTOR = "heartbeat"
+DHT_SWIM_PERIOD = datetime.timedelta(seconds=1)
+DHT_SWIM_PROBE_TIMEOUT = datetime.timedelta(seconds=0.3)
+DHT_SWIM_INDIRECT_PROBES = 3
+# Keys per stat_keys_success page.
+DHT_STAT_PAGE_KEYS = 64
+# Masters repeat leader_is_here this often, so the masters left by a healed partition meet and merge.
+DHT_LEADER_ANNOUNCE_INTERVAL = datetime.timedelta(seconds=5)
+# A slave without a complete peer list this long after attaching asks the master for it again.
+DHT_PEER_LIST_TIMEOUT = datetime.timedelta(seconds=0.5)
+# A starting node first says hello to these addresses and to its cached leader, and
+# only falls back to the broadcast election when none of them answers in time.
+DHT_SEED_ADDRS = []
+DHT_SEED_TIMEOUT = datetime.timedelta(seconds=0.5)
+DHT_SEED_ATTEMPTS = 3
+# Last known leader and members, kept in the node's storage directory unless leader_cache_path is given.
+DHT_LEADER_CACHE_FILE = "leader.json"
+DHT_LEADER_CACHE_PEERS = 8
+
+
+def item_size(key, value):
+    return len(json.dumps(key)) + len(json.dumps(value))
+
 
 class DHT(network.Network, timer.Timer):
     class State(Enum):
@@ -22,399 +91,1647 @@ class DHT(network.Network, timer.Timer):
         SLAVE = 3
 
     def update_peer_list(self):
-
+        # A full membership broadcast starts a new epoch that every slave re-attaches to;
+        # later joins and leaves go out as peer_delta messages instead.
+        self.update_ring()
         for (_, timer) in self._context.heartbeat_timer.items():
             timer.cancel()
         self._context.heartbeat_timer.clear()
-        self._context.timestamp = time.time()
-        self._context.data_counter_dict.clear()
-        self._context.node_key.clear()
-        message = {
-            "type": "leader_is_here",
-            "uuid": self.uuid,
-            "timestamp": self._context.timestamp,
-            "peer_count": len(self._context.peer_list) + 1,
-        }
-        if not (self.uuid in self._context.node_key.keys()):
-            self._context.node_key[self.uuid] = self._context.key
-        self.send_message(message, (network.NETWORK_BROADCAST_ADDR, network.NETWORK_PORT))
+        self._context.timestamp = self.now()
+        self._context.version = 0
+        self._context.placement.clear()
+        self._context.placement.add(self.uuid, None, len(self._data), DHT_NODE_CAPACITY)
+        self._context.key_index.clear()
+        self._context.key_index.replace(self.uuid, self._data.keys())
+        self._context.reported.clear()
+        self._context.audited = False
+        for (uuid, _) in self._context.peer_list:
+            self.start_heartbeat_timer(uuid)
+        self.send_membership((network.NETWORK_BROADCAST_ADDR, network.NETWORK_PORT))
+        self.save_leader_cache()
+        self.audit_replication()
+
+    def send_membership(self, addr):
+        self.announce_leader(addr)
 
         index = 0
-        for (uuid, addr) in self._context.peer_list:
-            self._context.heartbeat_timer[uuid] = \
-                self.async_trigger(lambda: self.master_heartbeat_timeout(uuid), _TIMER_LONG)
+        for (uuid, peer_addr) in self._context.peer_list:
             index += 1
             message = {
                 "type": "peer_list",
                 "uuid": self.uuid,
                 "timestamp": self._context.timestamp,
+                "version": self._context.version,
+                "peer_count": len(self._context.peer_list) + 1,
                 "peer_index": index,
                 "peer_uuid": uuid,
-                "peer_addr": addr,
+                "peer_addr": peer_addr,
             }
-            self.send_message(message, (network.NETWORK_BROADCAST_ADDR, network.NETWORK_PORT))
+            self.send_message(message, addr)
+
+    def send_peer_delta(self, op, uuid, addr):
+        self._context.version += 1
+        message = {
+            "type": "peer_delta",
+            "uuid": self.uuid,
+            "timestamp": self._context.timestamp,
+            "version": self._context.version,
+            "op": op,
+            "peer_uuid": uuid,
+            "peer_addr": addr,
+        }
+        self.send_message(message, (network.NETWORK_BROADCAST_ADDR, network.NETWORK_PORT))
+
+    def start_heartbeat_timer(self, uuid):
+        if self._failure_detector != "heartbeat":
+            return
+        timer = self._context.heartbeat_timer.get(uuid)
+        if timer is not None:
+            timer.reset(_TIMER_LONG)
+        else:
+            self._context.heartbeat_timer[uuid] = \
+                self.async_trigger(lambda: self.master_heartbeat_timeout(uuid), _TIMER_LONG)
+
+    def register_handlers(self):
+        START = self.State.START
+        MASTER = self.State.MASTER
+        SLAVE = self.State.SLAVE
+        register = self._dispatcher.register
+        register("hello", [START], self.start_on_hello)
+        register("hello", [MASTER], self.master_on_hello)
+        register("hello", [SLAVE], self.slave_on_hello)
+        register("hello_relayed", [MASTER], self.master_on_hello_relayed)
+        register("heartbeat_ping", [MASTER, SLAVE], self.on_heartbeat_ping)
+        register("heartbeat_pong", [MASTER], self.master_on_heartbeat_pong)
+        register("heartbeat_pong", [SLAVE], self.slave_on_heartbeat_pong)
+        register("leader_is_here", [START, SLAVE], self.on_leader_is_here)
+        register("leader_is_here", [MASTER], self.master_on_leader_is_here)
+        register("data_counter_and_keys", [MASTER], self.master_on_data_counter_and_keys)
+        register("inventory_pull", [SLAVE], self.slave_on_inventory_pull)
+        register("inventory_page", [MASTER], self.master_on_inventory_page)
+        register("peer_list", [SLAVE], self.slave_on_peer_list)
+        register("peer_delta", [SLAVE], self.slave_on_peer_delta)
+        register("membership_sync", [MASTER], self.master_on_membership_sync)
+        register("new_leader_election", [MASTER, SLAVE], self.on_new_leader_election)
+        register("you_are_rejected", [MASTER], self.on_new_leader_election)
+        register("you_are_rejected", [SLAVE], self.slave_on_you_are_rejected)
+        register("get", [MASTER, SLAVE], self.on_get)
+        register("get_relayed", [MASTER], self.master_on_get_relayed)
+        register("get_ask", [MASTER, SLAVE], self.on_get_ask)
+        register("put", [MASTER, SLAVE], self.on_put)
+        register("put_relayed", [MASTER], self.master_on_put_relayed)
+        register("put_final", [MASTER, SLAVE], self.on_put_final)
+        register("put_response", [MASTER], self.master_on_put_response)
+        register("remove", [MASTER, SLAVE], self.on_remove)
+        register("remove_relayed", [MASTER], self.master_on_remove_relayed)
+        register("remove_ask", [MASTER, SLAVE], self.on_remove_ask)
+        register("remove_response", [MASTER], self.master_on_remove_response)
+        register("put_ack", [MASTER, SLAVE], self.on_write_ack)
+        register("remove_ack", [MASTER, SLAVE], self.on_write_ack)
+        register("stat", [MASTER], self.master_on_stat)
+        register("stat", [SLAVE], self.slave_on_stat)
+        register("stat_relay", [MASTER], self.master_on_stat_relay)
+        register("stat_keys", [MASTER], self.master_on_stat_keys)
+        register("stat_keys", [SLAVE], self.slave_on_stat)
+        register("stat_keys_relay", [MASTER], self.master_on_stat_keys_relay)
+        register("members", [MASTER, SLAVE], self.on_members)
+        register("metrics", [START, MASTER, SLAVE], self.on_metrics)
+        register("sync_tree", [MASTER, SLAVE], self.on_sync_tree)
+        register("sync_keys", [MASTER, SLAVE], self.on_sync_keys)
+        register("sync_pull", [MASTER, SLAVE], self.on_sync_pull)
+        register("sync_push", [MASTER, SLAVE], self.on_sync_push)
+        register("replicate", [SLAVE], self.slave_on_replicate)
+        register("handoff", [MASTER, SLAVE], self.on_handoff)
+        register("handoff_ack", [MASTER, SLAVE], self.on_handoff_ack)
+        # Nodes in the middle of an election still answer probes, or everyone would suspect them.
+        register("swim_ping", [START, MASTER, SLAVE], self.on_swim_ping)
+        register("swim_ping_req", [START, MASTER, SLAVE], self.on_swim_ping_req)
+        register("swim_ack", [START, MASTER, SLAVE], self.on_swim_ack)
+        for kind in ("mget", "mput", "mremove"):
+            register(kind, [MASTER, SLAVE], self.on_batch)
+            register(kind + "_relayed", [MASTER], self.master_on_batch_relayed)
+            register(kind + "_ask", [MASTER, SLAVE], self.on_batch_ask)
+            register(kind + "_reply", [MASTER, SLAVE], self.on_batch_reply)
 
     def message_arrived(self, message, addr):
-        if message["uuid"] == self.uuid:
+        if message["uuid"] == self.uuid or self._dispatcher is None:
             return
         logging.debug("Message received from {addr}, {message}".format(addr=addr, message=message))
+        self._dispatcher.dispatch(message, addr, self._state)
+
+    def dispatch_stats(self):
+        return self._dispatcher.report()
+
+    def start_on_hello(self, message, addr):
+        self._context.messages.append((message, addr))
+
+    def master_on_hello(self, message, addr):
+        self.master_add_peer(message["uuid"], addr)
+
+    def slave_on_hello(self, message, addr):
+        if self._broadcast_mode == "members" or message.get("direct"):
+            # Joining nodes only reach their seeds; pass the hello on to the master.
+            _message = {
+                "type": "hello_relayed",
+                "uuid": self.uuid,
+                "peer_uuid": message["uuid"],
+                "peer_addr": addr,
+            }
+            self.send_message(_message, self._context.master_addr)
+
+    def master_on_hello_relayed(self, message, addr):
+        self.master_add_peer(message["peer_uuid"], tuple(message["peer_addr"]))
+
+    def announce_leader(self, addr):
+        message = {
+            "type": "leader_is_here",
+            "uuid": self.uuid,
+            "timestamp": self._context.timestamp,
+            "peer_count": len(self._context.peer_list) + 1,
+            "version": self._context.version,
+        }
+        self.send_message(message, addr)
+
+    def on_heartbeat_ping(self, message, addr):
+        message = {
+            "type": "heartbeat_pong",
+            "uuid": self.uuid,
+            "timestamp": self.now(),
+            "echo": message.get("timestamp"),
+        }
+        if self._state == self.State.MASTER:
+            # Lets a slave that missed the last peer_delta notice it.
+            message["version"] = self._context.version
+        logging.info("CURRENT_DATA:{data}".format(data=self._data))
+        self.send_message(message, addr)
+
+    def heartbeat_rtt(self, message):
+        if message.get("echo") is not None:
+            self._heartbeat_rtt.observe(max(self.now() - message["echo"], 0.0))
+
+    def master_on_heartbeat_pong(self, message, addr):
+        self.heartbeat_rtt(message)
+        client_uuid = message["uuid"]
+        if client_uuid in self._context.heartbeat_timer:
+            self.start_heartbeat_timer(client_uuid)
+
+    def slave_on_heartbeat_pong(self, message, addr):
+        self.heartbeat_rtt(message)
+        master_uuid = message["uuid"]
+        if self._context.master_uuid == master_uuid:
+            self._context.heartbeat_timer.reset(_TIMER_LONG)
+            version = message.get("version")
+            if version is not None and (self._context.version is None or self._context.version < version):
+                self.request_membership_sync()
 
-        if message["type"] == "hello":
-            if self._state == self.State.START:
-                self._context.messages.append((message, addr))
-            elif self._state == self.State.MASTER:
-                if not (message["uuid"], addr) in self._context.peer_list:
-                    self._context.peer_list.append((message["uuid"], addr))
-                    self._context.peer_list.sort(reverse=True)
-                    self.update_peer_list()
-                    self.master_peer_list_updated()
-        elif message["type"] == "heartbeat_ping":
+    def on_leader_is_here(self, message, addr):
+        # The newest epoch leads; two masters elected at the same moment are ordered by uuid.
+        if self._state == self.State.START or (self._state == self.State.SLAVE and (
+                self._context.master_timestamp, self._context.master_uuid) < (message["timestamp"], message["uuid"])):
+            self.slave_attach(message["uuid"], addr, message["timestamp"], int(message["peer_count"]))
+        elif self._state == self.State.SLAVE and self._context.master_uuid == message["uuid"]:
+            self.slave_check_listed()
+
+    def slave_check_listed(self):
+        # A lost data_counter_and_keys leaves this node attached but unknown to the master.
+        if self._context.version is not None and self.uuid not in self._ring:
+            self.report_data()
+
+    def master_on_leader_is_here(self, message, addr):
+        # Another master: the two sides of a healed partition. The one that leads a newer epoch stays.
+        if (message["timestamp"], message["uuid"]) <= (self._context.timestamp, self.uuid):
+            return
+        logging.info("MASTER {uuid} leads a newer epoch; following it.".format(uuid=message["uuid"]))
+        # Slaves that have not heard the winner yet rejoin through hello; the rest ignore this.
+        rejected = {
+            "type": "you_are_rejected",
+            "uuid": self.uuid,
+        }
+        for (_, peer_addr) in self._context.peer_list:
+            self.send_message(rejected, peer_addr)
+        self.slave_attach(message["uuid"], addr, message["timestamp"], int(message["peer_count"]))
+
+    def slave_on_you_are_rejected(self, message, addr):
+        if self._context.master_uuid == message["uuid"]:
+            self.on_new_leader_election(message, addr)
+
+    def slave_attach(self, master_uuid, master_addr, timestamp, peer_count=0):
+        self._context.cancel()
+        self._state = self.State.SLAVE
+        self._context = self.SlaveContext()
+        self._context.master_uuid = master_uuid
+        self._context.master_addr = master_addr
+        self._context.peer_count = peer_count
+        self._context.master_timestamp = timestamp
+        # Route through the master until the full peer list has arrived.
+        self._ring.rebuild([])
+        self.report_data()
+        if timestamp != -1:
+            self.save_leader_cache()
+        # Keeps asking for the membership until a full peer list has arrived.
+        self._context.peer_list_timer = self.trigger(self.peer_list_check, DHT_PEER_LIST_TIMEOUT)
+        asyncio.ensure_future(self.slave(), loop=self._loop)
+
+    def report_data(self):
+        # The store outlives roles: report what this node holds so the new master
+        # can rebuild its placement view without reloading anything.
+        message = {
+            "type": "data_counter_and_keys",
+            "uuid": self.uuid,
+            "data_counter": len(self._data),
+            "bytes": self._data_bytes,
+            "capacity": DHT_NODE_CAPACITY,
+            "digest": index.key_digest(self._data),
+        }
+        self.send_message(message, self._context.master_addr)
+
+    def master_on_data_counter_and_keys(self, message, addr):
+        if message["uuid"] not in self._ring:
+            # The slave attached on a leader_is_here before its hello reached us.
+            self.master_add_peer(message["uuid"], addr)
+        self._context.placement.add(message["uuid"], addr, message["data_counter"], message.get("capacity", 1))
+        self._context.node_bytes[message["uuid"]] = message.get("bytes", 0)
+        key_index = self._context.key_index
+        if "key_list" in message:
+            key_index.replace(message["uuid"], message["key_list"])
+        elif key_index.digest(message["uuid"]) != message["digest"] or \
+                key_index.count(message["uuid"]) != message["data_counter"]:
+            self.pull_inventory(message["uuid"], addr, message["data_counter"])
+        self._context.reported.add(message["uuid"])
+        self.audit_replication()
+
+    def pull_inventory(self, uuid, addr, count):
+        prev = self._context.inventory.pop(uuid, None)
+        if prev is not None:
+            prev.cancel()
+        pages = max(1, (count + DHT_INVENTORY_PAGE_KEYS - 1) // DHT_INVENTORY_PAGE_KEYS)
+        inventory = self.Inventory(uuid, addr, pages)
+        # Each page replaces its own slice of what the index holds, so updates that
+        # arrive while the pages are in flight are not lost.
+        for key in self._context.key_index.keys(uuid):
+            inventory.stale.setdefault(index.key_hash(key) % pages, set()).add(key)
+        self._context.inventory[uuid] = inventory
+        logging.info("Pulling the inventory of {uuid} in {pages} pages".format(uuid=uuid, pages=pages))
+        self.request_inventory_pages(inventory)
+
+    def request_inventory_pages(self, inventory, retry=False):
+        if retry:
+            pages = sorted(inventory.requested - inventory.received)
+        else:
+            pages = []
+            while inventory.next_page < inventory.pages and \
+                    len(inventory.requested - inventory.received) + len(pages) < DHT_INVENTORY_WINDOW:
+                pages.append(inventory.next_page)
+                inventory.next_page += 1
+        for page in pages:
+            inventory.requested.add(page)
             message = {
-                "type": "heartbeat_pong",
+                "type": "inventory_pull",
                 "uuid": self.uuid,
-                "timestamp": time.time(),
+                "pages": inventory.pages,
+                "page": page,
             }
-            logging.info("CURRENT_DATA:{data}".format(data=self._context.data))
-            self.send_message(message, addr)
-        elif message["type"] == "heartbeat_pong":
-            if self._state == self.State.MASTER:
-                client_uuid = message["uuid"]
-                if client_uuid in self._context.heartbeat_timer:
-                    prev = self._context.heartbeat_timer[client_uuid]
-                    prev.cancel()
-                    self._context.heartbeat_timer[client_uuid] = \
-                        self.async_trigger(lambda: self.master_heartbeat_timeout(client_uuid), _TIMER_LONG)
-            elif self._state == self.State.SLAVE:
-                master_uuid = message["uuid"]
-                if self._context.master_uuid == master_uuid:
-                    self._context.heartbeat_timer.cancel()
-                    self._context.heartbeat_timer = self.async_trigger(self.slave_heartbeat_timeout, _TIMER_LONG)
-        elif message["type"] == "leader_is_here":
-            tmp = None
-            tmp_data = None
-            tmp_keys = None
-            if self._state == self.State.SLAVE:
-                tmp = self._context.data_counter
-                tmp_data = self._context.data
-                tmp_key = self._context.key
-            if self._state == self.State.START or \
-                    (self._state == self.State.SLAVE and self._context.master_timestamp < message["timestamp"]):
-                self._context.cancel()
-                self._state = self.State.SLAVE
-                self._context = self.SlaveContext()
-                self._context.master_uuid = message["uuid"]
-                self._context.master_addr = addr
-                self._context.peer_count = int(message["peer_count"])
-                self._context.master_timestamp = message["timestamp"]
-                if tmp:
-                    self._context.data_counter = tmp
-                if tmp_data:
-                    self._context.data = tmp_data
-                if tmp_keys:
-                    self._context.key = tmp_key
-                message = {
-                    "type": "data_counter_and_keys",
-                    "uuid": self.uuid,
-                    "data_counter": self._context.data_counter,
-                    "key_list": self._context.key,
-                }
-                self.send_message(message, self._context.master_addr)
-                asyncio.ensure_future(self.slave(), loop=self._loop)
-                pass
-        elif message["type"] == "data_counter_and_keys":
-            if self._state == self.State.MASTER:
-                self._context.data_counter_dict[message["uuid"]] = message["data_counter"]
-                self._context.node_key[message["uuid"]] = message["key_list"]
-        elif message["type"] == "peer_list":
-            if self._state == self.State.SLAVE:
-                if self._context.master_uuid == message["uuid"]:
-                    self._context.peer_index[message["peer_index"]] = (message["peer_uuid"], message["peer_addr"])
-                    if (len(self._context.peer_index) + 1) == self._context.peer_count:
-                        self._context.peer_list = []
-                        for i in range(1, self._context.peer_count):
-                            self._context.peer_list.append(self._context.peer_index[i])
-                        self.slave_peer_list_updated()
-        elif message["type"] == "new_leader_election":
-            if self._context.heartbeat_send_job is not None:
-                self._context.heartbeat_send_job.cancel()
-            self._context.cancel()
-            self._state = self.State.START
-            self._context = self.StartContext()
-            asyncio.ensure_future(self.start(), loop=self._loop)
-        elif message["type"] == "you_are_rejected":
-            if self._context.heartbeat_send_job is not None:
-                self._context.heartbeat_send_job.cancel()
-            self._context.cancel()
-            self._state = self.State.START
-            self._context = self.StartContext()
-            asyncio.ensure_future(self.start(), loop=self._loop)
-        elif message["type"] == "get":
-            logging.info("Client request: get")
+            self.send_message(message, inventory.addr)
+        if inventory.timer is not None:
+            inventory.timer.cancel()
+        inventory.timer = self.trigger(lambda: self.inventory_timeout(inventory), DHT_INVENTORY_TIMEOUT)
+
+    def inventory_timeout(self, inventory):
+        if self._context.inventory.get(inventory.uuid) is not inventory:
+            return
+        inventory.retries += 1
+        if inventory.retries > DHT_INVENTORY_RETRIES:
+            logging.warning("Giving up on the inventory of {uuid}".format(uuid=inventory.uuid))
+            del self._context.inventory[inventory.uuid]
+            self.audit_replication()
+            return
+        self.request_inventory_pages(inventory, retry=True)
+
+    def slave_on_inventory_pull(self, message, addr):
+        pages = message["pages"]
+        if self._context.inventory_pages is None or self._context.inventory_pages[0] != pages:
+            groups = {}
+            for key in self._data:
+                groups.setdefault(index.key_hash(key) % pages, []).append(key)
+            self._context.inventory_pages = (pages, groups)
+        page = message["page"]
+        # Keys written since the grouping reach the master through put_response anyway.
+        keys = [key for key in self._context.inventory_pages[1].get(page, []) if key in self._data]
+        _message = {
+            "type": "inventory_page",
+            "uuid": self.uuid,
+            "pages": pages,
+            "page": page,
+            "key_list": keys,
+        }
+        self.send_message(_message, addr)
+
+    def master_on_inventory_page(self, message, addr):
+        inventory = self._context.inventory.get(message["uuid"])
+        if inventory is None or inventory.pages != message["pages"] or message["page"] in inventory.received:
+            return
+        inventory.received.add(message["page"])
+        key_index = self._context.key_index
+        keys = set(message["key_list"])
+        for key in inventory.stale.pop(message["page"], set()) - keys:
+            key_index.discard(inventory.uuid, key)
+        for key in keys:
+            key_index.add(inventory.uuid, key)
+        if len(inventory.received) < inventory.pages:
+            inventory.retries = 0
+            self.request_inventory_pages(inventory)
+        else:
+            inventory.cancel()
+            del self._context.inventory[inventory.uuid]
+            logging.info("Inventory of {uuid} complete: {count} keys".format(
+                uuid=inventory.uuid, count=key_index.count(inventory.uuid)))
+            self.audit_replication()
+
+    def slave_on_peer_list(self, message, addr):
+        if self._context.master_uuid == message["uuid"] and self._context.master_timestamp == -1:
+            # Attached from the election without hearing leader_is_here: take the master's epoch
+            # from its list, and report again in case the first report reached it before it led.
+            self._context.master_timestamp = message.get("timestamp")
+            self.report_data()
+        if self._context.master_uuid == message["uuid"] and self._context.master_timestamp == message.get("timestamp"):
+            version = message.get("version")
+            if self._context.version is not None and version is not None and version <= self._context.version:
+                return
+            if version != self._context.peer_index_version:
+                # A newer full list is on its way; drop what was collected for the old one.
+                # Its size travels with it: peer_delta keeps peer_count current meanwhile.
+                self._context.peer_index = {}
+                self._context.peer_index_version = version
+                self._context.peer_index_count = int(message["peer_count"])
+            self._context.peer_index[message["peer_index"]] = (message["peer_uuid"], message["peer_addr"])
+            if (len(self._context.peer_index) + 1) == self._context.peer_index_count:
+                self._context.peer_list = []
+                for i in range(1, self._context.peer_index_count):
+                    self._context.peer_list.append(self._context.peer_index[i])
+                self._context.peer_index = {}
+                self._context.peer_count = self._context.peer_index_count
+                self._context.version = version
+                self.update_ring()
+                self.slave_peer_list_updated()
+                self.save_leader_cache()
+
+    def slave_on_peer_delta(self, message, addr):
+        if self._context.master_uuid != message["uuid"] or self._context.master_timestamp != message["timestamp"]:
+            return
+        version = message["version"]
+        if self._context.version is None or version <= self._context.version:
+            return
+        if version != self._context.version + 1:
+            logging.info("Membership gap: at version {have}, got {got}".format(have=self._context.version, got=version))
+            self.request_membership_sync()
+            return
+        peer_uuid = message["peer_uuid"]
+        self._context.peer_list = [(uuid, addr) for (uuid, addr) in self._context.peer_list if uuid != peer_uuid]
+        if message["op"] == "join":
+            self._context.peer_list.append((peer_uuid, message["peer_addr"]))
+            self._context.peer_list.sort(reverse=True)
+        self._context.peer_count = len(self._context.peer_list) + 1
+        self._context.version = version
+        self.update_ring()
+        self.slave_peer_list_updated()
+
+    def peer_list_check(self):
+        # The list may have overtaken leader_is_here and been dropped.
+        if self._state != self.State.SLAVE or self._context.version is not None:
+            return
+        self.request_membership_sync()
+        self._context.peer_list_timer = self.trigger(self.peer_list_check, DHT_PEER_LIST_TIMEOUT)
+
+    def request_membership_sync(self):
+        message = {
+            "type": "membership_sync",
+            "uuid": self.uuid,
+        }
+        self.send_message(message, self._context.master_addr)
+
+    def master_on_membership_sync(self, message, addr):
+        self.send_membership(addr)
+
+    def on_new_leader_election(self, message, addr):
+        if self._context.heartbeat_send_job is not None:
+            self._context.heartbeat_send_job.cancel()
+        self._context.cancel()
+        self._state = self.State.START
+        self._context = self.StartContext()
+        asyncio.ensure_future(self.start(), loop=self._loop)
+
+    def on_get(self, message, addr):
+        logging.info("Client request: get")
+        if DHT_READ_CONSISTENCY == "replica":
+            # With a ring only its owners answer; a former owner's copy may be stale.
+            if self.ring_get(message["key"], addr, message.get("rid")) or \
+                    (not self.ring_replicas(message["key"]) and self.get_local(message["key"], addr, message.get("rid"))):
+                return
+        if self._state == self.State.SLAVE:
+            _message = {
+                "type": "get_relayed",
+                "uuid": self.uuid,
+                "cli_addr": addr,
+                "rid": message.get("rid"),
+                "key": message["key"],
+            }
+            self.send_message(_message, self._context.master_addr)
+        else:
+            self.master_get(message["key"], addr, message.get("rid"))
+
+    def master_on_get_relayed(self, message, addr):
+        self.master_get(message["key"], tuple(message["cli_addr"]), message.get("rid"))
+
+    def on_get_ask(self, message, addr):
+        if self.get_local(message["key"], tuple(message["cli_addr"]), message.get("rid")):
+            return
+        if message.get("routed", False) and message["key"] in self._tombstones:
+            # The owner removed it; copies the key index still lists elsewhere are stale.
+            self.get_missing(message["key"], tuple(message["cli_addr"]), message.get("rid"))
+            return
+        if message.get("routed", False):
+            # The ring owner misses the key (e.g. placed before a membership change),
+            # so fall back to the master's key inventory.
             if self._state == self.State.SLAVE:
                 _message = {
                     "type": "get_relayed",
                     "uuid": self.uuid,
-                    "cli_addr": addr,
+                    "cli_addr": message["cli_addr"],
+                    "rid": message.get("rid"),
                     "key": message["key"],
                 }
                 self.send_message(_message, self._context.master_addr)
-            elif self._state == self.State.MASTER:
-                if message["key"] in self._context.data.keys():
-                    _message = {
-                        "type": "get_success",
-                        "uuid": self.uuid,
-                        "key": message["key"],
-                        "value": self._context.data[message["key"]],
-                    }
-                    self.send_message(_message, addr)
-                else:
-                    tmp = addr
-                    for (uuid, addr) in self._context.peer_list:
-                        if message["key"] in self._context.node_key[uuid]:
-                            _message = {
-                                "type": "get_ask",
-                                "uuid": self.uuid,
-                                "cli_addr": tmp,
-                                "key": message["key"],
-                            }
-                            self.send_message(_message, addr)
-                            return
-                    _message = {
-                        "type": "get_success",
-                        "uuid": self.uuid,
-                        "key": message["key"],
-                        "value": None
-                    }
-                    self.send_message(_message, tmp)
-        elif message["type"] == "get_relayed":
-            if self._state == self.State.MASTER:
-                if message["key"] in self._context.data.keys():
+            else:
+                self.master_get(message["key"], tuple(message["cli_addr"]), message.get("rid"))
+
+    def on_put(self, message, addr):
+        logging.info("Client request: put")
+        if self.ring_put(message["key"], message["value"], addr, message.get("rid")):
+            return
+        if self._state == self.State.SLAVE:
+            _message = {
+                "type": "put_relayed",
+                "uuid": self.uuid,
+                "cli_addr": addr,
+                "rid": message.get("rid"),
+                "key": message["key"],
+                "value": message["value"],
+            }
+            self.send_message(_message, self._context.master_addr)
+        else:
+            self.master_put(message["key"], message["value"], addr, message.get("rid"))
+
+    def master_on_put_relayed(self, message, addr):
+        self.master_put(message["key"], message["value"], tuple(message["cli_addr"]), message.get("rid"))
+
+    def on_put_final(self, message, addr):
+        # Replica writes can arrive out of order; a stale one is dropped but still acknowledged.
+        if self.supersedes(message["key"], message.get("version"), message["value"]):
+            self.store_local(message["key"], message["value"], version=message.get("version"))
+        self.write_ack("put", message, addr)
+
+    def master_on_put_response(self, message, addr):
+        if "bytes" in message:
+            self._context.node_bytes[message["uuid"]] = message["bytes"]
+        for key in message.get("keys", [message.get("key")]):
+            if self._context.key_index.add(message["uuid"], key):
+                self._context.placement.adjust(message["uuid"], 1)
+
+    def on_remove(self, message, addr):
+        logging.info("Client request: remove")
+        if self.ring_remove(message["key"], addr, message.get("rid")):
+            return
+        if self._state == self.State.SLAVE:
+            _message = {
+                "type": "remove_relayed",
+                "uuid": self.uuid,
+                "cli_addr": addr,
+                "rid": message.get("rid"),
+                "key": message["key"],
+            }
+            self.send_message(_message, self._context.master_addr)
+        else:
+            self.master_remove(message["key"], addr, message.get("rid"))
+
+    def master_on_remove_relayed(self, message, addr):
+        self.master_remove(message["key"], message["cli_addr"], message.get("rid"))
+
+    def on_remove_ask(self, message, addr):
+        if self.supersedes(message["key"], message.get("version"), removed=True):
+            self.remove_local(message["key"], version=message.get("version"))
+        self.write_ack("remove", message, addr)
+
+    def write_ack(self, kind, message, addr):
+        if message.get("write") is not None:
+            _message = {
+                "type": kind + "_ack",
+                "uuid": self.uuid,
+                "write": message["write"],
+            }
+            self.when_durable(lambda: self.send_message(_message, addr))
+
+    def on_write_ack(self, message, addr):
+        self.write_acked(message["write"], message["uuid"])
+
+    def master_on_remove_response(self, message, addr):
+        if "bytes" in message:
+            self._context.node_bytes[message["uuid"]] = message["bytes"]
+        for key in message.get("keys", [message.get("key")]):
+            if self._context.key_index.discard(message["uuid"], key):
+                self._context.placement.adjust(message["uuid"], -1)
+
+    def master_on_stat(self, message, addr):
+        # Only aggregates: per-key detail is paged out through stat_keys.
+        key_index = self._context.key_index
+        self._context.node_bytes[self.uuid] = self._data_bytes
+        _message = {
+            "type": "stat_success",
+            "uuid": self.uuid,
+            "rid": message.get("rid"),
+            "replication": DHT_REPLICATION_FACTOR,
+            "keys": len(key_index),
+            "histogram": sorted(key_index.histogram().items()),
+            "node_stats": [[uuid, key_index.count(uuid), self._context.node_bytes.get(uuid, 0)]
+                           for uuid in key_index.nodes()],
+        }
+        self.send_message(_message, addr)
+
+    def master_on_stat_keys(self, message, addr):
+        key_index = self._context.key_index
+        node = message.get("node")
+        replicas = message.get("replicas")
+        cursor = message.get("cursor")
+        limit = min(message.get("limit") or DHT_STAT_PAGE_KEYS, DHT_STAT_PAGE_KEYS)
+        keys = key_index.keys(node) if node is not None else key_index.keys_all()
+        if replicas is not None:
+            keys = (key for key in keys if len(key_index.replicas(key)) == replicas)
+        if cursor is not None:
+            keys = (key for key in keys if str(key) > cursor)
+        # Pages follow str(key) order, so a cursor stays valid while keys come and go.
+        page = heapq.nsmallest(limit + 1, keys, key=str)
+        more = len(page) > limit
+        page = page[:limit]
+        _message = {
+            "type": "stat_keys_success",
+            "uuid": self.uuid,
+            "rid": message.get("rid"),
+            "entries": [[key, sorted(key_index.replicas(key))] for key in page],
+            "cursor": str(page[-1]) if more else None,
+        }
+        self.send_message(_message, addr)
+
+    def slave_on_stat(self, message, addr):
+        _message = dict(message)
+        _message["type"] = message["type"] + "_relay"
+        _message["uuid"] = self.uuid
+        _message["cli_addr"] = addr
+        self.send_message(_message, self._context.master_addr)
+
+    def master_on_stat_relay(self, message, addr):
+        self.master_on_stat(message, tuple(message["cli_addr"]))
+
+    def master_on_stat_keys_relay(self, message, addr):
+        self.master_on_stat_keys(message, tuple(message["cli_addr"]))
+
+    def on_metrics(self, message, addr):
+        _message = {
+            "type": "metrics_success",
+            "uuid": self.uuid,
+            "rid": message.get("rid"),
+            "metrics": self._metrics.snapshot(),
+        }
+        self.send_message(_message, addr)
+
+    def register_metrics(self):
+        registry = self._metrics
+        self._heartbeat_rtt = registry.histogram("dht_heartbeat_rtt_seconds", "Heartbeat ping to pong round trip")
+        self._elections = registry.counter("dht_elections_total", "Elections started after losing the master")
+        self._peers_lost = registry.counter("dht_peers_lost_total", "Slaves dropped by this node as master")
+        registry.gauge("dht_state", "1 start, 2 master, 3 slave", func=lambda: self._state.value)
+        registry.gauge("dht_keys", "Keys stored on this node", func=lambda: len(self._data))
+        registry.gauge("dht_data_bytes", "Encoded size of the keys and values on this node",
+                       func=lambda: self._data_bytes)
+        registry.gauge("dht_ring_members", "Members in this node's ring view", func=lambda: len(self._ring))
+        registry.gauge("dht_batches_pending", "Batch requests awaiting replies", func=lambda: len(self._batches))
+        registry.gauge("dht_writes_pending", "Client writes awaiting replica acks", func=lambda: len(self._writes))
+        registry.gauge("dht_rereplication_pending", "Keys queued for re-replication",
+                       func=lambda: len(self._context.rereplication) if self._state == self.State.MASTER else 0)
+        registry.gauge("dht_timers_pending", "Armed timers", func=self.timers_pending)
+
+    def on_members(self, message, addr):
+        if len(self._ring) > 0:
+            _message = {
+                "type": "members_success",
+                "uuid": self.uuid,
+                "rid": message.get("rid"),
+                "timestamp": self.epoch(),
+                "version": self.membership_version(),
+                "replication": DHT_REPLICATION_FACTOR,
+                "members": self._ring.members(),
+            }
+            self.send_message(_message, addr)
+
+    def on_batch(self, message, addr):
+        logging.info("Client request: {type}".format(type=message["type"]))
+        routed = message["type"] != "mget" or DHT_READ_CONSISTENCY == "replica"
+        self.coordinate_batch(message["type"], self.batch_entries(message), addr, message.get("rid"), routed)
+
+    def master_on_batch_relayed(self, message, addr):
+        kind = message["type"][:-len("_relayed")]
+        cli_addr = tuple(message["cli_addr"]) if message.get("cli_addr") is not None else addr
+        self.coordinate_batch(kind, self.batch_entries(message), cli_addr, message.get("rid"),
+                              routed=False, parent=message.get("batch"))
+
+    def on_batch_ask(self, message, addr):
+        kind = message["type"][:-len("_ask")]
+        _message = {
+            "type": kind + "_reply",
+            "uuid": self.uuid,
+            "batch": message["batch"],
+        }
+        _message.update(self.apply_batch(kind, self.batch_entries(message), message.get("version")))
+        self.when_durable(lambda: self.send_message(_message, addr))
+
+    def on_batch_reply(self, message, addr):
+        batch = self._batches.get(message["batch"])
+        if batch is None or addr not in batch.pending:
+            return
+        batch.pending.discard(addr)
+        self._silent.pop(addr, None)
+        batch.merge(message)
+        if not batch.pending:
+            self.batch_done(batch)
+
+    def batch_entries(self, message):
+        if message["type"].startswith("mput"):
+            return [(key, value) for (key, value) in message["items"]]
+        return [(key, None) for key in message["keys"]]
+
+    def coordinate_batch(self, kind, entries, cli_addr, rid=None, routed=True, parent=None):
+        groups = self.resolve_batch(kind, entries, routed)
+        if groups is None:
+            # No ring yet: let the master coordinate and answer the client directly.
+            _message = {
+                "type": kind + "_relayed",
+                "uuid": self.uuid,
+                "cli_addr": cli_addr,
+                "rid": rid,
+            }
+            _message.update(self.batch_payload(kind, entries))
+            self.send_message(_message, self._context.master_addr)
+            return
+        self._next_batch = (self._next_batch + 1) & 0x7FFFFFFF
+        batch = self.Batch(self._next_batch, kind, [key for (key, _) in entries], cli_addr, rid, routed, parent)
+        self.batch_send(batch, groups)
+
+    def resolve_batch(self, kind, entries, routed=True):
+        """Group batch entries by the node that serves them; None stands for this node."""
+        groups = {}
+        if routed and DHT_RING_ROUTING and len(self._ring) > 0:
+            for (key, value) in entries:
+                replicas = self.ring_replicas(key)
+                if kind == "mget":
+                    if key in self._data and any(uuid == self.uuid for (uuid, _) in replicas):
+                        replicas = [(self.uuid, None)]
+                    else:
+                        replicas = sorted((r for r in replicas if r[0] != self.uuid),
+                                          key=lambda r: self.silent(r[1]))[:1]
+                for (uuid, addr) in replicas:
+                    groups.setdefault(None if uuid == self.uuid else tuple(addr), []).append((key, value))
+            return groups
+        if self._state != self.State.MASTER:
+            return None
+        everyone = [(self.uuid, None)] + list(self._context.peer_list)
+        for (key, value) in entries:
+            if kind == "mget":
+                owners = {uuid for (uuid, _) in self.ring_replicas(key)}
+                holders = [(uuid, self._ring.addr(uuid)) for uuid in self._context.key_index.replicas(key)]
+                replicas = sorted((r for r in holders if r[1] is not None),
+                                  key=lambda r: (r[0] not in owners, self.silent(r[1])))[:1]
+                if key in self._data and (not owners or self.uuid in owners or not replicas):
+                    replicas = [(self.uuid, None)]
+            elif kind == "mput":
+                replicas = self._context.placement.pick(DHT_REPLICATION_FACTOR)
+                if len(replicas) < DHT_REPLICATION_FACTOR:
+                    replicas = everyone
+            else:
+                replicas = everyone
+            for (uuid, addr) in replicas:
+                groups.setdefault(None if uuid == self.uuid else tuple(addr), []).append((key, value))
+        return groups
+
+    def batch_payload(self, kind, entries, version=None):
+        if kind == "mput":
+            return {"items": [[key, value] for (key, value) in entries], "version": version}
+        elif kind == "mremove":
+            return {"keys": [key for (key, _) in entries], "version": version}
+        return {"keys": [key for (key, _) in entries]}
+
+    def apply_batch(self, kind, entries, version=None):
+        if kind == "mget":
+            data = self._data
+            return {"items": [[key, data[key]] for (key, _) in entries if key in data],
+                    "removed": [key for (key, _) in entries if key in self._tombstones]}
+        keys = []
+        stored = []
+        for (key, value) in entries:
+            if kind == "mput":
+                if self.supersedes(key, version, value):
+                    self.store_local(key, value, notify=False, version=version)
+                    keys.append(key)
+                stored.append(key)
+            elif self.supersedes(key, version, removed=True) and self.remove_local(key, notify=False, version=version):
+                keys.append(key)
+        if keys and self._state == self.State.SLAVE:
+            _message = {
+                "type": "put_response" if kind == "mput" else "remove_response",
+                "uuid": self.uuid,
+                "keys": keys,
+                "bytes": self._data_bytes,
+            }
+            self.send_message(_message, self._context.master_addr)
+        return {"stored": stored} if kind == "mput" else {"removed": keys}
+
+    def batch_done(self, batch):
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self._batches.pop(batch.id, None)
+        if batch.kind == "mget" and batch.routed:
+            missing = [key for key in batch.keys
+                       if key not in batch.values and key not in batch.done and key not in batch.unfinished]
+            if missing:
+                # Ring owners can miss keys placed before a membership change;
+                # ask the master's key inventory for the rest.
+                batch.routed = False
+                if self._state == self.State.MASTER:
+                    self.batch_send(batch, self.resolve_batch("mget", [(key, None) for key in missing], routed=False))
+                    return
+                elif self._state == self.State.SLAVE:
                     _message = {
-                        "type": "get_success",
+                        "type": "mget_relayed",
                         "uuid": self.uuid,
-                        "key": message["key"],
-                        "value": self._context.data[message["key"]],
+                        "batch": batch.id,
+                        "keys": missing,
                     }
-                    self.send_message(_message, tuple(message["cli_addr"]))
+                    self.send_message(_message, self._context.master_addr)
+                    batch.pending.add(tuple(self._context.master_addr))
+                    batch.sent[tuple(self._context.master_addr)] = missing
+                    self.batch_wait(batch)
+                    return
+        if batch.parent is not None:
+            _message = {
+                "type": batch.kind + "_reply",
+                "uuid": self.uuid,
+                "batch": batch.parent,
+            }
+        else:
+            _message = {
+                "type": batch.kind + "_success",
+                "uuid": self.uuid,
+                "rid": batch.rid,
+            }
+        _message.update(batch.result())
+        self.when_durable(lambda: self.send_message(_message, batch.cli_addr))
+
+    def batch_send(self, batch, groups):
+        version = self.now()
+        batch.merge(self.apply_batch(batch.kind, groups.pop(None, []), version))
+        for (addr, group) in groups.items():
+            _message = {
+                "type": batch.kind + "_ask",
+                "uuid": self.uuid,
+                "batch": batch.id,
+            }
+            _message.update(self.batch_payload(batch.kind, group, version))
+            self.send_message(_message, addr)
+            batch.pending.add(addr)
+            batch.sent[addr] = [key for (key, _) in group]
+        if batch.pending:
+            self.batch_wait(batch)
+        else:
+            self.batch_done(batch)
+
+    def batch_wait(self, batch):
+        self._batches[batch.id] = batch
+        batch.timer = self.trigger(lambda: self.batch_timeout(batch.id), DHT_BATCH_TIMEOUT)
+
+    def batch_timeout(self, batch_id):
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            return
+        logging.warning("Batch {type} timed out waiting for {count} nodes".format(
+            type=batch.kind, count=len(batch.pending)))
+        # Answer with what arrived and name the keys left over, so the client only retries those.
+        for addr in batch.pending:
+            batch.unfinished.update(batch.sent.get(addr, []))
+            self._silent[addr] = self._loop.time()
+        batch.pending.clear()
+        batch.timer = None
+        self.batch_done(batch)
+
+    def silent(self, addr):
+        since = self._silent.get(tuple(addr))
+        return since is not None and self._loop.time() - since < DHT_SILENT_TIMEOUT.total_seconds()
+
+    def anti_entropy_round(self):
+        now = self.now()
+        expired = [key for (key, version) in self._tombstones.items()
+                   if version < now - DHT_TOMBSTONE_TTL.total_seconds()]
+        for key in expired:
+            del self._tombstones[key]
+            self._sync_index[merkle.key_bucket(key)].discard(key)
+        if not DHT_RING_ROUTING or self._state == self.State.START:
+            return
+        peers = [(uuid, addr) for (uuid, addr) in self._ring.members() if uuid != self.uuid and addr is not None]
+        if not peers:
+            return
+        (uuid, addr) = random.choice(peers)
+        tree = self.sync_tree(uuid)
+        _message = {
+            "type": "sync_tree",
+            "uuid": self.uuid,
+            "level": 0,
+            "nodes": [0],
+            "digests": [tree.root()],
+        }
+        self.send_message(_message, addr)
+        self.sync_stats["rounds"] += 1
+
+    def shares_key(self, key, peer_uuid):
+        replicas = [uuid for (uuid, _) in self.ring_replicas(key)]
+        return self.uuid in replicas and peer_uuid in replicas
+
+    def sync_tree(self, peer_uuid):
+        tree = self._sync_trees.get(peer_uuid)
+        if tree is None:
+            tree = merkle.MerkleTree.build(
+                (key, value) for (key, value) in self._data.items() if self.shares_key(key, peer_uuid))
+            self._sync_trees[peer_uuid] = tree
+        return tree
+
+    def sync_version(self, key):
+        # Newest write wins; a removal beats a put stamped with the same time.
+        if key in self._data:
+            return (self._versions.get(key, 0), 1, merkle.item_hash(key, self._data[key]))
+        elif key in self._tombstones:
+            return (self._tombstones[key], 2, 0)
+        return None
+
+    def supersedes(self, key, version, value=None, removed=False):
+        """Whether a put of value, or a removal, stamped version beats this node's copy of key."""
+        mine = self.sync_version(key)
+        if version is None or mine is None:
+            return True
+        if removed:
+            return (version, 2, 0) > mine
+        return (version, 1, merkle.item_hash(key, value)) > mine
+
+    def on_sync_tree(self, message, addr):
+        if message["uuid"] not in self._ring:
+            return
+        tree = self.sync_tree(message["uuid"])
+        level = message["level"]
+        nodes = tree.diff(level, message["nodes"], message["digests"])
+        if not nodes:
+            if level == 0:
+                self.sync_stats["in_sync"] += 1
+            return
+        if level < tree.depth:
+            children = tree.children(nodes)
+            _message = {
+                "type": "sync_tree",
+                "uuid": self.uuid,
+                "level": level + 1,
+                "nodes": children,
+                "digests": tree.digests(level + 1, children),
+            }
+        else:
+            self.sync_stats["buckets"] += len(nodes)
+            _message = {
+                "type": "sync_keys",
+                "uuid": self.uuid,
+                "buckets": nodes,
+                "entries": [[key] + list(version) for (key, version) in self.sync_entries(tree, nodes, message["uuid"])],
+            }
+        self.send_message(_message, addr)
+
+    def sync_entries(self, tree, buckets, peer_uuid):
+        keys = set()
+        for bucket in buckets:
+            keys.update(self._sync_index.get(bucket, ()))
+        return [(key, self.sync_version(key)) for key in keys
+                if self.sync_version(key) is not None and self.shares_key(key, peer_uuid)]
+
+    def sync_toggle(self, key):
+        # Item digests XOR into the trees, so the same call takes a value out and puts one in.
+        if not self._sync_trees or key not in self._data:
+            return
+        replicas = self.ring_replicas(key)
+        if not any(uuid == self.uuid for (uuid, _) in replicas):
+            return
+        for (uuid, _) in replicas:
+            tree = self._sync_trees.get(uuid)
+            if tree is not None:
+                tree.add(key, self._data[key])
+
+    def on_sync_keys(self, message, addr):
+        if message["uuid"] not in self._ring:
+            return
+        tree = self.sync_tree(message["uuid"])
+        theirs = {key: tuple(version) for (key, *version) in message["entries"]}
+        mine = dict(self.sync_entries(tree, message["buckets"], message["uuid"]))
+        pull = []
+        push = []
+        for key in set(theirs) | set(mine):
+            (their_version, my_version) = (theirs.get(key), mine.get(key))
+            if my_version is None or (their_version is not None and their_version > my_version):
+                if their_version[1] == 1:
+                    pull.append(key)
                 else:
-                    for (uuid, addr) in self._context.peer_list:
-                        if message["key"] in self._context.node_key[uuid]:
-                            _message = {
-                                "type": "get_ask",
-                                "uuid": self.uuid,
-                                "cli_addr": message["cli_addr"],
-                                "key": message["key"],
-                            }
-                            self.send_message(_message, addr)
-                            return
-                    _message = {
-                        "type": "get_success",
-                        "uuid": self.uuid,
-                        "key": message["key"],
-                        "value": None
-                    }
-                    self.send_message(_message, tuple(message["cli_addr"]))
-        elif message["type"] == "get_ask":
-            if self._state == self.State.SLAVE:
-                if message["key"] in self._context.data.keys():
-                    _message = {
-                        "type": "get_success",
-                        "uuid": self.uuid,
-                        "key": message["key"],
-                        "value": self._context.data[message["key"]],
-                    }
-                    self.send_message(_message, tuple(message["cli_addr"]))
-        elif message["type"] == "put":
-            logging.info("Client request: put")
-            if self._state == self.State.SLAVE:
+                    self.remove_local(key, version=their_version[0])
+            elif (their_version is None and my_version[1] == 1) or \
+                    (their_version is not None and my_version > their_version):
+                push.append(key)
+        if pull:
+            _message = {
+                "type": "sync_pull",
+                "uuid": self.uuid,
+                "keys": pull,
+            }
+            self.send_message(_message, addr)
+        if push:
+            self.sync_push(push, addr)
+
+    def on_sync_pull(self, message, addr):
+        self.sync_push(message["keys"], addr)
+
+    def sync_push(self, keys, addr):
+        items = []
+        removed = []
+        for key in keys:
+            if key in self._data:
+                items.append([key, self._data[key], self._versions.get(key, 0)])
+            elif key in self._tombstones:
+                removed.append([key, self._tombstones[key]])
+        _message = {
+            "type": "sync_push",
+            "uuid": self.uuid,
+            "items": items,
+            "removed": removed,
+        }
+        self.send_message(_message, addr)
+        self.sync_stats["pushed"] += len(items) + len(removed)
+
+    def on_sync_push(self, message, addr):
+        for (key, value, version) in message["items"]:
+            mine = self.sync_version(key)
+            if self.shares_key(key, message["uuid"]) and (mine is None or (version, 1, merkle.item_hash(key, value)) > mine):
+                self.store_local(key, value, version=version)
+                self.sync_stats["pulled"] += 1
+        for (key, version) in message["removed"]:
+            mine = self.sync_version(key)
+            if self.shares_key(key, message["uuid"]) and (mine is None or (version, 2, 0) > mine):
+                self.remove_local(key, version=version)
+                self.sync_stats["pulled"] += 1
+
+    def epoch(self):
+        if self._state == self.State.MASTER:
+            return self._context.timestamp
+        elif self._state == self.State.SLAVE:
+            return self._context.master_timestamp
+        return None
+
+    def membership_version(self):
+        # Joins and leaves bump the version within an epoch; clients key their caches on both.
+        if self._state == self.State.START:
+            return None
+        return self._context.version
+
+    def load_leader_cache(self):
+        path = self._leader_cache_path
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+            leader = tuple(cache["leader_addr"]) if cache.get("leader_addr") is not None else None
+            return {"leader_addr": leader, "epoch": cache.get("epoch"),
+                    "peers": [tuple(addr) for addr in cache.get("peers", [])]}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring leader cache {path}: {error}".format(path=path, error=e))
+            return None
+
+    def save_leader_cache(self):
+        path = self._leader_cache_path
+        if path is None:
+            return
+        if self._state == self.State.MASTER:
+            # The master's own address is the one its peers reach it on; it does not know it itself.
+            leader_addr = None
+        else:
+            leader_addr = self._context.master_addr
+        cache = {
+            "leader_uuid": self._context.master_uuid if self._state == self.State.SLAVE else self.uuid,
+            "leader_addr": leader_addr,
+            "epoch": self.epoch(),
+            "peers": [addr for (_, addr) in self._context.peer_list[:DHT_LEADER_CACHE_PEERS]],
+        }
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            # Losing the cache only costs a slower start, so no fsync.
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Cannot write leader cache {path}: {error}".format(path=path, error=e))
+
+    def bootstrap_addrs(self):
+        addrs = []
+        cache = self.load_leader_cache()
+        if cache is not None:
+            if cache["leader_addr"] is not None:
+                addrs.append(cache["leader_addr"])
+            addrs += cache["peers"]
+        addrs += [tuple(addr) for addr in self._seed_addrs]
+        return list(dict.fromkeys(addrs))
+
+    def update_ring(self):
+        if self._state == self.State.MASTER:
+            members = [(self.uuid, None)] + list(self._context.peer_list)
+        elif self._state == self.State.SLAVE:
+            members = [(self._context.master_uuid, self._context.master_addr)] + list(self._context.peer_list)
+        else:
+            members = []
+        self._ring.rebuild([(uuid, tuple(addr) if addr is not None else None) for (uuid, addr) in members])
+        self._sync_trees.clear()
+        self._handoff_scan = True
+        # Suspicions and deaths from an earlier epoch do not carry over into the new membership.
+        self._swim.set_members(self._ring.members(), fresh=self.epoch() != self._swim_epoch)
+        self._swim_epoch = self.epoch()
+        self.set_members([addr for (_, addr) in self._ring.members()])
+
+    def master_add_peer(self, uuid, addr):
+        if not (uuid, addr) in self._context.peer_list:
+            # A known node coming back on a new address replaces its old entry.
+            self._context.peer_list = [(u, a) for (u, a) in self._context.peer_list if u != uuid]
+            self._context.peer_list.append((uuid, addr))
+            self._context.peer_list.sort(reverse=True)
+            self.update_ring()
+            self.start_heartbeat_timer(uuid)
+            self.send_peer_delta("join", uuid, addr)
+            # The newcomer needs the whole list; everyone else just the delta.
+            self.send_membership(addr)
+            self.master_peer_list_updated()
+
+    def master_remove_peer(self, uuid):
+        self._context.peer_list = [(u, a) for (u, a) in self._context.peer_list if u != uuid]
+        timer = self._context.heartbeat_timer.pop(uuid, None)
+        if timer is not None:
+            timer.cancel()
+        self._context.key_index.drop(uuid)
+        self._context.placement.remove(uuid)
+        self._context.node_bytes.pop(uuid, None)
+        inventory = self._context.inventory.pop(uuid, None)
+        if inventory is not None:
+            inventory.cancel()
+        self.update_ring()
+        self.send_peer_delta("leave", uuid, None)
+        self.master_peer_list_updated()
+        self.audit_replication()
+
+    def ring_replicas(self, key):
+        if not DHT_RING_ROUTING or self._state == self.State.START:
+            return []
+        return self._ring.lookup(key, DHT_REPLICATION_FACTOR)
+
+    def owns(self, key):
+        return any(uuid == self.uuid for (uuid, _) in self.ring_replicas(key))
+
+    def get_local(self, key, cli_addr, rid=None):
+        if key not in self._data:
+            return False
+        _message = {
+            "type": "get_success",
+            "uuid": self.uuid,
+            "timestamp": self.epoch(),
+            "version": self.membership_version(),
+            "rid": rid,
+            "key": key,
+            "value": self._data[key],
+        }
+        self.send_message(_message, cli_addr)
+        return True
+
+    def get_missing(self, key, cli_addr, rid=None):
+        _message = {
+            "type": "get_success",
+            "uuid": self.uuid,
+            "timestamp": self.epoch(),
+            "version": self.membership_version(),
+            "rid": rid,
+            "key": key,
+            "value": None
+        }
+        self.send_message(_message, cli_addr)
+
+    def ring_get(self, key, cli_addr, rid=None):
+        replicas = self.ring_replicas(key)
+        if not replicas:
+            return False
+        if any(uuid == self.uuid for (uuid, _) in replicas):
+            if self.get_local(key, cli_addr, rid):
+                return True
+            if key in self._tombstones:
+                self.get_missing(key, cli_addr, rid)
+                return True
+        for (uuid, addr) in replicas:
+            if uuid != self.uuid:
                 _message = {
-                    "type": "put_relayed",
+                    "type": "get_ask",
                     "uuid": self.uuid,
-                    "cli_addr": addr,
-                    "key": message["key"],
-                    "value": message["value"],
+                    "cli_addr": cli_addr,
+                    "rid": rid,
+                    "key": key,
+                    "routed": True,
                 }
-                self.send_message(_message, self._context.master_addr)
-            elif self._state == self.State.MASTER:
-                if not (self.uuid in self._context.data_counter_dict.keys()):
-                    self._context.data_counter_dict[self.uuid] = self._context.data_counter
-                sorted_counter = [(k, self._context.data_counter_dict[k]) for k in sorted(self._context.data_counter_dict, key=self._context.data_counter_dict.get, reverse=False)]
-                if len(sorted_counter) < 3:
-                    self._context.data[message["key"]] = message["value"]
-                    self._context.node_key[self.uuid].append(message["key"])
-                    #self._context.key.append(message["key"])
-                    self._context.data_counter_dict[self.uuid] += 1
-                    self._context.data_counter += 1
-                    tmp = addr
-                    for (uuid, addr) in self._context.peer_list:
-                        _message = {
-                            "type": "put_final",
-                            "uuid": self.uuid,
-                            "cli_addr": tmp,
-                            "key": message["key"],
-                            "value": message["value"],
-                        }
-                        self.send_message(_message, addr)
-                else:
-                    for (uuid, counter) in sorted_counter[:3]:
-                        if uuid == self.uuid:
-                            self._context.data[message["key"]] = message["value"]
-                            self._context.node_key[self.uuid].append(message["key"])
-                            #self._context.key.append(message["key"])
-                            self._context.data_counter_dict[self.uuid] += 1
-                            self._context.data_counter += 1
-                        else:
-                            tmp = addr
-                            for (t_uuid, addr) in self._context.peer_list:
-                                if uuid == t_uuid:
-                                    _message = {
-                                        "type": "put_final",
-                                        "uuid": self.uuid,
-                                        "cli_addr": tmp,
-                                        "key": message["key"],
-                                        "value": message["value"],
-                                    }
-                                    self.send_message(_message, addr)
-        elif message["type"] == "put_relayed":
-            if self._state == self.State.MASTER:
-                if not (self.uuid in self._context.data_counter_dict.keys()):
-                    self._context.data_counter_dict[self.uuid] = self._context.data_counter
-                sorted_counter = [(k, self._context.data_counter_dict[k]) for k in sorted(self._context.data_counter_dict, key=self._context.data_counter_dict.get, reverse=False)]
-                if len(sorted_counter) < 3:
-                    self._context.data[message["key"]] = message["value"]
-                    self._context.node_key[self.uuid].append(message["key"])
-                    #self._context.key.append(message["key"])
-                    self._context.data_counter_dict[self.uuid] += 1
-                    self._context.data_counter += 1
-                    tmp = message["cli_addr"]
-                    for (uuid, addr) in self._context.peer_list:
-                        _message = {
-                            "type": "put_final",
-                            "uuid": self.uuid,
-                            "cli_addr": tmp,
-                            "key": message["key"],
-                            "value": message["value"],
-                        }
-                        self.send_message(_message, addr)
-                else:
-                    for (uuid, counter) in sorted_counter[:3]:
-                        if uuid == self.uuid:
-                            self._context.data[message["key"]] = message["value"]
-                            self._context.node_key[self.uuid].append(message["key"])
-                            #self._context.key.append(message["key"])
-                            self._context.data_counter_dict[self.uuid] += 1
-                            self._context.data_counter += 1
-                        else:
-                            tmp = message["cli_addr"]
-                            for (t_uuid, addr) in self._context.peer_list:
-                                if uuid == t_uuid:
-                                    _message = {
-                                        "type": "put_final",
-                                        "uuid": self.uuid,
-                                        "cli_addr": tmp,
-                                        "key": message["key"],
-                                        "value": message["value"],
-                                    }
-                                    self.send_message(_message, addr)
-        elif message["type"] == "put_final":
-            if self._state == self.State.SLAVE:
-                self._context.data[message["key"]] = message["value"]
-                self._context.key.append(message["key"])
-                self._context.data_counter += 1
+                self.send_message(_message, addr)
+                return True
+        return False
+
+    def ring_put(self, key, value, cli_addr, rid=None):
+        replicas = self.ring_replicas(key)
+        if not replicas:
+            return False
+        version = self.now()
+        write = self.write_begin("put", key, cli_addr, rid, len(replicas))
+        for (uuid, addr) in replicas:
+            if uuid == self.uuid:
+                self.store_local(key, value, version=version)
+                self.when_durable(lambda: self.write_acked(write, self.uuid))
+            else:
                 _message = {
-                    "type": "put_response",
+                    "type": "put_final",
                     "uuid": self.uuid,
-                    "key": message["key"],
+                    "write": write,
+                    "key": key,
+                    "value": value,
+                    "version": version,
                 }
                 self.send_message(_message, addr)
+        return True
 
-        elif message["type"] == "put_response":
-            if self._state == self.State.MASTER:
-                self._context.data_counter_dict[message["uuid"]] += 1
-                self._context.node_key[message["uuid"]].append(message["key"])
-
-        elif message["type"] == "remove":
-            logging.info("Client request: remove")
-            if self._state == self.State.SLAVE:
+    def ring_remove(self, key, cli_addr, rid=None):
+        replicas = self.ring_replicas(key)
+        if not replicas:
+            return False
+        version = self.now()
+        write = self.write_begin("remove", key, cli_addr, rid, len(replicas))
+        for (uuid, addr) in replicas:
+            if uuid == self.uuid:
+                self.remove_local(key, version=version)
+                self.when_durable(lambda: self.write_acked(write, self.uuid))
+            else:
                 _message = {
-                    "type": "remove_relayed",
+                    "type": "remove_ask",
                     "uuid": self.uuid,
-                    "cli_addr": addr,
-                    "key": message["key"],
+                    "write": write,
+                    "key": key,
+                    "version": version,
                 }
-                self.send_message(_message, self._context.master_addr)
-            elif self._state == self.State.MASTER:
-                if message["key"] in self._context.data:
-                    del self._context.data[message["key"]]
-                    self._context.data_counter -= 1
-                    self._context.data_counter_dict[self.uuid] -= 1
-                    self._context.node_key[self.uuid].remove(message["key"])
-                    #self._context.key.remove(message["key"])
-                tmp = addr
-                for (uuid, addr) in self._context.peer_list:
-                    _message = {
-                        "type": "remove_ask",
-                        "uuid": self.uuid,
-                        "cli_addr": tmp,
-                        "key": message["key"],
-                    }
-                    self.send_message(_message, addr)
-        elif message["type"] == "remove_relayed":
-            if self._state == self.State.MASTER:
-                if message["key"] in self._context.data:
-                    del self._context.data[message["key"]]
-                    self._context.data_counter -= 1
-                    self._context.data_counter_dict[self.uuid] -= 1
-                    self._context.node_key[self.uuid].remove(message["key"])
-                    #self._context.key.remove(message["key"])
-                for (uuid, addr) in self._context.peer_list:
-                    _message = {
-                        "type": "remove_ask",
-                        "uuid": self.uuid,
-                        "cli_addr": message["cli_addr"],
-                        "key": message["key"],
-                    }
-                    self.send_message(_message, addr)
-        elif message["type"] == "remove_ask":
-            if self._state == self.State.SLAVE:
-                if message["key"] in self._context.data:
-                    del self._context.data[message["key"]]
-                    self._context.data_counter -= 1
-                    self._context.key.remove(message["key"])
-                    _message = {
-                        "type": "remove_response",
-                        "uuid": self.uuid,
-                        "cli_addr": message["cli_addr"],
-                        "key": message["key"],
-                    }
-                    self.send_message(_message, addr)
-        elif message["type"] == "remove_response":
+                self.send_message(_message, addr)
+        return True
+
+    def when_durable(self, callback):
+        if self._storage is None:
+            callback()
+        else:
+            self._storage.after_sync(callback)
+
+    def write_begin(self, kind, key, cli_addr, rid, replicas):
+        """Track a client write so the client gets one answer once enough replicas have acked it."""
+        if rid is None or cli_addr is None:
+            return None
+        quorum = DHT_WRITE_QUORUM if DHT_WRITE_QUORUM is not None else replicas // 2 + 1
+        self._next_write = (self._next_write + 1) & 0x7FFFFFFF
+        write = self.Write(self._next_write, kind, key, tuple(cli_addr), rid, min(quorum, replicas))
+        write.timer = self.trigger(lambda: self.write_timeout(write.id), DHT_BATCH_TIMEOUT)
+        self._writes[write.id] = write
+        return write.id
+
+    def write_acked(self, write_id, uuid):
+        write = self._writes.get(write_id)
+        if write is None:
+            return
+        write.acked.add(uuid)
+        if len(write.acked) < write.quorum:
+            return
+        write.timer.cancel()
+        del self._writes[write_id]
+        _message = {
+            "type": write.kind + "_success",
+            "uuid": self.uuid,
+            "timestamp": self.epoch(),
+            "version": self.membership_version(),
+            "rid": write.rid,
+            "key": write.key,
+        }
+        self.send_message(_message, write.cli_addr)
+
+    def write_timeout(self, write_id):
+        write = self._writes.pop(write_id, None)
+        if write is not None:
+            # No answer: the client retries the write with a newer version.
+            logging.warning("Write {type} timed out with {acked} of {quorum} acks".format(
+                type=write.kind, acked=len(write.acked), quorum=write.quorum))
+
+    def store_local(self, key, value, notify=True, version=None):
+        is_new = key not in self._data
+        version = version if version is not None else self.now()
+        if not is_new:
+            self._data_bytes -= item_size(key, self._data[key])
+            self.sync_toggle(key)
+        self._data_bytes += item_size(key, value)
+        if self._storage is not None:
+            self._storage.put(key, value, version)
+        self._data[key] = value
+        self._versions[key] = version
+        self._tombstones.pop(key, None)
+        self._sync_index[merkle.key_bucket(key)].add(key)
+        self.sync_toggle(key)
+        if DHT_RING_ROUTING and len(self._ring) > 0 and not self.owns(key):
+            self._handoff.setdefault(key, set())
+        if self._state == self.State.MASTER:
+            if is_new:
+                self._context.key_index.add(self.uuid, key)
+                self._context.placement.adjust(self.uuid, 1)
+        elif self._state == self.State.SLAVE and notify:
+            _message = {
+                "type": "put_response",
+                "uuid": self.uuid,
+                "key": key,
+                "bytes": self._data_bytes,
+            }
+            self.send_message(_message, self._context.master_addr)
+
+    def remove_local(self, key, notify=True, version=None):
+        removed = key in self._data
+        version = version if version is not None else self.now()
+        if removed:
+            self.sync_toggle(key)
+            self._data_bytes -= item_size(key, self._data[key])
+        if self._storage is not None:
+            # Tombstones are logged too, so a restarted node does not push removed keys back.
+            self._storage.remove(key, version)
+        self._data.pop(key, None)
+        self._versions.pop(key, None)
+        self._tombstones[key] = version
+        self._sync_index[merkle.key_bucket(key)].add(key)
+        if removed:
             if self._state == self.State.MASTER:
-                self._context.data_counter_dict[message["uuid"]] -= 1
-                self._context.node_key[message["uuid"]].remove(message["key"])
-        elif message["type"] == "stat":
-            if self._state == self.State.SLAVE:
+                self._context.placement.adjust(self.uuid, -1)
+                self._context.key_index.discard(self.uuid, key)
+            elif self._state == self.State.SLAVE and notify:
                 _message = {
-                    "type": "stat_relay",
+                    "type": "remove_response",
                     "uuid": self.uuid,
-                    "cli_addr": addr,
+                    "key": key,
+                    "bytes": self._data_bytes,
                 }
                 self.send_message(_message, self._context.master_addr)
-            elif self._state == self.State.MASTER:
+        return removed
+
+    def master_put(self, key, value, cli_addr, rid=None):
+        replicas = self._context.placement.pick(DHT_REPLICATION_FACTOR)
+        if len(replicas) < DHT_REPLICATION_FACTOR:
+            # Not enough nodes have reported their load yet: replicate everywhere.
+            replicas = [(self.uuid, None)] + list(self._context.peer_list)
+        version = self.now()
+        write = self.write_begin("put", key, cli_addr, rid, len(replicas))
+        for (uuid, addr) in replicas:
+            if uuid == self.uuid:
+                self.store_local(key, value, version=version)
+                self.when_durable(lambda: self.write_acked(write, self.uuid))
+            else:
                 _message = {
-                    "type": "stat_success",
+                    "type": "put_final",
                     "uuid": self.uuid,
-                    "node_key": self._context.node_key,
+                    "write": write,
+                    "key": key,
+                    "value": value,
+                    "version": version,
                 }
                 self.send_message(_message, addr)
-        elif message["type"] == "stat_relay":
-            if self._state == self.State.MASTER:
+
+    def master_remove(self, key, cli_addr, rid=None):
+        version = self.now()
+        write = self.write_begin("remove", key, cli_addr, rid, 1 + len(self._context.peer_list))
+        self.remove_local(key, version=version)
+        self.when_durable(lambda: self.write_acked(write, self.uuid))
+        for (uuid, addr) in self._context.peer_list:
+            _message = {
+                "type": "remove_ask",
+                "uuid": self.uuid,
+                "write": write,
+                "key": key,
+                "version": version,
+            }
+            self.send_message(_message, addr)
+
+    def master_get(self, key, cli_addr, rid=None):
+        owners = {uuid for (uuid, _) in self.ring_replicas(key)}
+        if (not owners or self.uuid in owners) and self.get_local(key, cli_addr, rid):
+            return
+        # Owners first: other holders are former owners whose copies await handoff.
+        for uuid in sorted(self._context.key_index.replicas(key), key=lambda uuid: uuid not in owners):
+            if uuid == self.uuid:
+                continue
+            addr = self._ring.addr(uuid)
+            if addr is not None:
                 _message = {
-                    "type": "stat_success",
+                    "type": "get_ask",
                     "uuid": self.uuid,
-                    "node_key": self._context.node_key,
+                    "cli_addr": cli_addr,
+                    "rid": rid,
+                    "key": key,
                 }
-                self.send_message(_message, tuple(message["cli_addr"]))
+                self.send_message(_message, addr)
+                return
+        if self.get_local(key, cli_addr, rid):
+            return
+        self.get_missing(key, cli_addr, rid)
+
+    def schedule_rereplication(self, dead_uuid):
+        key_index = self._context.key_index
+        queue = self._context.rereplication
+        for key in key_index.keys(dead_uuid):
+            holders = [uuid for uuid in key_index.replicas(key) if uuid != dead_uuid]
+            if not holders:
+                self.rereplication_stats["lost"] += 1
+                continue
+            queue[key] = holders
+            self.rereplication_stats["scheduled"] += 1
+        # A key queued earlier may have lost another holder since.
+        for (key, holders) in queue.items():
+            if dead_uuid in holders:
+                holders.remove(dead_uuid)
+        self.rereplication_stats["pending"] = len(queue)
+        logging.info("Node {uuid} is gone, {count} keys to re-replicate".format(uuid=dead_uuid, count=len(queue)))
+
+    def audit_replication(self):
+        # A new master inherits no re-replication queue: once every peer's inventory is in,
+        # queue whatever is short of copies, e.g. the keys the old master itself held.
+        context = self._context
+        if context.audited or context.inventory or \
+                any(uuid not in context.reported for (uuid, _) in context.peer_list):
+            return
+        context.audited = True
+        key_index = context.key_index
+        want = min(DHT_REPLICATION_FACTOR, len(context.peer_list) + 1)
+        count = 0
+        for key in key_index.keys_all():
+            holders = key_index.replicas(key)
+            if len(holders) < want and key not in context.rereplication:
+                context.rereplication[key] = list(holders)
+                count += 1
+        self.rereplication_stats["scheduled"] += count
+        self.rereplication_stats["pending"] = len(context.rereplication)
+        logging.info("Replication audit: {count} keys below {want} copies".format(count=count, want=want))
+
+    def rereplication_targets(self, key, holders):
+        need = DHT_REPLICATION_FACTOR - len(holders)
+        if need <= 0:
+            return []
+        if DHT_RING_ROUTING and len(self._ring) > 0:
+            candidates = self.ring_replicas(key)
+        else:
+            candidates = self._context.placement.pick(DHT_REPLICATION_FACTOR + len(holders))
+        return [(uuid, addr) for (uuid, addr) in candidates if uuid not in holders][:need]
+
+    def rereplicate_step(self):
+        queue = self._context.rereplication
+        if not queue:
+            return
+        orders = {}
+        for _ in range(min(DHT_REREPLICATION_BATCH, len(queue))):
+            (key, holders) = queue.popitem(last=False)
+            holders = [uuid for uuid in holders if uuid == self.uuid or uuid in self._ring]
+            if not holders:
+                self.rereplication_stats["lost"] += 1
+                continue
+            targets = self.rereplication_targets(key, holders)
+            if not targets:
+                continue
+            remote = [uuid for uuid in holders if uuid != self.uuid]
+            if self.uuid in holders and key in self._data:
+                for (_, addr) in targets:
+                    self.copy_key(key, addr)
+            elif remote:
+                orders.setdefault(remote[0], []).append([key, [addr for (_, addr) in targets]])
+            else:
+                self.rereplication_stats["lost"] += 1
+                continue
+            self.rereplication_stats["copied"] += len(targets)
+        for (uuid, items) in orders.items():
+            _message = {
+                "type": "replicate",
+                "uuid": self.uuid,
+                "items": items,
+            }
+            self.send_message(_message, self._ring.addr(uuid))
+        self.rereplication_stats["pending"] = len(queue)
+        if not queue:
+            logging.info("Re-replication finished: {stats}".format(stats=self.rereplication_stats))
+
+    def copy_key(self, key, addr):
+        _message = {
+            "type": "put_final",
+            "uuid": self.uuid,
+            "key": key,
+            "value": self._data[key],
+            "version": self._versions.get(key),
+        }
+        self.send_message(_message, addr)
+
+    def slave_on_replicate(self, message, addr):
+        for (key, targets) in message["items"]:
+            if key in self._data:
+                for target in targets:
+                    # The master has no address of its own in its member list.
+                    self.copy_key(key, tuple(target) if target is not None else self._context.master_addr)
+
+    def handoff_step(self):
+        if not DHT_RING_ROUTING or self._state == self.State.START or len(self._ring) == 0:
+            return
+        if self._handoff_scan:
+            self._handoff_scan = False
+            for key in self._data:
+                if key not in self._handoff and not self.owns(key):
+                    self._handoff[key] = set()
+        orders = {}
+        for _ in range(min(DHT_HANDOFF_BATCH, len(self._handoff))):
+            (key, acked) = self._handoff.popitem(last=False)
+            if key not in self._data or self.owns(key):
+                continue
+            # Resent every pass until all owners have acknowledged it.
+            self._handoff[key] = acked
+            for (uuid, addr) in self.ring_replicas(key):
+                if uuid not in acked:
+                    orders.setdefault(tuple(addr), []).append([key, self._data[key], self._versions.get(key, 0)])
+        for (addr, items) in orders.items():
+            _message = {
+                "type": "handoff",
+                "uuid": self.uuid,
+                "items": items,
+            }
+            self.send_message(_message, addr)
+            self.handoff_stats["sent"] += len(items)
+        self.handoff_stats["pending"] = len(self._handoff)
+
+    def on_handoff(self, message, addr):
+        stored = []
+        acked = []
+        for (key, value, version) in message["items"]:
+            mine = self.sync_version(key)
+            if mine is None or (version, 1, merkle.item_hash(key, value)) > mine:
+                self.store_local(key, value, notify=False, version=version)
+                stored.append(key)
+            # A newer value or removal here supersedes the handed-off copy, so it is acknowledged too.
+            acked.append([key, version])
+        if stored and self._state == self.State.SLAVE:
+            _message = {
+                "type": "put_response",
+                "uuid": self.uuid,
+                "keys": stored,
+                "bytes": self._data_bytes,
+            }
+            self.send_message(_message, self._context.master_addr)
+        _message = {
+            "type": "handoff_ack",
+            "uuid": self.uuid,
+            "items": acked,
+        }
+        self.when_durable(lambda: self.send_message(_message, addr))
+
+    def on_handoff_ack(self, message, addr):
+        dropped = []
+        for (key, version) in message["items"]:
+            acked = self._handoff.get(key)
+            if acked is None or key not in self._data or self._versions.get(key, 0) != version:
+                continue
+            acked.add(message["uuid"])
+            replicas = self.ring_replicas(key)
+            if any(uuid == self.uuid for (uuid, _) in replicas):
+                del self._handoff[key]
+            elif all(uuid in acked for (uuid, _) in replicas):
+                del self._handoff[key]
+                self.drop_local(key)
+                dropped.append(key)
+        self.handoff_stats["dropped"] += len(dropped)
+        self.handoff_stats["pending"] = len(self._handoff)
+        if dropped and self._state == self.State.SLAVE:
+            _message = {
+                "type": "remove_response",
+                "uuid": self.uuid,
+                "keys": dropped,
+                "bytes": self._data_bytes,
+            }
+            self.send_message(_message, self._context.master_addr)
+
+    def drop_local(self, key):
+        # Unlike remove_local this leaves no tombstone: the key lives on at its owners.
+        self.sync_toggle(key)
+        self._data_bytes -= item_size(key, self._data[key])
+        if self._storage is not None:
+            self._storage.remove(key)
+        self._data.pop(key, None)
+        self._versions.pop(key, None)
+        self._sync_index[merkle.key_bucket(key)].discard(key)
+        if self._state == self.State.MASTER:
+            self._context.placement.adjust(self.uuid, -1)
+            self._context.key_index.discard(self.uuid, key)
+
+    def swim_message(self, message_type, seq, **fields):
+        message = {
+            "type": message_type,
+            "uuid": self.uuid,
+            "seq": seq,
+            "gossip": self._swim.gossip(),
+            "incarnation": self._swim.incarnation,
+        }
+        if self._state == self.State.MASTER:
+            # Slaves that missed a peer_delta catch up from the probe traffic.
+            message["timestamp"] = self._context.timestamp
+            message["version"] = self._context.version
+        message.update(fields)
+        return message
+
+    def swim_round(self):
+        if self._state == self.State.START:
+            return
+        for uuid in self._swim.expire():
+            self.swim_member_dead(uuid)
+        member = self._swim.next_target()
+        if member is None:
+            return
+        self._swim_seq = (self._swim_seq + 1) & 0x7FFFFFFF
+        seq = self._swim_seq
+        self._swim_probes[seq] = self.trigger(lambda: self.swim_probe_timeout(seq, member), DHT_SWIM_PROBE_TIMEOUT)
+        self.send_message(self.swim_message("swim_ping", seq), member.addr)
+
+    def swim_probe_timeout(self, seq, member):
+        if seq not in self._swim_probes:
+            return
+        helpers = self._swim.helpers(member.uuid, DHT_SWIM_INDIRECT_PROBES)
+        for helper in helpers:
+            message = self.swim_message("swim_ping_req", seq, peer_uuid=member.uuid, peer_addr=member.addr)
+            self.send_message(message, helper.addr)
+        # Whatever is left of the period is the indirect probes' deadline.
+        remaining = max(DHT_SWIM_PERIOD - DHT_SWIM_PROBE_TIMEOUT, DHT_SWIM_PROBE_TIMEOUT)
+        self._swim_probes[seq] = self.trigger(lambda: self.swim_probe_failed(seq, member), remaining)
+
+    def swim_probe_failed(self, seq, member):
+        if self._swim_probes.pop(seq, None) is not None and self._swim.suspect(member.uuid):
+            logging.info("Suspecting {uuid}".format(uuid=member.uuid))
+
+    def swim_receive(self, message):
+        for uuid in self._swim.apply(message.get("gossip", [])):
+            self.swim_member_dead(uuid)
+        if self._state == self.State.SLAVE and message["uuid"] == self._context.master_uuid and \
+                message.get("timestamp") == self._context.master_timestamp and \
+                "version" in message and (self._context.version is None or message["version"] > self._context.version):
+            self.request_membership_sync()
+
+    def swim_member_dead(self, uuid):
+        logging.info("Member {uuid} is dead".format(uuid=uuid))
+        if self._state == self.State.MASTER:
+            asyncio.ensure_future(self.master_heartbeat_timeout(uuid), loop=self._loop)
+        elif self._state == self.State.SLAVE and uuid == self._context.master_uuid:
+            asyncio.ensure_future(self.slave_heartbeat_timeout(), loop=self._loop)
+
+    def on_swim_ping(self, message, addr):
+        self.swim_receive(message)
+        self.send_message(self.swim_message("swim_ack", message["seq"]), addr)
+
+    def on_swim_ping_req(self, message, addr):
+        self.swim_receive(message)
+        self._swim_seq = (self._swim_seq + 1) & 0x7FFFFFFF
+        seq = self._swim_seq
+        self._swim_relays[seq] = (addr, message["seq"])
+        self.trigger(lambda: self._swim_relays.pop(seq, None), DHT_SWIM_PERIOD)
+        self.send_message(self.swim_message("swim_ping", seq), tuple(message["peer_addr"]))
+
+    def on_swim_ack(self, message, addr):
+        self.swim_receive(message)
+        probe = self._swim_probes.pop(message["seq"], None)
+        if probe is not None:
+            probe.cancel()
+            return
+        relay = self._swim_relays.pop(message["seq"], None)
+        if relay is not None:
+            (requester, seq) = relay
+            self.send_message(self.swim_message("swim_ack", seq), requester)
 
     def master_peer_list_updated(self):
         logging.info("Peer list updated: I'm MASTER with {peers} peers".format(peers=len(self._context.peer_list)))
@@ -426,8 +1743,10 @@ class DHT(network.Network, timer.Timer):
             master=str((self._context.master_uuid, self._context.master_addr)), peers=len(self._context.peer_list)))
         for (uuid, addr) in self._context.peer_list:
             logging.info("Peer list updated: PEER[{peer}]".format(peer=str((uuid,addr))))
+        self.slave_check_listed()
 
     async def slave_heartbeat_timeout(self):
+        self._elections.inc()
         message = {
             "type": "new_leader_election",
             "uuid": self.uuid,
@@ -450,17 +1769,23 @@ class DHT(network.Network, timer.Timer):
             if uuid == client_uuid:
                 client = (uuid, addr)
                 self.send_message(message, addr)
-        self._context.peer_list.remove(client)
-        self.update_peer_list()
-        self.master_peer_list_updated()
+        if client is None:
+            return
+        self._peers_lost.inc()
+        # Take the dead node's keys before its inventory is dropped.
+        self.schedule_rereplication(client_uuid)
+        self.master_remove_peer(client_uuid)
 
     class StartContext:
         def __init__(self):
+            self.seed_job = None
             self.hello_job = None
             self.timeout_job = None
             self.messages = []
 
         def cancel(self):
+            if self.seed_job is not None:
+                self.seed_job.cancel()
             if self.hello_job is not None:
                 self.hello_job.cancel()
             if self.timeout_job is not None:
@@ -473,66 +1798,166 @@ class DHT(network.Network, timer.Timer):
             self.timestamp = time.time()
             self.heartbeat_send_job = None
             self.heartbeat_timer = {}
-            self.data_counter_dict = {}
-            self.data_counter = 0
-            self.data = {}
-            self.node_key = {}
-            self.key = []
+            self.placement = placement.Placement(DHT_PLACEMENT_POLICY)
+            self.key_index = index.KeyIndex()
+            self.version = 0
+            self.inventory = {}
+            self.rereplication = collections.OrderedDict()
+            self.rereplication_job = None
+            self.announce_job = None
+            self.node_bytes = {}
+            # Peers whose data_counter_and_keys has arrived; the audit waits for all of them.
+            self.reported = set()
+            self.audited = False
 
         def cancel(self):
             if self.heartbeat_send_job is not None:
                 self.heartbeat_send_job.cancel()
             for (_, timer) in self.heartbeat_timer.items():
                 timer.cancel()
+            if self.rereplication_job is not None:
+                self.rereplication_job.cancel()
+            if self.announce_job is not None:
+                self.announce_job.cancel()
+            for (_, inventory) in self.inventory.items():
+                inventory.cancel()
             pass
 
     class SlaveContext:
         def __init__(self):
             self.peer_list = []
             self.peer_index = {}
+            self.peer_index_version = None
+            self.peer_index_count = 0
             self.peer_count = 0
+            self.version = None
+            self.inventory_pages = None
             self.master_addr = None
             self.master_uuid = None
             self.master_timestamp = None
             self.heartbeat_send_job = None
             self.heartbeat_timer = None
-            self.data_counter = 0
-            self.data = {}
-            self.key = []
+            self.peer_list_timer = None
 
         def cancel(self):
             if self.heartbeat_send_job is not None:
                 self.heartbeat_send_job.cancel()
             if self.heartbeat_timer is not None:
                 self.heartbeat_timer.cancel()
+            if self.peer_list_timer is not None:
+                self.peer_list_timer.cancel()
             pass
 
+    class Inventory:
+        def __init__(self, uuid, addr, pages):
+            self.uuid = uuid
+            self.addr = addr
+            self.pages = pages
+            self.next_page = 0
+            self.requested = set()
+            self.received = set()
+            self.stale = {}
+            self.timer = None
+            self.retries = 0
+
+        def cancel(self):
+            if self.timer is not None:
+                self.timer.cancel()
+
+    class Write:
+        def __init__(self, write_id, kind, key, cli_addr, rid, quorum):
+            self.id = write_id
+            self.kind = kind
+            self.key = key
+            self.cli_addr = cli_addr
+            self.rid = rid
+            self.quorum = quorum
+            self.acked = set()
+            self.timer = None
+
+    class Batch:
+        def __init__(self, batch_id, kind, keys, cli_addr, rid, routed, parent):
+            self.id = batch_id
+            self.kind = kind
+            self.keys = keys
+            self.cli_addr = cli_addr
+            self.rid = rid
+            self.routed = routed
+            self.parent = parent
+            self.pending = set()
+            # Node address -> keys asked of it, and keys whose nodes did not answer in time.
+            self.sent = {}
+            self.unfinished = set()
+            self.timer = None
+            self.values = {}
+            self.done = set()
+
+        def merge(self, result):
+            self.unfinished.update(result.get("pending", []))
+            if self.kind == "mget":
+                for (key, value) in result.get("items", []):
+                    self.values[key] = value
+                # Keys an owner has removed: the key index fallback must not revive them.
+                self.done.update(result.get("removed", []))
+            else:
+                self.done.update(result.get("stored" if self.kind == "mput" else "removed", []))
+
+        def result(self):
+            if self.kind == "mget":
+                if self.parent is not None:
+                    result = {"items": [[key, value] for (key, value) in self.values.items()]}
+                else:
+                    result = {"values": [self.values.get(key) for key in self.keys]}
+            elif self.kind == "mput":
+                result = {"stored": [key for key in self.keys if key in self.done]}
+            else:
+                result = {"removed": [key for key in self.keys if key in self.done]}
+            pending = [key for key in self.keys
+                       if key in self.unfinished and key not in self.done and key not in self.values]
+            if pending:
+                result["pending"] = pending
+            return result
+
     async def master(self):
+        if self._context.rereplication_job is not None:
+            return
+        self._metrics.counter("dht_role_changes_total", "Role changes", {"role": "master"}).inc()
         async def heartbeat_send():
             for (_, addr) in self._context.peer_list:
                 message = {
                     "type": "heartbeat_ping",
                     "uuid": self.uuid,
-                    "timestamp": time.time(),
+                    "timestamp": self.now(),
                 }
                 self.send_message(message, addr)
-        self._context.heartbeat_send_job = self.async_period(heartbeat_send, _SHORT)
+        if self._failure_detector == "heartbeat":
+            self._context.heartbeat_send_job = self.async_period(heartbeat_send, _SHORT)
+        self._context.rereplication_job = self.period(self.rereplicate_step, DHT_REREPLICATION_INTERVAL)
+        self._context.announce_job = self.period(
+            lambda: self.announce_leader((network.NETWORK_BROADCAST_ADDR, network.NETWORK_PORT)),
+            DHT_LEADER_ANNOUNCE_INTERVAL)
         pass
 
     async def slave(self):
+        # Two quick leader_is_here messages schedule slave() twice for the same context.
+        if self._context.heartbeat_send_job is not None or self._context.heartbeat_timer is not None:
+            return
+        self._metrics.counter("dht_role_changes_total", "Role changes", {"role": "slave"}).inc()
         async def heartbeat_send():
             message = {
                 "type": "heartbeat_ping",
                 "uuid": self.uuid,
-                "timestamp": time.time(),
+                "timestamp": self.now(),
             }
             self.send_message(message, self._context.master_addr)
 
-        self._context.heartbeat_timer = self.async_trigger(self.slave_heartbeat_timeout, _TIMER_LONG)
-        self._context.heartbeat_send_job = self.async_period(heartbeat_send, _SHORT)
+        if self._failure_detector == "heartbeat":
+            self._context.heartbeat_timer = self.async_trigger(self.slave_heartbeat_timeout, _TIMER_LONG)
+            self._context.heartbeat_send_job = self.async_period(heartbeat_send, _SHORT)
         pass
 
     async def start(self):
+        self._metrics.counter("dht_role_changes_total", "Role changes", {"role": "start"}).inc()
         self._context = self.StartContext()
         async def hello():
             message = {
@@ -571,32 +1996,102 @@ class DHT(network.Network, timer.Timer):
                     logging.info("I am the leader of {peers} peers".format(peers=len(sorted_list)))
                 else:
                     #I am the slave
-                    self._context.cancel()
-                    self._context = self.SlaveContext()
-                    self._state = self.State.SLAVE
-                    self._context.master_addr = max_addr
-                    self._context.master_uuid = max_val
-                    self._context.master_timestamp = -1
-                    #asyncio.ensure_future(self.slave(), loop=self._loop)
+                    # The master's epoch comes with its leader_is_here or, if that is lost, its peer list.
+                    self.slave_attach(max_val, max_addr, -1)
                     logging.info("I am the slave of MASTER {master_addr}.".format(master_addr=max_addr))
 
             if self._state == self.State.MASTER:
                 self.update_peer_list()
                 self.master_peer_list_updated()
 
-        self._context.hello_job = self.async_period(hello, _SHORT)
-        self._context.timeout_job = self.async_trigger(timeout, _LONG)
+        async def seed_hello():
+            message = {
+                "type": "hello",
+                "uuid": self.uuid,
+                "direct": True,
+            }
+            for addr in seeds:
+                self.send_message(message, addr)
+
+        async def elect():
+            self._context.seed_job.cancel()
+            logging.info("No seed answered; falling back to the broadcast election.")
+            self._context.hello_job = self.async_period(hello, _SHORT)
+            self._context.timeout_job = self.async_trigger(timeout, _LONG)
+
+        seeds = self.bootstrap_addrs()
+        if seeds:
+            # Any member that hears a direct hello relays it to the master, which answers
+            # with leader_is_here and ends the start state before the election begins.
+            logging.info("Contacting {count} seed nodes".format(count=len(seeds)))
+            self._context.seed_job = self.async_period(seed_hello, DHT_SEED_TIMEOUT / DHT_SEED_ATTEMPTS,
+                                                       DHT_SEED_ATTEMPTS)
+            self._context.timeout_job = self.async_trigger(elect, DHT_SEED_TIMEOUT)
+        else:
+            self._context.hello_job = self.async_period(hello, _SHORT)
+            self._context.timeout_job = self.async_trigger(timeout, _LONG)
 
         pass
 
-    def __init__(self, loop):
-        network.Network.__init__(self, loop)
+    def __init__(self, loop, local_addr=None, transport=None, node_id=None, storage_path=None,
+                 leader_cache_path=None, broadcast_mode=None, failure_detector=None, seed_addrs=None):
+        import uuid
+        self.uuid = node_id if node_id is not None else str(uuid.uuid1())
+        self._failure_detector = failure_detector if failure_detector is not None else DHT_FAILURE_DETECTOR
+        # Read when the node starts, so the caller may still fill it in until the loop runs.
+        self._seed_addrs = seed_addrs if seed_addrs is not None else DHT_SEED_ADDRS
+        # Peers may already be sending to this address while the socket is bound below.
+        self._dispatcher = None
+        network.Network.__init__(self, loop, local_addr, transport, broadcast_mode)
         timer.Timer.__init__(self, loop)
         self._state = self.State.START
         self._loop = loop
         self._context = None
+        self._ring = ring.HashRing()
+        self._dispatcher = dispatch.Dispatcher(self._metrics)
+        self._batches = {}
+        self._next_batch = 0
+        self._writes = {}
+        # Batch peers that did not answer in time -> when.
+        self._silent = {}
+        self._next_write = 0
+        if storage_path is None and DHT_STORAGE_PATH is not None:
+            # Nodes sharing a process or a directory must not share a log.
+            storage_path = os.path.join(DHT_STORAGE_PATH, self.uuid)
+        if leader_cache_path is None and storage_path is not None:
+            leader_cache_path = os.path.join(storage_path, DHT_LEADER_CACHE_FILE)
+        self._leader_cache_path = leader_cache_path
+        self._storage = storage.Storage(storage_path, loop) if storage_path is not None else None
+        # The key/value store belongs to the node, not to its current role.
+        self._data = self._storage.data if self._storage is not None else {}
+        self._data_bytes = sum(item_size(key, value) for (key, value) in self._data.items())
+        # Write versions and removal tombstones drive anti-entropy and are logged with the data.
+        self._versions = self._storage.versions if self._storage is not None else {}
+        self._tombstones = self._storage.tombstones if self._storage is not None else {}
+        self._sync_trees = {}
+        # Merkle leaf bucket -> keys with a value or tombstone, so sync_keys only looks at its buckets.
+        self._sync_index = collections.defaultdict(set)
+        for key in list(self._data) + list(self._tombstones):
+            self._sync_index[merkle.key_bucket(key)].add(key)
+        self.sync_stats = {"rounds": 0, "in_sync": 0, "buckets": 0, "pulled": 0, "pushed": 0}
+        self.rereplication_stats = {"scheduled": 0, "copied": 0, "lost": 0, "pending": 0}
+        # Keys waiting to move to their ring owners -> owners that have acknowledged them.
+        self._handoff = collections.OrderedDict()
+        self._handoff_scan = False
+        self.handoff_stats = {"sent": 0, "dropped": 0, "pending": 0}
+        self.register_handlers()
+        self.register_metrics()
 
-        import uuid
-        self.uuid = str(uuid.uuid1())
+        self._swim = swim.Swim(self.uuid, clock=self._loop.time)
+        self._swim_seq = 0
+        self._swim_probes = {}
+        self._swim_relays = {}
+        self._swim_epoch = None
 
         asyncio.ensure_future(self.start(), loop=self._loop)
+        if self._metrics.enabled and metrics.METRICS_HTTP_PORT is not None:
+            asyncio.ensure_future(metrics.serve(self._metrics, port=metrics.METRICS_HTTP_PORT), loop=self._loop)
+        self.period(self.anti_entropy_round, DHT_ANTI_ENTROPY_INTERVAL)
+        self.period(self.handoff_step, DHT_HANDOFF_INTERVAL)
+        if self._failure_detector == "swim":
+            self.period(self.swim_round, DHT_SWIM_PERIOD)
@@ -0,0 +1,61 @@
+import logging
+import time
+
+import metrics
+
+
+class Dispatcher:
+    class Stats:
+        __slots__ = ("handled", "dropped", "seconds", "latency", "dropped_metric")
+
+        def __init__(self, registry, message_type):
+            self.handled = 0
+            self.dropped = 0
+            self.seconds = 0.0
+            labels = {"type": message_type}
+            self.latency = registry.histogram("dht_handler_seconds", "Time spent in message handlers", labels)
+            self.dropped_metric = registry.counter(
+                "dht_messages_dropped_total", "Messages with no handler in the current state", labels)
+
+    def __init__(self, registry=None):
+        self._handlers = {}
+        self._registry = registry if registry is not None else metrics.Registry(enabled=False)
+        self.stats = {}
+        self.unknown = 0
+        self._unknown_metric = self._registry.counter("dht_messages_unknown_total", "Messages of unknown type")
+
+    def register(self, message_type, states, handler):
+        for state in states:
+            self._handlers[(message_type, state)] = handler
+        if message_type not in self.stats:
+            self.stats[message_type] = self.Stats(self._registry, message_type)
+
+    def dispatch(self, message, addr, state):
+        message_type = message.get("type")
+        handler = self._handlers.get((message_type, state))
+        if handler is None:
+            stats = self.stats.get(message_type)
+            if stats is None:
+                self.unknown += 1
+                self._unknown_metric.inc()
+                logging.debug("Unknown message type {type}".format(type=message_type))
+            else:
+                stats.dropped += 1
+                stats.dropped_metric.inc()
+            return False
+        stats = self.stats[message_type]
+        begin = time.perf_counter()
+        try:
+            handler(message, addr)
+        finally:
+            elapsed = time.perf_counter() - begin
+            stats.handled += 1
+            stats.seconds += elapsed
+            stats.latency.observe(elapsed)
+        return True
+
+    def report(self):
+        return {
+            message_type: {"handled": stats.handled, "dropped": stats.dropped, "seconds": stats.seconds}
+            for (message_type, stats) in self.stats.items()
+        }
@@ -0,0 +1,90 @@
+import collections
+import logging
+import struct
+import time
+
+FRAGMENT_MAGIC_VALUE = b"\xd4\x7c"
+
+_HEADER = struct.Struct("!2sQHH")
+
+
+def is_fragment(data):
+    return data[:len(FRAGMENT_MAGIC_VALUE)] == FRAGMENT_MAGIC_VALUE
+
+
+def split(data, message_id, mtu):
+    size = mtu - _HEADER.size
+    count = (len(data) + size - 1) // size
+    if count > 0xFFFF:
+        raise ValueError("Message needs {count} fragments".format(count=count))
+    return [_HEADER.pack(FRAGMENT_MAGIC_VALUE, message_id, i, count) + data[i * size:(i + 1) * size]
+            for i in range(count)]
+
+
+class Reassembler:
+    class Entry:
+        def __init__(self, count, deadline):
+            self.count = count
+            self.deadline = deadline
+            self.chunks = {}
+            self.size = 0
+
+    def __init__(self, max_messages, max_bytes, timeout, clock=time.monotonic):
+        self._max_messages = max_messages
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, data, addr):
+        if len(data) < _HEADER.size:
+            logging.warning("Truncated fragment from {addr}".format(addr=addr))
+            return None
+        (_, message_id, index, count) = _HEADER.unpack_from(data, 0)
+        if count == 0 or index >= count:
+            logging.warning("Invalid fragment {index}/{count} from {addr}".format(index=index, count=count, addr=addr))
+            return None
+        now = self._clock()
+        self._expire(now)
+        key = (addr, message_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self.Entry(count, now + self._timeout)
+            self._entries[key] = entry
+        elif entry.count != count:
+            logging.warning("Fragment count mismatch from {addr}".format(addr=addr))
+            return None
+        if index in entry.chunks:
+            return None
+        chunk = bytes(data[_HEADER.size:])
+        entry.chunks[index] = chunk
+        entry.size += len(chunk)
+        self._size += len(chunk)
+        if len(entry.chunks) == entry.count:
+            self._drop(key)
+            return b"".join(entry.chunks[i] for i in range(entry.count))
+        while self._entries and (len(self._entries) > self._max_messages or self._size > self._max_bytes):
+            (oldest, _) = next(iter(self._entries.items()))
+            logging.warning("Reassembly buffer full, dropping partial message from {addr}".format(addr=oldest[0]))
+            self._drop(oldest)
+            self.evicted += 1
+        return None
+
+    def _expire(self, now):
+        while self._entries:
+            (key, entry) = next(iter(self._entries.items()))
+            if entry.deadline > now:
+                break
+            logging.warning("Reassembly timed out for a message from {addr}".format(addr=key[0]))
+            self._drop(key)
+            self.expired += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
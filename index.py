@@ -0,0 +1,109 @@
+import collections
+
+import ring
+
+
+def key_hash(key):
+    return ring.ring_hash(str(key))
+
+
+def key_digest(keys):
+    """Order-independent digest of a key set; equal sets give equal digests."""
+    digest = 0
+    for key in keys:
+        digest ^= key_hash(key)
+    return digest
+
+
+class KeyIndex:
+    def __init__(self):
+        self._replicas = {}
+        self._keys = {}
+        self._digests = {}
+        # replica count -> number of keys with that many replicas
+        self._histogram = collections.Counter()
+
+    def _recount(self, before, after):
+        if before:
+            self._histogram[before] -= 1
+            if not self._histogram[before]:
+                del self._histogram[before]
+        if after:
+            self._histogram[after] += 1
+
+    def add(self, uuid, key):
+        keys = self._keys.setdefault(uuid, set())
+        if key in keys:
+            return False
+        keys.add(key)
+        replicas = self._replicas.setdefault(key, set())
+        replicas.add(uuid)
+        self._recount(len(replicas) - 1, len(replicas))
+        self._digests[uuid] = self._digests.get(uuid, 0) ^ key_hash(key)
+        return True
+
+    def discard(self, uuid, key):
+        keys = self._keys.get(uuid)
+        if keys is None or key not in keys:
+            return False
+        keys.remove(key)
+        self._digests[uuid] ^= key_hash(key)
+        replicas = self._replicas[key]
+        replicas.remove(uuid)
+        self._recount(len(replicas) + 1, len(replicas))
+        if not replicas:
+            del self._replicas[key]
+        return True
+
+    def replace(self, uuid, keys):
+        self.drop(uuid)
+        self._keys[uuid] = set()
+        for key in keys:
+            self.add(uuid, key)
+
+    def drop(self, uuid):
+        keys = self._keys.pop(uuid, set())
+        self._digests.pop(uuid, None)
+        for key in keys:
+            replicas = self._replicas[key]
+            replicas.discard(uuid)
+            self._recount(len(replicas) + 1, len(replicas))
+            if not replicas:
+                del self._replicas[key]
+        return keys
+
+    def clear(self):
+        self._replicas.clear()
+        self._keys.clear()
+        self._digests.clear()
+        self._histogram.clear()
+
+    def replicas(self, key):
+        return self._replicas.get(key, set())
+
+    def keys(self, uuid):
+        return self._keys.get(uuid, set())
+
+    def keys_all(self):
+        return self._replicas.keys()
+
+    def digest(self, uuid):
+        return self._digests.get(uuid, 0)
+
+    def histogram(self):
+        return dict(self._histogram)
+
+    def count(self, uuid):
+        return len(self._keys.get(uuid, ()))
+
+    def nodes(self):
+        return list(self._keys.keys())
+
+    def __contains__(self, uuid):
+        return uuid in self._keys
+
+    def __len__(self):
+        return len(self._replicas)
+
+    def as_dict(self):
+        return {uuid: list(keys) for (uuid, keys) in self._keys.items()}
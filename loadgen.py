@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import client
+import dht
+import network
+
+LOADGEN_ADDR = "127.0.0.1"
+LOADGEN_BASE_PORT = 20000
+LOADGEN_SETTLE_TIMEOUT = 30.0
+LOADGEN_PRELOAD_BATCH = 32
+OPS = ("put", "get", "remove")
+
+
+class Keyspace:
+    """Keys ranked by popularity; rank r is drawn with probability proportional to 1 / r ** skew."""
+
+    def __init__(self, count, key_size, skew, rng):
+        self._rng = rng
+        self.keys = [self.make_key(i, key_size) for i in range(count)]
+        weights = [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+        total = 0.0
+        self._cumulative = []
+        for weight in weights:
+            total += weight
+            self._cumulative.append(total)
+        self._total = total
+
+    @staticmethod
+    def make_key(i, key_size):
+        key = "k{i}".format(i=i)
+        return key + "-" * max(0, key_size - len(key))
+
+    def pick(self):
+        i = bisect.bisect_left(self._cumulative, self._rng.random() * self._total)
+        return self.keys[min(i, len(self.keys) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {op: [] for op in OPS}
+        self.failures = {op: 0 for op in OPS}
+        self.misses = 0
+
+    def summary(self, duration):
+        results = {}
+        everything = []
+        for op in OPS:
+            latencies = sorted(self.latencies[op])
+            everything += latencies
+            results[op] = self.describe(latencies, self.failures[op], duration)
+        results["total"] = self.describe(sorted(everything), sum(self.failures.values()), duration)
+        results["get"]["misses"] = self.misses
+        return results
+
+    @staticmethod
+    def describe(latencies, failures, duration):
+        count = len(latencies)
+        attempted = count + failures
+        return {
+            "ok": count,
+            "failed": failures,
+            "loss": failures / attempted if attempted else 0.0,
+            "throughput": count / duration if duration > 0 else 0.0,
+            "mean_ms": sum(latencies) / count * 1e3 if count else None,
+            "p50_ms": percentile(latencies, 0.50),
+            "p99_ms": percentile(latencies, 0.99),
+            "p999_ms": percentile(latencies, 0.999),
+            "max_ms": latencies[-1] * 1e3 if count else None,
+        }
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e3
+
+
+def parse_mix(text):
+    mix = {op: 0.0 for op in OPS}
+    for part in text.split(","):
+        (op, _, weight) = part.partition("=")
+        if op not in mix:
+            raise argparse.ArgumentTypeError("Unknown operation " + op)
+        mix[op] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("The mix needs a positive weight")
+    return mix
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_cluster(loop, count, base_port):
+    addrs = [(LOADGEN_ADDR, base_port + i) for i in range(count)]
+    # Nodes find each other by unicasting to the full list instead of broadcasting to 10.0.0.x.
+    network.NETWORK_BROADCAST_MODE = "members"
+    network.NETWORK_SEED_ADDRS = addrs
+    return [dht.DHT(loop, addr) for addr in addrs]
+
+
+async def settle(nodes, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        masters = [node for node in nodes if node._state == dht.DHT.State.MASTER]
+        if len(masters) == 1 and all(len(node._ring) == len(nodes) for node in nodes):
+            return True
+        await asyncio.sleep(0.2)
+    return False
+
+
+async def preload(clients, keyspace, value):
+    for i in range(0, len(keyspace.keys), LOADGEN_PRELOAD_BATCH):
+        batch = keyspace.keys[i:i + LOADGEN_PRELOAD_BATCH]
+        await clients[i // LOADGEN_PRELOAD_BATCH % len(clients)].mput([(key, value) for key in batch])
+
+
+async def worker(dht_client, keyspace, mix, value, recorder, stop_at, rng):
+    ops = list(mix.keys())
+    weights = list(mix.values())
+    loop = asyncio.get_event_loop()
+    while loop.time() < stop_at:
+        op = rng.choices(ops, weights)[0]
+        key = keyspace.pick()
+        begin = time.perf_counter()
+        try:
+            if op == "put":
+                await dht_client.put(key, value)
+            elif op == "get":
+                if await dht_client.get(key) is None:
+                    recorder.misses += 1
+            else:
+                await dht_client.remove(key)
+        except client.DHTError:
+            recorder.failures[op] += 1
+            continue
+        recorder.latencies[op].append(time.perf_counter() - begin)
+
+
+async def run(args, loop, nodes, clients):
+    if not await settle(nodes, args.settle_timeout):
+        raise RuntimeError("The cluster did not converge within {timeout}s".format(timeout=args.settle_timeout))
+    rng = random.Random(args.seed)
+    keyspace = Keyspace(args.keys, args.key_size, args.zipf, rng)
+    value = "v" * args.value_size
+    await asyncio.gather(*[c.refresh_members() for c in clients])
+    if args.preload:
+        await preload(clients, keyspace, value)
+
+    recorder = Recorder()
+    if args.warmup > 0:
+        stop_at = loop.time() + args.warmup
+        await asyncio.gather(*[worker(c, keyspace, args.mix, value, Recorder(), stop_at, random.Random(rng.random()))
+                               for c in clients for _ in range(args.concurrency)])
+    sent_before = sum(node._packets_sent.value for node in nodes)
+    begin = loop.time()
+    stop_at = begin + args.duration
+    await asyncio.gather(*[worker(c, keyspace, args.mix, value, recorder, stop_at, random.Random(rng.random()))
+                           for c in clients for _ in range(args.concurrency)])
+    duration = loop.time() - begin
+    return {
+        "results": recorder.summary(duration),
+        "duration": duration,
+        "node_packets_sent": sum(node._packets_sent.value for node in nodes) - sent_before,
+        "client_retries": sum(c._timeouts.value for c in clients),
+        "cache_hits": sum(c.cache_hits for c in clients),
+        "cache_misses": sum(c.cache_misses for c in clients),
+    }
+
+
+def report(config, outcome):
+    print("{nodes} nodes, {clients}x{concurrency} clients, {duration:.1f}s, mix {mix}, zipf {zipf}".format(
+        **dict(config, duration=outcome["duration"])))
+    print("{:>8} {:>10} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "op", "ops/s", "ok", "loss", "p50 (ms)", "p99 (ms)", "p999 (ms)", "max (ms)"))
+
+    def ms(value):
+        return "-" if value is None else "{:.2f}".format(value)
+
+    for (op, row) in outcome["results"].items():
+        print("{:>8} {:>10.1f} {:>8} {:>8.4f} {:>10} {:>10} {:>10} {:>10}".format(
+            op, row["throughput"], row["ok"], row["loss"], ms(row["p50_ms"]), ms(row["p99_ms"]),
+            ms(row["p999_ms"]), ms(row["max_ms"])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a DHT cluster on loopback and measure it under load.")
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--base-port", type=int, default=LOADGEN_BASE_PORT)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4, help="outstanding requests per client")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("put=0.2,get=0.75,remove=0.05"))
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--key-size", type=int, default=16)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--zipf", type=float, default=0.99, help="skew exponent; 0 is uniform")
+    parser.add_argument("--no-preload", dest="preload", action="store_false")
+    parser.add_argument("--timeout", type=float, default=client.CLIENT_TIMEOUT)
+    parser.add_argument("--retries", type=int, default=client.CLIENT_RETRIES)
+    parser.add_argument("--settle-timeout", type=float, default=LOADGEN_SETTLE_TIMEOUT)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", help="write the results to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel("WARNING")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    nodes = start_cluster(loop, args.nodes, args.base_port)
+    # Sockets are bound with run_until_complete, so every client exists before the run starts.
+    clients = [client.DHTClient(loop, network.NETWORK_SEED_ADDRS, timeout=args.timeout, retries=args.retries,
+                                local_addr=(LOADGEN_ADDR, 0)) for _ in range(args.clients)]
+    try:
+        outcome = loop.run_until_complete(run(args, loop, nodes, clients))
+    finally:
+        for endpoint in nodes + clients:
+            endpoint.close()
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+    config = {
+        "nodes": args.nodes, "clients": args.clients, "concurrency": args.concurrency, "duration": args.duration,
+        "mix": args.mix, "keys": args.keys, "key_size": args.key_size, "value_size": args.value_size,
+        "zipf": args.zipf, "preload": args.preload, "timeout": args.timeout, "retries": args.retries,
+        "seed": args.seed, "codec": network.NETWORK_CODEC, "replication": dht.DHT_REPLICATION_FACTOR,
+    }
+    report(config, outcome)
+    if args.json:
+        document = dict(outcome, config=config, revision=git_revision(), python=platform.python_version(),
+                        timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+        if args.json == "-":
+            json.dump(document, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(document, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
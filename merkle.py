@@ -0,0 +1,67 @@
+import hashlib
+import json
+
+import ring
+
+MERKLE_FANOUT = 16
+MERKLE_DEPTH = 2
+
+
+def item_hash(key, value):
+    digest = hashlib.md5(json.dumps([key, value]).encode(encoding="utf-8")).digest()
+    return int.from_bytes(digest[:8], byteorder="big")
+
+
+def key_bucket(key, leaves=MERKLE_FANOUT ** MERKLE_DEPTH):
+    return ring.ring_hash(str(key)) % leaves
+
+
+class MerkleTree:
+    """A fixed-shape hash tree over key/value pairs.
+
+    Keys fall into FANOUT ** DEPTH leaf buckets by their ring hash. A node's digest is the XOR of
+    the item hashes below it, so items can be added and removed in O(depth).
+    """
+
+    def __init__(self, fanout=MERKLE_FANOUT, depth=MERKLE_DEPTH):
+        self.fanout = fanout
+        self.depth = depth
+        self._levels = [[0] * (fanout ** level) for level in range(depth + 1)]
+
+    @classmethod
+    def build(cls, items, fanout=MERKLE_FANOUT, depth=MERKLE_DEPTH):
+        tree = cls(fanout, depth)
+        for (key, value) in items:
+            tree.add(key, value)
+        return tree
+
+    @property
+    def leaves(self):
+        return len(self._levels[self.depth])
+
+    def bucket(self, key):
+        return key_bucket(key, self.leaves)
+
+    def add(self, key, value):
+        self._toggle(self.bucket(key), item_hash(key, value))
+
+    def remove(self, key, value):
+        self._toggle(self.bucket(key), item_hash(key, value))
+
+    def _toggle(self, leaf, h):
+        for level in range(self.depth, -1, -1):
+            self._levels[level][leaf] ^= h
+            leaf //= self.fanout
+
+    def root(self):
+        return self._levels[0][0]
+
+    def digests(self, level, nodes):
+        return [self._levels[level][node] for node in nodes]
+
+    def children(self, nodes):
+        return [node * self.fanout + i for node in nodes for i in range(self.fanout)]
+
+    def diff(self, level, nodes, digests):
+        """Return the nodes at level whose digest differs from the given one."""
+        return [node for (node, digest) in zip(nodes, digests) if self._levels[level][node] != digest]
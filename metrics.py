@@ -0,0 +1,182 @@
+import asyncio
+import bisect
+import logging
+
+# With metrics disabled every instrument is a shared no-op object.
+METRICS_ENABLED = True
+# Serve the Prometheus text format on this local port; None disables the endpoint.
+METRICS_HTTP_PORT = None
+METRICS_HTTP_ADDR = "127.0.0.1"
+# Upper bounds in seconds, from 100us to 5s.
+METRICS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0)
+
+
+class Counter:
+    kind = "counter"
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    kind = "gauge"
+    __slots__ = ("value", "_func")
+
+    def __init__(self, func=None):
+        self.value = 0
+        self._func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def sample(self):
+        return self._func() if self._func is not None else self.value
+
+
+class Histogram:
+    kind = "histogram"
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One slot per bucket plus the overflow (+Inf) slot; cumulated only when sampled.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def sample(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile; None if empty or past the last bucket."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class _Null:
+    kind = None
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL = _Null()
+
+
+class Registry:
+    def __init__(self, enabled=None):
+        self.enabled = METRICS_ENABLED if enabled is None else enabled
+        self._metrics = {}
+        self._help = {}
+
+    def _get(self, factory, name, help, labels):
+        if not self.enabled:
+            return NULL
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = factory()
+            self._help.setdefault(name, (metric.kind, help))
+        return metric
+
+    def counter(self, name, help="", labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", labels=None, func=None):
+        return self._get(lambda: Gauge(func), name, help, labels)
+
+    def histogram(self, name, help="", labels=None, buckets=METRICS_LATENCY_BUCKETS):
+        return self._get(lambda: Histogram(buckets), name, help, labels)
+
+    def snapshot(self):
+        return [[name, dict(labels), metric.sample()] for ((name, labels), metric) in self._metrics.items()]
+
+    def prometheus(self):
+        lines = []
+        last = None
+        for ((name, labels), metric) in sorted(self._metrics.items(), key=lambda item: item[0]):
+            (kind, help) = self._help[name]
+            if name != last:
+                if help:
+                    lines.append("# HELP {name} {help}".format(name=name, help=help))
+                lines.append("# TYPE {name} {kind}".format(name=name, kind=kind))
+                last = name
+            if kind == "histogram":
+                cumulative = 0
+                for (bound, count) in zip(metric.buckets + (float("inf"),), metric.counts):
+                    cumulative += count
+                    bound_labels = labels + (("le", "+Inf" if bound == float("inf") else repr(bound)),)
+                    lines.append("{name}_bucket{labels} {value}".format(
+                        name=name, labels=_labels(bound_labels), value=cumulative))
+                lines.append("{name}_sum{labels} {value}".format(name=name, labels=_labels(labels), value=metric.sum))
+                lines.append("{name}_count{labels} {value}".format(name=name, labels=_labels(labels), value=metric.count))
+            else:
+                lines.append("{name}{labels} {value}".format(name=name, labels=_labels(labels), value=metric.sample()))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = ('{key}="{value}"'.format(key=key, value=str(value).replace("\\", "\\\\").replace('"', '\\"'))
+               for (key, value) in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+async def serve(registry, addr=METRICS_HTTP_ADDR, port=METRICS_HTTP_PORT):
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request.split(b" ")[:2] == [b"GET", b"/metrics"]:
+                (status, body) = ("200 OK", registry.prometheus().encode(encoding="utf-8"))
+            else:
+                (status, body) = ("404 Not Found", b"")
+            writer.write("HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         "Content-Length: {length}\r\n\r\n".format(status=status, length=len(body)).encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug("Metrics request failed: " + str(e))
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, addr, port)
+    logging.info("Serving metrics on http://{addr}:{port}/metrics".format(addr=addr, port=port))
+    return server
@@ -1,15 +1,51 @@
 import asyncio
-import json
+import codec
+import fragment
 import logging
+import metrics
+import random
+import socket
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 
-NETWORK_MAGIC_VALUE= "Sound body, sound code."
+NETWORK_MAGIC_VALUE = codec.JSON_MAGIC_VALUE
 NETWORK_PORT = 19999
 NETWORK_LISTEN_ADDR = "0.0.0.0" #or 127.0.0.1
 NETWORK_UDP_MTU = 1024
+# Messages above the MTU are split into fragments; messages above this are refused.
+NETWORK_MAX_PAYLOAD = 64 * 1024
+NETWORK_REASSEMBLY_TIMEOUT = 5.0
+NETWORK_REASSEMBLY_MESSAGES = 256
+NETWORK_REASSEMBLY_BYTES = 4 * 1024 * 1024
 NETWORK_BROADCAST_ADDR = "255.255.255.255"
 EMULATE_BROADCAST = True
 EMULATE_ADDR = "10.0.0.{num}"
+# How messages to NETWORK_BROADCAST_ADDR are delivered:
+#   "emulate"   unicast to every EMULATE_ADDR host
+#   "broadcast" a real UDP broadcast
+#   "members"   unicast to the current members plus NETWORK_SEED_ADDRS
+#   "multicast" one datagram to NETWORK_MULTICAST_GROUP
+NETWORK_BROADCAST_MODE = "emulate" if EMULATE_BROADCAST else "broadcast"
+NETWORK_SEED_ADDRS = []
+NETWORK_MULTICAST_GROUP = "239.255.77.77"
+NETWORK_MULTICAST_TTL = 1
+# "json" never sends binary, "auto" negotiates binary per peer, "binary" always sends binary.
+NETWORK_CODEC = "auto"
+# Queue messages per destination and send each event-loop tick's worth as few datagrams as possible.
+NETWORK_COALESCE = True
+
+
+class UDPTransport:
+    """Opens the real UDP socket; sim.SimTransport stands in for it in simulations."""
+
+    def open(self, loop, protocol, local_addr):
+        endpoint = loop.create_datagram_endpoint(lambda: protocol, local_addr=local_addr, allow_broadcast=True)
+        (transport, _) = loop.run_until_complete(endpoint)
+        if protocol._network._broadcast_mode == "multicast":
+            sock = transport.get_extra_info("socket")
+            membership = socket.inet_aton(NETWORK_MULTICAST_GROUP) + socket.inet_aton("0.0.0.0")
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, NETWORK_MULTICAST_TTL)
+        return transport
 
 
 class Network:
@@ -19,55 +55,215 @@ class Network:
 
         def datagram_received(self, data, addr):
             logging.debug("Packet received from {addr}, length {len}".format(addr=addr, len=len(data)))
+            network = self._network
+            network._packets_received.inc()
+            network._bytes_received.inc(len(data))
+            if fragment.is_fragment(data):
+                data = network._reassembler.add(data, addr)
+                if data is None:
+                    return
             try:
-                s = data.decode(encoding="utf-8", errors="strict")
-                message = json.loads(s)
-                if not "_magic" in message:
-                    raise Exception("No magic value")
-                if not message["_magic"] == NETWORK_MAGIC_VALUE:
-                    raise Exception("Invalid magic value")
-                self._network.message_arrived(message, addr)
+                messages = network.decode_messages(data, addr)
             except UnicodeError as e:
                 logging.warning("Invalid unicode character: " + str(e))
-            #except Exception as e:
-            #    logging.warning("Cannot parse packet: " + str(e))
+                network._decode_errors.inc()
+                return
+            except codec.CodecError as e:
+                logging.warning("Cannot parse packet: " + str(e))
+                network._decode_errors.inc()
+                return
+            network._messages_received.inc(len(messages))
+            for message in messages:
+                # One failing handler must not cost the other messages coalesced with it.
+                try:
+                    network.message_arrived(message, addr)
+                except Exception:
+                    logging.exception("Handler for {type} message from {addr} failed".format(
+                        type=message.get("type") if isinstance(message, dict) else None, addr=addr))
+                    network._handler_errors.inc()
 
         def error_received(self, err):
             logging.warning("Error received in UDPListener: " + str(err))
 
-    def __init__(self, loop: asyncio.AbstractEventLoop):
+    def __init__(self, loop: asyncio.AbstractEventLoop, local_addr=None, transport=None, broadcast_mode=None):
         self._loop = loop
-        socket = loop.create_datagram_endpoint(
-            lambda: self.UDPListener(self), local_addr=(NETWORK_LISTEN_ADDR, NETWORK_PORT),
-            reuse_address=True, allow_broadcast=True,
-        )
+        self._broadcast_mode = broadcast_mode if broadcast_mode is not None else NETWORK_BROADCAST_MODE
+        self._peer_codec = {}
+        self._reassembler = fragment.Reassembler(
+            NETWORK_REASSEMBLY_MESSAGES, NETWORK_REASSEMBLY_BYTES, NETWORK_REASSEMBLY_TIMEOUT, clock=loop.time)
+        self._fragment_id = random.getrandbits(64)
+        self._outbox = {}
+        self._flush_handle = None
+        self._members = []
+        self.broadcast_count = 0
+        self.broadcast_sends = 0
+        self.last_broadcast_sends = 0
+        self._metrics = metrics.Registry()
+        self._packets_received = self._metrics.counter("network_packets_received_total", "Datagrams received")
+        self._bytes_received = self._metrics.counter("network_received_bytes_total", "Bytes received")
+        self._messages_received = self._metrics.counter("network_messages_received_total", "Messages decoded")
+        self._decode_errors = self._metrics.counter(
+            "network_decode_errors_total", "Datagrams dropped because they could not be parsed")
+        self._packets_sent = self._metrics.counter("network_packets_sent_total", "Datagrams sent")
+        self._bytes_sent = self._metrics.counter("network_sent_bytes_total", "Bytes sent")
+        self._messages_sent = self._metrics.counter("network_messages_sent_total", "Messages queued for sending")
+        self._send_errors = self._metrics.counter(
+            "network_send_errors_total", "Messages dropped because they could not be encoded or sent")
+        self._handler_errors = self._metrics.counter(
+            "network_handler_errors_total", "Decoded messages whose handler raised")
+        self._oversized = self._metrics.counter(
+            "network_oversized_total", "Messages dropped for exceeding NETWORK_MAX_PAYLOAD")
+        self._metrics.gauge("network_outbox_messages", "Messages waiting for the next flush",
+                            func=lambda: sum(len(items) for items in self._outbox.values()))
+        self._metrics.gauge("network_reassembly_messages", "Partially received fragmented messages",
+                            func=lambda: len(self._reassembler))
+        self._metrics.gauge("network_reassembly_dropped", "Partial messages expired or evicted",
+                            func=lambda: self._reassembler.expired + self._reassembler.evicted)
+        transport = transport if transport is not None else UDPTransport()
+        self._socket = transport.open(loop, self.UDPListener(self), local_addr or (NETWORK_LISTEN_ADDR, NETWORK_PORT))
+
+    def set_members(self, addrs):
+        self._members = [tuple(addr) for addr in addrs if addr is not None]
+
+    def broadcast_targets(self, port):
+        if self._broadcast_mode == "emulate":
+            return [(EMULATE_ADDR.format(num=i), port) for i in range(2, 255)]
+        elif self._broadcast_mode == "members":
+            return list(dict.fromkeys(self._members + [tuple(addr) for addr in NETWORK_SEED_ADDRS]))
+        elif self._broadcast_mode == "multicast":
+            return [(NETWORK_MULTICAST_GROUP, port)]
+        return [(NETWORK_BROADCAST_ADDR, port)]
+
+    def codec_for(self, addr):
+        if NETWORK_CODEC == "binary":
+            return codec.BINARY
+        if NETWORK_CODEC == "auto" and addr[0] != NETWORK_BROADCAST_ADDR:
+            version = self._peer_codec.get(tuple(addr), 0)
+            if version >= codec.BINARY_VERSION:
+                return codec.BINARY
+        return codec.JSON
+
+    def coalesces(self, addr):
+        # Batch envelopes are only understood by peers that advertised _codec; older nodes drop them.
+        if NETWORK_CODEC == "binary":
+            return True
+        return addr[0] != NETWORK_BROADCAST_ADDR and tuple(addr) in self._peer_codec
+
+    def encode_message(self, message, addr):
+        message_codec = self.codec_for(addr)
+        if message_codec is codec.JSON and NETWORK_CODEC == "auto":
+            # Advertise binary support so upgraded peers can switch; older peers ignore the field.
+            message["_codec"] = codec.BINARY_VERSION
+        return message_codec.encode(message)
 
-        (self._socket, _) = loop.run_until_complete(socket)
+    def decode_messages(self, data, addr):
+        if codec.is_binary(data):
+            messages = codec.BINARY.decode_all(data)
+            self._peer_codec[addr] = codec.BINARY_VERSION
+        else:
+            messages = codec.JSON.decode_all(data)
+            if messages and "_codec" in messages[0]:
+                self._peer_codec[addr] = min(int(messages[0]["_codec"]), codec.BINARY_VERSION)
+        return messages
 
     def send_message(self, message, addr):
-        if not "_magic" in message:
-            message["_magic"] = NETWORK_MAGIC_VALUE
-        s = json.dumps(message)
         try:
-            b = s.encode(encoding='utf-8', errors='strict')
+            message_codec = self.codec_for(addr)
+            b = self.encode_message(message, addr)
+        except Exception as e:
+            logging.error("Cannot encode a send message: " + str(e))
+            self._send_errors.inc()
+            return
+        self._messages_sent.inc()
+        if len(b) > NETWORK_MAX_PAYLOAD:
+            logging.error("Too large send message: {orig} over {limit}".format(orig=len(b), limit=NETWORK_MAX_PAYLOAD))
+            self._oversized.inc()
+        elif NETWORK_COALESCE:
+            self._outbox.setdefault(tuple(addr), []).append((message_codec, b))
+            if self._flush_handle is None:
+                self._flush_handle = self._loop.call_soon(self.flush)
+        else:
+            self.send_datagram(b, addr)
+
+    def flush(self):
+        outbox = self._outbox
+        self._outbox = {}
+        self._flush_handle = None
+        for (addr, items) in outbox.items():
+            if not self.coalesces(addr):
+                for (_, b) in items:
+                    self.send_datagram(b, addr)
+                continue
+            batch = []
+            batch_codec = None
+            size = 0
+            for (message_codec, b) in items:
+                item_size = message_codec.batch_item_size(len(b))
+                if batch and (message_codec is not batch_codec or size + item_size > NETWORK_UDP_MTU):
+                    self.send_batch(batch_codec, batch, addr)
+                    batch = []
+                if message_codec.batch_overhead + item_size > NETWORK_UDP_MTU:
+                    # Too large to share a datagram; it goes out alone, fragmented.
+                    self.send_datagram(b, addr)
+                    continue
+                if not batch:
+                    batch_codec = message_codec
+                    size = message_codec.batch_overhead
+                batch.append(b)
+                size += item_size
+            if batch:
+                self.send_batch(batch_codec, batch, addr)
+
+    def send_batch(self, message_codec, frames, addr):
+        if len(frames) == 1:
+            self.send_datagram(frames[0], addr)
+        else:
+            logging.debug("Coalescing {count} messages for {addr}".format(count=len(frames), addr=addr))
+            self.send_datagram(message_codec.encode_batch(frames), addr)
+
+    def send_datagram(self, b, addr):
+        try:
             if len(b) > NETWORK_UDP_MTU:
-                logging.error("Too large send message: {orig} over {limit}".format(orig=len(b), limit=NETWORK_UDP_MTU))
+                self._fragment_id = (self._fragment_id + 1) & 0xFFFFFFFFFFFFFFFF
+                frames = fragment.split(b, self._fragment_id, NETWORK_UDP_MTU)
+                logging.debug("Sending {bytes} bytes of message in {count} fragments".format(bytes=len(b), count=len(frames)))
+                for frame in frames:
+                    self.sendto(frame, addr)
             else:
                 logging.debug("Sending {bytes} bytes of message".format(bytes=len(b)))
-                if EMULATE_BROADCAST and addr[0] == NETWORK_BROADCAST_ADDR:
-                    logging.debug("Emulation mode enabled")
-                    for i in range(2, 255):
-                        self._socket.sendto(b, (EMULATE_ADDR.format(num=i), addr[1]))
-                else:
-                    self._socket.sendto(b, addr)
+                self.sendto(b, addr)
         except Exception as e:
-            logging.error("Cannot encode a send message: " + str(e))
+            logging.error("Cannot send a message: " + str(e))
+            self._send_errors.inc()
+
+    def sendto(self, b, addr):
+        if addr[0] == NETWORK_BROADCAST_ADDR:
+            targets = self.broadcast_targets(addr[1])
+            logging.debug("Broadcasting in {mode} mode to {count} targets".format(
+                mode=self._broadcast_mode, count=len(targets)))
+            for target in targets:
+                self._socket.sendto(b, target)
+            self._packets_sent.inc(len(targets))
+            self._bytes_sent.inc(len(b) * len(targets))
+            self.broadcast_count += 1
+            self.broadcast_sends += len(targets)
+            self.last_broadcast_sends = len(targets)
+        else:
+            self._socket.sendto(b, tuple(addr))
+            self._packets_sent.inc()
+            self._bytes_sent.inc(len(b))
 
     def message_arrived(self, message, addr):
         logging.debug("Message received from {addr}, {message}".format(addr=addr, message=message))
 
     def abort(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._outbox.clear()
         self._socket.abort()
 
     def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self.flush()
         self._socket.close()
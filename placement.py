@@ -0,0 +1,125 @@
+import heapq
+
+
+def least_loaded(load, capacity):
+    return load
+
+
+def capacity_weighted(load, capacity):
+    return load / capacity if capacity > 0 else float("inf")
+
+
+PLACEMENT_POLICIES = {
+    "least_loaded": least_loaded,
+    "capacity_weighted": capacity_weighted,
+}
+
+
+class Placement:
+    def __init__(self, policy="least_loaded"):
+        if isinstance(policy, str):
+            policy = PLACEMENT_POLICIES[policy]
+        self._policy = policy
+        self._heap = []
+        self._pos = {}
+        self._load = {}
+        self._capacity = {}
+        self._addrs = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, uuid):
+        return uuid in self._pos
+
+    def add(self, uuid, addr, load=0, capacity=1):
+        self._addrs[uuid] = addr
+        self._load[uuid] = load
+        self._capacity[uuid] = capacity
+        if uuid in self._pos:
+            self._update(uuid)
+        else:
+            self._heap.append((self._score(uuid), uuid))
+            self._pos[uuid] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+
+    def remove(self, uuid):
+        if uuid not in self._pos:
+            return
+        i = self._pos.pop(uuid)
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._pos[last[1]] = i
+            self._sift_down(self._sift_up(i))
+        del self._load[uuid]
+        del self._capacity[uuid]
+        del self._addrs[uuid]
+
+    def clear(self):
+        self._heap.clear()
+        self._pos.clear()
+        self._load.clear()
+        self._capacity.clear()
+        self._addrs.clear()
+
+    def load(self, uuid):
+        return self._load.get(uuid, 0)
+
+    def addr(self, uuid):
+        return self._addrs.get(uuid)
+
+    def set_load(self, uuid, load):
+        if uuid in self._pos:
+            self._load[uuid] = load
+            self._update(uuid)
+
+    def adjust(self, uuid, delta):
+        if uuid in self._pos:
+            self.set_load(uuid, self._load[uuid] + delta)
+
+    def pick(self, count):
+        # Walk the k smallest entries with a frontier heap over heap positions: O(k log k).
+        picked = []
+        frontier = [(self._heap[0], 0)] if self._heap else []
+        while frontier and len(picked) < count:
+            ((_, uuid), i) = heapq.heappop(frontier)
+            picked.append((uuid, self._addrs[uuid]))
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+        return picked
+
+    def _score(self, uuid):
+        return self._policy(self._load[uuid], self._capacity[uuid])
+
+    def _update(self, uuid):
+        i = self._pos[uuid]
+        self._heap[i] = (self._score(uuid), uuid)
+        self._sift_down(self._sift_up(i))
+
+    def _swap(self, i, j):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._pos[self._heap[i][1]] = i
+        self._pos[self._heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self._heap[i] < self._heap[parent]:
+                self._swap(i, parent)
+                i = parent
+            else:
+                break
+        return i
+
+    def _sift_down(self, i):
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self._heap) and self._heap[child] < self._heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                return i
+            self._swap(i, smallest)
+            i = smallest
@@ -0,0 +1,60 @@
+import bisect
+import functools
+import hashlib
+
+RING_VIRTUAL_NODES = 64
+
+
+def ring_hash(value):
+    digest = hashlib.md5(value.encode(encoding="utf-8")).digest()
+    return int.from_bytes(digest[:8], byteorder="big")
+
+
+@functools.lru_cache(maxsize=4096)
+def member_points(uuid, vnodes):
+    # A member's points never change, so rebuilding after a join or leave only re-sorts.
+    return tuple(ring_hash("{uuid}#{i}".format(uuid=uuid, i=i)) for i in range(vnodes))
+
+
+class HashRing:
+    def __init__(self, members=(), vnodes=RING_VIRTUAL_NODES):
+        self._vnodes = vnodes
+        self._points = []
+        self._owners = []
+        self._addrs = {}
+        self.rebuild(members)
+
+    def rebuild(self, members):
+        self._addrs = {uuid: addr for (uuid, addr) in members}
+        points = []
+        for uuid in self._addrs:
+            points.extend((point, uuid) for point in member_points(uuid, self._vnodes))
+        points.sort()
+        self._points = [point for (point, _) in points]
+        self._owners = [uuid for (_, uuid) in points]
+
+    def __len__(self):
+        return len(self._addrs)
+
+    def __contains__(self, uuid):
+        return uuid in self._addrs
+
+    def addr(self, uuid):
+        return self._addrs.get(uuid)
+
+    def members(self):
+        return list(self._addrs.items())
+
+    def lookup(self, key, count=1):
+        if not self._points:
+            return []
+        count = min(count, len(self._addrs))
+        replicas = []
+        start = bisect.bisect(self._points, ring_hash(str(key)))
+        for i in range(len(self._points)):
+            uuid = self._owners[(start + i) % len(self._points)]
+            if uuid not in replicas:
+                replicas.append(uuid)
+                if len(replicas) == count:
+                    break
+        return [(uuid, self._addrs[uuid]) for uuid in replicas]
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import collections
+import errno
+import logging
+import random
+import selectors
+import time
+import uuid
+
+import client
+import dht
+import network
+
+SIM_LATENCY = 0.001
+SIM_JITTER = 0.0005
+SIM_LOSS = 0.0
+# Virtual wall clock at time zero, so timestamps and versions look like real ones.
+SIM_EPOCH = 1700000000.0
+SIM_EPHEMERAL_PORT = 40000
+
+
+class SimulationStalled(Exception):
+    pass
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        # Never block: whatever the loop would have waited for has already happened.
+        events = super().select(0)
+        if events:
+            return events
+        if timeout is None:
+            raise SimulationStalled("Nothing is scheduled")
+        self.now += timeout
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """An event loop whose clock jumps straight to the next scheduled callback."""
+
+    def __init__(self, epoch=SIM_EPOCH):
+        self._virtual = _VirtualSelector()
+        super().__init__(selector=self._virtual)
+        self._epoch = epoch
+
+    def time(self):
+        return self._virtual.now
+
+    def wall_time(self):
+        return self._epoch + self._virtual.now
+
+    def run_for(self, seconds):
+        self.run_until_complete(asyncio.sleep(seconds))
+
+
+class SimEndpoint:
+    def __init__(self, transport, addr, protocol):
+        self._transport = transport
+        self.addr = addr
+        self.protocol = protocol
+
+    def sendto(self, data, addr):
+        self._transport.send(self, bytes(data), tuple(addr))
+
+    def get_extra_info(self, name, default=None):
+        return self.addr if name == "sockname" else default
+
+    def close(self):
+        self._transport.detach(self)
+
+    def abort(self):
+        self._transport.detach(self)
+
+
+class SimTransport:
+    """In-memory datagram fabric with per-hop latency, random loss and partitions."""
+
+    def __init__(self, loop, latency=SIM_LATENCY, jitter=SIM_JITTER, loss=SIM_LOSS, seed=0):
+        self._loop = loop
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self._rng = random.Random(seed)
+        self._endpoints = {}
+        self._ports = collections.defaultdict(dict)
+        self._groups = {}
+        # Endpoints whose broadcasts reach nobody, like a node on another subnet.
+        self.unheard = set()
+        self._next_host = 1
+        self._next_port = SIM_EPHEMERAL_PORT
+        self.datagrams = 0
+        self.deliveries = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def open(self, loop, protocol, local_addr):
+        (host, port) = local_addr
+        if host in ("", "0.0.0.0", "127.0.0.1"):
+            # Every endpoint gets its own host so thousands of nodes can share NETWORK_PORT.
+            self._next_host += 1
+            host = "10.{a}.{b}.{c}".format(
+                a=(self._next_host >> 16) & 0xFF, b=(self._next_host >> 8) & 0xFF, c=self._next_host & 0xFF)
+        if port == 0:
+            self._next_port += 1
+            port = self._next_port
+        addr = (host, port)
+        if addr in self._endpoints:
+            raise OSError(errno.EADDRINUSE, "Address already in use: " + str(addr))
+        endpoint = SimEndpoint(self, addr, protocol)
+        self._endpoints[addr] = endpoint
+        self._ports[port][addr] = endpoint
+        protocol.connection_made(endpoint)
+        return endpoint
+
+    def detach(self, endpoint):
+        if self._endpoints.get(endpoint.addr) is endpoint:
+            del self._endpoints[endpoint.addr]
+            del self._ports[endpoint.addr[1]][endpoint.addr]
+
+    def send(self, source, data, addr):
+        if self._endpoints.get(source.addr) is not source:
+            return
+        self.datagrams += 1
+        self.bytes += len(data)
+        if addr[0] == network.NETWORK_BROADCAST_ADDR:
+            targets = [] if source.addr in self.unheard else list(self._ports[addr[1]].values())
+        else:
+            target = self._endpoints.get(addr)
+            targets = [target] if target is not None else []
+        for target in targets:
+            if not self.connected(source.addr, target.addr) or (self.loss and self._rng.random() < self.loss):
+                self.dropped += 1
+                continue
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            self._loop.call_later(delay, self.arrive, target, data, source.addr)
+
+    def arrive(self, target, data, source):
+        if self._endpoints.get(target.addr) is target:
+            self.deliveries += 1
+            target.protocol.datagram_received(data, source)
+
+    def partition(self, *groups):
+        """Split the listed address groups from each other; unlisted addresses form one more group."""
+        self._groups = {tuple(addr): i for (i, group) in enumerate(groups) for addr in group}
+
+    def heal(self):
+        self._groups = {}
+
+    def connected(self, a, b):
+        return not self._groups or self._groups.get(a, -1) == self._groups.get(b, -1)
+
+
+class Cluster:
+    """Many DHT nodes in one process on a virtual clock.
+
+    Runs are reproducible for a given seed and PYTHONHASHSEED.
+    """
+
+    def __init__(self, size=0, latency=SIM_LATENCY, jitter=SIM_JITTER, loss=SIM_LOSS, seed=0, detector=None,
+                 seeds=0):
+        random.seed(seed)
+        self._ids = random.Random(seed)
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = SimTransport(self.loop, latency, jitter, loss, seed)
+        self.detector = detector
+        # The first `seeds` nodes' addresses; every node shares this list and reads it when it starts.
+        self.seed_addrs = []
+        self._seeds = seeds
+        self.nodes = []
+        self.dead = []
+        for _ in range(size):
+            self.add_node()
+
+    def add_node(self, broadcast=True):
+        node_id = str(uuid.UUID(int=self._ids.getrandbits(128), version=1))
+        # The fabric delivers broadcasts itself.
+        node = dht.DHT(self.loop, (network.NETWORK_LISTEN_ADDR, network.NETWORK_PORT), self.transport, node_id,
+                       broadcast_mode="broadcast", failure_detector=self.detector, seed_addrs=self.seed_addrs)
+        if len(self.seed_addrs) < self._seeds:
+            self.seed_addrs.append(node._socket.addr)
+        if not broadcast:
+            self.transport.unheard.add(node._socket.addr)
+        self.nodes.append(node)
+        return node
+
+    def client(self, **kwargs):
+        return client.DHTClient(self.loop, [node._socket.addr for node in self.nodes], transport=self.transport,
+                                **kwargs)
+
+    def kill(self, node):
+        node.abort()
+        node.stop_timers()
+        self.nodes.remove(node)
+        self.dead.append(node)
+
+    def partition(self, *groups):
+        self.transport.partition(*[[node._socket.addr for node in group] for group in groups])
+
+    def heal(self):
+        self.transport.heal()
+
+    @property
+    def now(self):
+        return self.loop.time()
+
+    def run_for(self, seconds):
+        self.loop.run_for(seconds)
+
+    def run_until(self, predicate, timeout, step=0.1):
+        """Advance until predicate() holds; return the virtual seconds it took, or None on timeout."""
+        begin = self.loop.time()
+        while not predicate():
+            if self.loop.time() - begin >= timeout:
+                return None
+            self.loop.run_for(step)
+        return self.loop.time() - begin
+
+    def masters(self):
+        return [node for node in self.nodes if node._state == dht.DHT.State.MASTER]
+
+    def converged(self):
+        masters = self.masters()
+        if len(masters) != 1:
+            return False
+        members = {node.uuid for node in self.nodes}
+        for node in self.nodes:
+            if node is not masters[0] and (node._state != dht.DHT.State.SLAVE or
+                                           node._context.master_uuid != masters[0].uuid):
+                return False
+            if {uuid for (uuid, _) in node._ring.members()} != members:
+                return False
+        return True
+
+    def close(self):
+        # Another cluster may have installed its own loop since this one was made.
+        asyncio.set_event_loop(self.loop)
+        for node in self.nodes:
+            node.abort()
+            node.stop_timers()
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
+def measure(cluster, label, predicate, timeout):
+    datagrams = cluster.transport.datagrams
+    deliveries = cluster.transport.deliveries
+    begin = time.perf_counter()
+    elapsed = cluster.run_until(predicate, timeout)
+    print("{:<12} {:>12} {:>10.2f} {:>12} {:>12} {:>8}".format(
+        label, "timeout" if elapsed is None else "{:.2f}".format(elapsed), time.perf_counter() - begin,
+        cluster.transport.datagrams - datagrams, cluster.transport.deliveries - deliveries, len(cluster.masters())))
+    return elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a DHT cluster on a virtual clock.")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=SIM_LATENCY)
+    parser.add_argument("--jitter", type=float, default=SIM_JITTER)
+    parser.add_argument("--loss", type=float, default=SIM_LOSS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="virtual seconds allowed per phase")
+    parser.add_argument("--detector", choices=("heartbeat", "swim"), default=dht.DHT_FAILURE_DETECTOR)
+    parser.add_argument("--seeds", type=int, default=0, help="use the first N nodes as seed nodes")
+    parser.add_argument("--unheard-join", action="store_true",
+                        help="the joining node's broadcasts reach nobody, so only seeds can bring it in")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel("ERROR")
+    cluster = Cluster(args.nodes, args.latency, args.jitter, args.loss, args.seed, args.detector, args.seeds)
+    print("{nodes} nodes, latency {latency}s, loss {loss}, {detector} failure detector".format(
+        nodes=args.nodes, latency=args.latency, loss=args.loss, detector=args.detector))
+    print("{:<12} {:>12} {:>10} {:>12} {:>12} {:>8}".format(
+        "phase", "virtual (s)", "real (s)", "datagrams", "deliveries", "masters"))
+    try:
+        if measure(cluster, "bootstrap", cluster.converged, args.timeout) is None:
+            return
+        cluster.kill(cluster.masters()[0])
+        measure(cluster, "failover", cluster.converged, args.timeout)
+        cluster.add_node(broadcast=not args.unheard_join)
+        if measure(cluster, "join", cluster.converged, args.timeout) is None:
+            return
+        half = len(cluster.nodes) // 2
+        cluster.partition(cluster.nodes[:half], cluster.nodes[half:])
+        cluster.run_for(60)
+        cluster.heal()
+        measure(cluster, "heal", cluster.converged, args.timeout)
+    finally:
+        cluster.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+STORAGE_LOG_FILE = "data.log"
+STORAGE_SNAPSHOT_FILE = "data.snapshot"
+# Records appended within this many seconds share one fsync.
+STORAGE_SYNC_INTERVAL = 0.005
+# Compact the log into a new snapshot after this many records.
+STORAGE_SNAPSHOT_RECORDS = 100000
+
+SNAPSHOT_MAGIC_VALUE = b"DHTS"
+SNAPSHOT_VERSION = 2
+
+_PUT = 1
+_REMOVE = 2
+# Versioned records carry json [value, version] or json version as their value; a versioned
+# remove leaves a tombstone, a plain one (a key handed off elsewhere) does not.
+_PUT_VERSIONED = 3
+_REMOVE_VERSIONED = 4
+# Each log record is a crc32 of the rest followed by op, key length and value length.
+_CRC = struct.Struct("!I")
+_RECORD = struct.Struct("!BII")
+# magic, version, entry count, crc32 of the entries
+_SNAPSHOT_HEADER = struct.Struct("!4sBII")
+_ENTRY = struct.Struct("!II")
+# Version 2 entries: op (_PUT or _REMOVE for a tombstone), key length, value length, write version.
+_ENTRY_V2 = struct.Struct("!BIId")
+
+
+class StorageError(Exception):
+    pass
+
+
+class Storage:
+    def __init__(self, path, loop=None, sync_interval=STORAGE_SYNC_INTERVAL,
+                 snapshot_records=STORAGE_SNAPSHOT_RECORDS):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._loop = loop
+        self._sync_interval = sync_interval
+        self._snapshot_records = snapshot_records
+        self._log_path = os.path.join(path, STORAGE_LOG_FILE)
+        self._snapshot_path = os.path.join(path, STORAGE_SNAPSHOT_FILE)
+        self._sync_handle = None
+        self._waiters = []
+        self._dirty = False
+        self.data = {}
+        self.versions = {}
+        self.tombstones = {}
+        self.records = 0
+        self.syncs = 0
+        self.snapshots = 0
+
+        self.load_snapshot()
+        self.replay_log()
+        self._log = open(self._log_path, "ab")
+
+    def put(self, key, value, version=None):
+        self.apply(_PUT if version is None else _PUT_VERSIONED, key, value, version)
+        if version is None:
+            self.append(_PUT, key, value)
+        else:
+            self.append(_PUT_VERSIONED, key, [value, version])
+
+    def remove(self, key, version=None):
+        self.apply(_REMOVE if version is None else _REMOVE_VERSIONED, key, None, version)
+        if version is None:
+            self.append(_REMOVE, key, None)
+        else:
+            self.append(_REMOVE_VERSIONED, key, version)
+
+    def apply(self, op, key, value, version):
+        if op in (_PUT, _PUT_VERSIONED):
+            self.data[key] = value
+            self.tombstones.pop(key, None)
+            if version is None:
+                self.versions.pop(key, None)
+            else:
+                self.versions[key] = version
+        else:
+            self.data.pop(key, None)
+            self.versions.pop(key, None)
+            if version is not None:
+                self.tombstones[key] = version
+
+    def append(self, op, key, value):
+        k = json.dumps(key).encode(encoding="utf-8")
+        v = json.dumps(value).encode(encoding="utf-8") if op != _REMOVE else b""
+        body = _RECORD.pack(op, len(k), len(v)) + k + v
+        self._log.write(_CRC.pack(zlib.crc32(body)) + body)
+        self._dirty = True
+        self.records += 1
+        if self.records >= self._snapshot_records:
+            self.snapshot()
+        elif self._loop is None:
+            self.sync()
+        elif self._sync_handle is None:
+            self._sync_handle = self._loop.call_later(self._sync_interval, self.sync)
+
+    def after_sync(self, callback):
+        """Run callback once everything appended so far is on disk."""
+        if self._dirty:
+            self._waiters.append(callback)
+        else:
+            callback()
+
+    def sync(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        if self._dirty:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._dirty = False
+            self.syncs += 1
+        waiters = self._waiters
+        self._waiters = []
+        for callback in waiters:
+            callback()
+
+    def snapshot(self):
+        tmp_path = self._snapshot_path + ".tmp"
+        body = bytearray()
+        for (key, value) in self.data.items():
+            k = json.dumps(key).encode(encoding="utf-8")
+            v = json.dumps(value).encode(encoding="utf-8")
+            body += _ENTRY_V2.pack(_PUT, len(k), len(v), self.versions.get(key, 0))
+            body += k
+            body += v
+        for (key, version) in self.tombstones.items():
+            k = json.dumps(key).encode(encoding="utf-8")
+            body += _ENTRY_V2.pack(_REMOVE, len(k), 0, version)
+            body += k
+        count = len(self.data) + len(self.tombstones)
+        with open(tmp_path, "wb") as f:
+            f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC_VALUE, SNAPSHOT_VERSION, count, zlib.crc32(body)))
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        self.sync_directory()
+        # Replaying a log over a snapshot that already contains its records is harmless,
+        # so a crash before the truncation below loses nothing.
+        self._log.truncate(0)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._dirty = False
+        self.records = 0
+        self.snapshots += 1
+        logging.info("Storage snapshot written with {count} keys and {tombstones} tombstones".format(
+            count=len(self.data), tombstones=len(self.tombstones)))
+        self.sync()
+
+    def sync_directory(self):
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def load_snapshot(self):
+        try:
+            f = open(self._snapshot_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size < _SNAPSHOT_HEADER.size:
+                raise StorageError("Truncated snapshot " + self._snapshot_path)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                (magic, version, count, crc) = _SNAPSHOT_HEADER.unpack_from(view, 0)
+                if magic != SNAPSHOT_MAGIC_VALUE or version > SNAPSHOT_VERSION:
+                    raise StorageError("Invalid snapshot header in " + self._snapshot_path)
+                body = memoryview(view)[_SNAPSHOT_HEADER.size:]
+                try:
+                    if zlib.crc32(body) != crc:
+                        raise StorageError("Snapshot checksum mismatch in " + self._snapshot_path)
+                    pos = 0
+                    for _ in range(count):
+                        if version >= 2:
+                            (op, klen, vlen, item_version) = _ENTRY_V2.unpack_from(body, pos)
+                            pos += _ENTRY_V2.size
+                        else:
+                            (op, item_version) = (_PUT, None)
+                            (klen, vlen) = _ENTRY.unpack_from(body, pos)
+                            pos += _ENTRY.size
+                        key = json.loads(bytes(body[pos:pos + klen]))
+                        pos += klen
+                        if op == _PUT:
+                            self.data[key] = json.loads(bytes(body[pos:pos + vlen]))
+                            if item_version is not None:
+                                self.versions[key] = item_version
+                        else:
+                            self.tombstones[key] = item_version
+                        pos += vlen
+                finally:
+                    body.release()
+        logging.info("Storage snapshot loaded with {count} keys".format(count=len(self.data)))
+
+    def replay_log(self):
+        try:
+            f = open(self._log_path, "r+b")
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                pos = self.replay(view, size)
+            if pos < size:
+                logging.warning("Discarding {bytes} bytes of torn log tail".format(bytes=size - pos))
+                f.truncate(pos)
+                f.flush()
+                os.fsync(f.fileno())
+        logging.info("Storage log replayed: {count} records".format(count=self.records))
+
+    def replay(self, view, size):
+        pos = 0
+        while pos + _CRC.size + _RECORD.size <= size:
+            (crc,) = _CRC.unpack_from(view, pos)
+            (op, klen, vlen) = _RECORD.unpack_from(view, pos + _CRC.size)
+            start = pos + _CRC.size + _RECORD.size
+            end = start + klen + vlen
+            if end > size or zlib.crc32(view[pos + _CRC.size:end]) != crc:
+                break
+            try:
+                key = json.loads(view[start:start + klen])
+                if op == _PUT:
+                    self.apply(op, key, json.loads(view[start + klen:end]), None)
+                elif op == _PUT_VERSIONED:
+                    (value, version) = json.loads(view[start + klen:end])
+                    self.apply(op, key, value, version)
+                elif op == _REMOVE:
+                    self.apply(op, key, None, None)
+                elif op == _REMOVE_VERSIONED:
+                    self.apply(op, key, None, json.loads(view[start + klen:end]))
+                else:
+                    break
+            except (ValueError, TypeError):
+                break
+            self.records += 1
+            pos = end
+        return pos
+
+    def close(self):
+        self.sync()
+        self._log.close()
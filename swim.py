@@ -0,0 +1,138 @@
+import random
+import time
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+SWIM_SUSPECT_TIMEOUT = 3.0
+# Piggyback at most this many membership updates on one message.
+SWIM_GOSSIP_LIMIT = 6
+# Each update is piggybacked this many times, scaled by log2 of the group size.
+SWIM_RETRANSMIT_MULTIPLIER = 3
+
+_PRECEDENCE = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+
+
+class Member:
+    __slots__ = ("uuid", "addr", "state", "incarnation", "deadline")
+
+    def __init__(self, uuid, addr):
+        self.uuid = uuid
+        self.addr = addr
+        self.state = ALIVE
+        self.incarnation = 0
+        self.deadline = None
+
+
+class Swim:
+    def __init__(self, uuid, suspect_timeout=SWIM_SUSPECT_TIMEOUT, clock=time.monotonic):
+        self.uuid = uuid
+        self.incarnation = 0
+        self.members = {}
+        self._suspect_timeout = suspect_timeout
+        self._clock = clock
+        self._probe_order = []
+        self._updates = {}
+
+    def set_members(self, members, fresh=False):
+        """Track the given members; fresh starts every one of them over as alive (a new epoch)."""
+        current = {uuid: addr for (uuid, addr) in members if uuid != self.uuid}
+        for uuid in list(self.members):
+            if uuid not in current or fresh:
+                del self.members[uuid]
+                self._updates.pop(uuid, None)
+        for (uuid, addr) in current.items():
+            member = self.members.get(uuid)
+            if member is None:
+                self.members[uuid] = Member(uuid, addr)
+            elif addr is not None:
+                member.addr = addr
+
+    def next_target(self):
+        # Round-robin over a shuffled list bounds the time until every member is probed.
+        while self._probe_order:
+            member = self.members.get(self._probe_order.pop())
+            if member is not None and member.state != DEAD and member.addr is not None:
+                return member
+        candidates = [uuid for (uuid, member) in self.members.items()
+                      if member.state != DEAD and member.addr is not None]
+        if not candidates:
+            return None
+        random.shuffle(candidates)
+        self._probe_order = candidates
+        return self.next_target()
+
+    def helpers(self, target_uuid, count):
+        candidates = [member for (uuid, member) in self.members.items()
+                      if uuid != target_uuid and member.state == ALIVE and member.addr is not None]
+        return random.sample(candidates, min(count, len(candidates)))
+
+    def gossip(self):
+        if not self._updates:
+            return []
+        picked = sorted(self._updates.items(), key=lambda item: -item[1][1])[:SWIM_GOSSIP_LIMIT]
+        out = []
+        for (uuid, (update, remaining)) in picked:
+            out.append(update)
+            if remaining <= 1:
+                del self._updates[uuid]
+            else:
+                self._updates[uuid] = (update, remaining - 1)
+        return out
+
+    def _queue(self, uuid, state, incarnation):
+        transmissions = SWIM_RETRANSMIT_MULTIPLIER * max(1, (len(self.members) + 1).bit_length())
+        self._updates[uuid] = ([uuid, state, incarnation], transmissions)
+
+    def _set(self, member, state, incarnation):
+        member.state = state
+        member.incarnation = incarnation
+        member.deadline = self._clock() + self._suspect_timeout if state == SUSPECT else None
+        self._queue(member.uuid, state, incarnation)
+
+    def suspect(self, uuid):
+        member = self.members.get(uuid)
+        if member is None or member.state != ALIVE:
+            return False
+        self._set(member, SUSPECT, member.incarnation)
+        return True
+
+    def apply(self, updates):
+        """Merge piggybacked updates; return the members that are newly dead."""
+        dead = []
+        for (uuid, state, incarnation) in updates:
+            if uuid == self.uuid:
+                if state != ALIVE and incarnation >= self.incarnation:
+                    # Refute the rumour with a newer incarnation.
+                    self.incarnation = incarnation + 1
+                    self._queue(self.uuid, ALIVE, self.incarnation)
+                continue
+            member = self.members.get(uuid)
+            if member is None:
+                continue
+            if member.state == DEAD and not (state == ALIVE and incarnation > member.incarnation):
+                # Only the member itself, refuting with a newer incarnation, brings it back.
+                continue
+            if incarnation > member.incarnation or \
+                    (incarnation == member.incarnation and _PRECEDENCE[state] > _PRECEDENCE[member.state]):
+                self._set(member, state, incarnation)
+                if state == DEAD:
+                    dead.append(uuid)
+        return dead
+
+    def expire(self):
+        """Declare members whose suspicion has run out dead and return them."""
+        now = self._clock()
+        dead = []
+        for member in self.members.values():
+            if member.state == SUSPECT and member.deadline <= now:
+                self._set(member, DEAD, member.incarnation)
+                dead.append(member.uuid)
+        return dead
+
+    def counts(self):
+        counts = {ALIVE: 0, SUSPECT: 0, DEAD: 0}
+        for member in self.members.values():
+            counts[member.state] += 1
+        return counts
@@ -0,0 +1,27 @@
+import logging
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim  # noqa: E402
+
+
+@pytest.fixture
+def cluster():
+    """Start a simulated cluster with make(size, **kwargs); every cluster made is closed afterwards."""
+    logging.getLogger().setLevel("ERROR")
+    clusters = []
+
+    def make(size, **kwargs):
+        c = sim.Cluster(size, **kwargs)
+        clusters.append(c)
+        assert c.run_until(c.converged, 60) is not None
+        return c
+
+    yield make
+    for c in clusters:
+        c.close()
@@ -0,0 +1,73 @@
+import pytest
+
+import codec
+import fragment
+
+MESSAGE = {
+    "type": "put_final",
+    "uuid": "6fa459ea-ee8a-11ca-9a4b-0800200c9a66",
+    "key": "key",
+    "value": {"nested": [1, -2, 3.5, None, True, False, "text"]},
+    "version": 1700000000.25,
+    "cli_addr": ["10.0.0.7", 40001],
+    "rid": 12345,
+    "an_unlisted_field": "kept by name",
+}
+
+
+@pytest.mark.parametrize("wire", [codec.JSON, codec.BINARY])
+def test_message_round_trip(wire):
+    decoded = codec.decode(wire.encode(dict(MESSAGE)))
+    decoded.pop("_magic", None)
+    assert decoded == MESSAGE
+
+
+def test_binary_keeps_unknown_message_types():
+    message = {"type": "not_a_listed_type", "uuid": "plain-id"}
+    assert codec.decode(codec.BINARY.encode(dict(message))) == message
+
+
+@pytest.mark.parametrize("wire", [codec.JSON, codec.BINARY])
+def test_batch_round_trip(wire):
+    messages = [{"type": "get", "key": "k{i}".format(i=i), "rid": i} for i in range(5)]
+    data = wire.encode_batch([wire.encode(dict(message)) for message in messages])
+    decoded = codec.decode_all(data)
+    for message in decoded:
+        message.pop("_magic", None)
+    assert decoded == messages
+
+
+@pytest.mark.parametrize("data", [b"", b"\xd4\x7b\x01", b"{not json", b'{"type": "get"}'])
+def test_corrupt_messages_raise_codec_error(data):
+    with pytest.raises(codec.CodecError):
+        codec.decode(data)
+
+
+def test_fragments_reassemble_in_any_order():
+    data = bytes(range(256)) * 40
+    fragments = fragment.split(data, 7, 1000)
+    assert len(fragments) > 1 and all(fragment.is_fragment(f) for f in fragments)
+    reassembler = fragment.Reassembler(16, 1 << 20, 5.0)
+    results = [reassembler.add(f, ("10.0.0.1", 1)) for f in reversed(fragments)]
+    assert results[:-1] == [None] * (len(fragments) - 1)
+    assert results[-1] == data
+    assert len(reassembler) == 0
+
+
+def test_fragments_from_different_senders_do_not_mix():
+    data = b"x" * 3000
+    (first, *rest) = fragment.split(data, 1, 1000)
+    reassembler = fragment.Reassembler(16, 1 << 20, 5.0)
+    assert reassembler.add(first, ("10.0.0.1", 1)) is None
+    assert all(reassembler.add(f, ("10.0.0.2", 1)) is None for f in rest)
+    assert len(reassembler) == 2
+
+
+def test_incomplete_messages_expire():
+    now = [0.0]
+    reassembler = fragment.Reassembler(16, 1 << 20, 5.0, clock=lambda: now[0])
+    fragments = fragment.split(b"y" * 3000, 2, 1000)
+    reassembler.add(fragments[0], ("10.0.0.1", 1))
+    now[0] = 6.0
+    assert reassembler.add(fragments[1], ("10.0.0.1", 1)) is None
+    assert reassembler.expired == 1
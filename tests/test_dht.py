@@ -0,0 +1,163 @@
+import collections
+
+import pytest
+
+import client
+import dht
+
+
+def run(c, coro):
+    return c.loop.run_until_complete(coro)
+
+
+def spy_sent(c, types):
+    """Count the messages of the given types that any node sends, per (type, rid)."""
+    sent = collections.Counter()
+    for node in c.nodes:
+        def send_message(message, addr, send=node.send_message):
+            if message["type"] in types:
+                sent[message["type"], message.get("rid")] += 1
+            return send(message, addr)
+        node.send_message = send_message
+    return sent
+
+
+def test_put_get_remove(cluster):
+    c = cluster(5)
+    cl = c.client()
+
+    async def work():
+        for i in range(50):
+            await cl.put("k{i}".format(i=i), i)
+        for i in range(0, 50, 2):
+            await cl.remove("k{i}".format(i=i))
+        return [await cl.get("k{i}".format(i=i)) for i in range(50)]
+
+    assert run(c, work()) == [None if i % 2 == 0 else i for i in range(50)]
+
+
+def test_each_write_is_answered_once(cluster):
+    c = cluster(5)
+    sent = spy_sent(c, ("put_success", "remove_success"))
+    cl = c.client()
+
+    async def work():
+        for i in range(20):
+            await cl.put("k{i}".format(i=i), i)
+            await cl.remove("k{i}".format(i=i))
+
+    run(c, work())
+    assert len(sent) == 40
+    assert set(sent.values()) == {1}
+
+
+def test_stale_replica_writes_are_dropped_but_acknowledged(cluster):
+    c = cluster(3)
+    (node, peer) = c.nodes[:2]
+    addr = peer._socket.addr
+    acks = spy_sent(c, ("put_ack", "remove_ack"))
+
+    def put(key, value, version, write):
+        node.on_put_final({"type": "put_final", "uuid": peer.uuid, "key": key, "value": value,
+                           "version": version, "write": write}, addr)
+
+    def remove(key, version, write):
+        node.on_remove_ask({"type": "remove_ask", "uuid": peer.uuid, "key": key, "version": version,
+                            "write": write}, addr)
+
+    put("a", "new", 200, 1)
+    put("a", "old", 100, 2)
+    remove("a", 150, 3)
+    remove("b", 300, 4)
+    put("b", "zombie", 100, 5)
+    c.run_for(0.1)
+
+    assert node._data["a"] == "new"
+    assert "b" not in node._data and node._tombstones["b"] == 300
+    assert sum(acks.values()) == 5
+    assert node.apply_batch("mput", [("a", "older")], 50) == {"stored": ["a"]}
+    assert node.apply_batch("mremove", [("a", None)], 60) == {"removed": []}
+    assert node._data["a"] == "new"
+
+
+def test_batches_round_trip(cluster):
+    c = cluster(5)
+    cl = c.client()
+    items = {"k{i}".format(i=i): i for i in range(100)}
+    assert sorted(run(c, cl.mput(items))) == sorted(items)
+    assert run(c, cl.mget(list(items) + ["absent"])) == dict(items, absent=None)
+    assert sorted(run(c, cl.mremove(items))) == sorted(items)
+    assert set(run(c, cl.mget(items)).values()) == {None}
+
+
+def test_batch_timeout_answers_with_the_pending_keys(cluster, monkeypatch):
+    monkeypatch.setattr(dht, "DHT_REPLICATION_FACTOR", 1)
+    c = cluster(5)
+    cl = c.client()
+    keys = ["k{i}".format(i=i) for i in range(100)]
+    run(c, cl.mput([(key, key) for key in keys]))
+    c.run_for(1)
+    # The ring still lists the killed node until the failure detector notices.
+    victim = [node for node in c.nodes if node not in c.masters()][0]
+    lost = set(victim._data)
+    c.kill(victim)
+
+    (response, _) = run(c, cl.request({"type": "mget", "keys": keys}))
+    assert set(response["pending"]) == lost
+    assert {key: value for (key, value) in zip(keys, response["values"]) if key not in lost} == \
+        {key: key for key in keys if key not in lost}
+
+    with pytest.raises(client.DHTTimeout):
+        run(c, cl.mget(keys))
+
+
+def test_batch_retries_only_pending_keys_on_a_live_replica(cluster):
+    c = cluster(6)
+    cl = c.client()
+    keys = ["k{i}".format(i=i) for i in range(100)]
+    run(c, cl.mput([(key, key) for key in keys]))
+    c.run_for(1)
+    run(c, cl.refresh_members())
+    c.kill([node for node in c.nodes if node not in c.masters()][0])
+
+    sizes = []
+    request = cl.request
+
+    async def spy(message, key=None, addr=None):
+        sizes.append(len(message["keys"]))
+        return await request(message, key, addr)
+
+    cl.request = spy
+    assert run(c, cl.mget(keys)) == {key: key for key in keys}
+    assert sizes[0] == len(keys) and all(size < len(keys) for size in sizes[1:])
+
+
+def test_master_failover_keeps_the_data(cluster):
+    c = cluster(6)
+    cl = c.client()
+    items = {"k{i}".format(i=i): i for i in range(50)}
+    run(c, cl.mput(items))
+    c.run_for(1)
+    old = c.masters()[0]
+    c.kill(old)
+    assert c.run_until(c.converged, 60) is not None
+    assert c.masters()[0] is not old
+    assert run(c, cl.mget(items)) == items
+
+
+@pytest.mark.parametrize("detector", ["heartbeat", "swim"])
+def test_election_converges_under_loss(cluster, detector):
+    for seed in range(3):
+        c = cluster(8, loss=0.05, seed=seed, detector=detector)
+        master = c.masters()[0]
+        assert master._context.reported == {uuid for (uuid, _) in master._context.peer_list}
+
+
+def test_healed_partition_merges_to_one_master(cluster):
+    c = cluster(10)
+    half = len(c.nodes) // 2
+    c.partition(c.nodes[:half], c.nodes[half:])
+    c.run_for(60)
+    assert len(c.masters()) == 2
+    c.heal()
+    assert c.run_until(c.converged, 60) is not None
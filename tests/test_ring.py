@@ -0,0 +1,52 @@
+import ring
+
+MEMBERS = [("node-{i}".format(i=i), ("10.0.0.{i}".format(i=i), 19999)) for i in range(1, 9)]
+
+
+def test_empty_ring_has_no_replicas():
+    assert ring.HashRing().lookup("key", 3) == []
+
+
+def test_lookup_returns_distinct_members_with_addresses():
+    r = ring.HashRing(MEMBERS)
+    addrs = dict(MEMBERS)
+    for i in range(200):
+        replicas = r.lookup("key-{i}".format(i=i), 3)
+        assert len({uuid for (uuid, _) in replicas}) == 3
+        assert all(addrs[uuid] == addr for (uuid, addr) in replicas)
+
+
+def test_lookup_is_capped_by_members():
+    assert len(ring.HashRing(MEMBERS[:2]).lookup("key", 5)) == 2
+
+
+def test_lookup_does_not_depend_on_member_order():
+    forward = ring.HashRing(MEMBERS)
+    backward = ring.HashRing(list(reversed(MEMBERS)))
+    for i in range(100):
+        key = "key-{i}".format(i=i)
+        assert forward.lookup(key, 3) == backward.lookup(key, 3)
+
+
+def test_non_string_keys_hash_by_their_string_form():
+    r = ring.HashRing(MEMBERS)
+    assert r.lookup(7, 3) == r.lookup("7", 3)
+
+
+def test_leave_only_moves_the_keys_of_the_leaving_member():
+    before = ring.HashRing(MEMBERS)
+    after = ring.HashRing(MEMBERS[1:])
+    gone = MEMBERS[0][0]
+    for i in range(500):
+        key = "key-{i}".format(i=i)
+        (owner, _) = before.lookup(key)[0]
+        if owner != gone:
+            assert after.lookup(key)[0][0] == owner
+
+
+def test_rebuild_updates_membership():
+    r = ring.HashRing(MEMBERS)
+    r.rebuild(MEMBERS[:3])
+    assert len(r) == 3
+    assert MEMBERS[0][0] in r and MEMBERS[5][0] not in r
+    assert r.addr(MEMBERS[5][0]) is None
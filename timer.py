@@ -1,75 +1,169 @@
-import asyncio
-
-
-class Timer:
-    def __init__(self, loop):
-        self._loop = loop
-        pass
-
-    def trigger(self, func, delta):
-        async def _trigger():
-            try:
-                await asyncio.sleep(delta.total_seconds(), loop=self._loop)
-                func()
-            except asyncio.CancelledError:
-                pass
-
-        return asyncio.ensure_future(_trigger(), loop=self._loop)
-
-    def async_trigger(self, coro_func, delta):
-        async def _trigger():
-            try:
-                await asyncio.sleep(delta.total_seconds(), loop=self._loop)
-                await coro_func()
-            except asyncio.CancelledError:
-                pass
-
-        return asyncio.ensure_future(_trigger(), loop=self._loop)
-
-    def period(self, func, delta, repeat=None):
-        if repeat is None:
-            async def _period():
-                try:
-                    while True:
-                        func()
-                        await asyncio.sleep(delta.total_seconds(), loop=self._loop)
-                except asyncio.CancelledError:
-                    pass
-
-            return asyncio.ensure_future(_period(), loop=self._loop)
-        else:
-            async def _period():
-                try:
-                    counter = 0
-                    while counter < repeat:
-                        func()
-                        await asyncio.sleep(delta.total_seconds(), loop=self._loop)
-                        counter += 1
-                except asyncio.CancelledError:
-                    pass
-
-            return asyncio.ensure_future(_period(), loop=self._loop)
-
-    def async_period(self, coro_func, delta, repeat=None):
-        if repeat is None:
-            async def _period():
-                try:
-                    while True:
-                        await coro_func()
-                        await asyncio.sleep(delta.total_seconds(), loop=self._loop)
-                except asyncio.CancelledError:
-                    pass
-
-            return asyncio.ensure_future(_period(), loop=self._loop)
-        else:
-            async def _period():
-                try:
-                    counter = 0
-                    while counter < repeat:
-                        await coro_func()
-                        await asyncio.sleep(delta.total_seconds(), loop=self._loop)
-                        counter += 1
-                except asyncio.CancelledError:
-                    pass
-
-            return asyncio.ensure_future(_period(), loop=self._loop)
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+# Drop cancelled and superseded entries once the heap has doubled since the last sweep.
+TIMER_COMPACT_MIN = 1024
+
+
+class TimerHandle:
+    __slots__ = ("_timer", "_func", "_is_async", "_interval", "_remaining", "_deadline", "_queued", "_task",
+                 "cancelled")
+
+    def __init__(self, timer, func, is_async, interval=None, remaining=None):
+        self._timer = timer
+        self._func = func
+        self._is_async = is_async
+        self._interval = interval
+        self._remaining = remaining
+        self._deadline = None
+        # Deadline of this handle's live heap entry, if any.
+        self._queued = None
+        self._task = None
+        self.cancelled = False
+
+    def reset(self, delta):
+        # Re-arming only moves the deadline; the heap entry is fixed up when it comes due.
+        self.cancelled = False
+        self._timer.arm(self, self._timer._loop.time() + delta.total_seconds())
+
+    def cancel(self):
+        self.cancelled = True
+        self._deadline = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def fire(self):
+        if self._remaining is not None:
+            self._remaining -= 1
+        if self._is_async:
+            self._task = asyncio.ensure_future(self.run(), loop=self._timer._loop)
+            return
+        try:
+            self._func()
+        except Exception:
+            logging.exception("Timer callback failed")
+        self.rearm()
+
+    async def run(self):
+        try:
+            await self._func()
+        except asyncio.CancelledError:
+            return
+        self._task = None
+        self.rearm()
+
+    def rearm(self):
+        if self._interval is None or self.cancelled or self._remaining == 0:
+            return
+        self._timer.arm(self, self._timer._loop.time() + self._interval)
+
+
+class Timer:
+    # All timeouts of a node share one deadline heap and at most one pending loop.call_at.
+    def __init__(self, loop):
+        self._loop = loop
+        self._timer_heap = []
+        self._timer_seq = itertools.count()
+        self._timer_wakeup = None
+        self._timer_wakeup_at = None
+        self._timer_compact_at = TIMER_COMPACT_MIN
+        self._timers_stopped = False
+
+    def now(self):
+        # Wall-clock seconds for timestamps and versions; simulated loops supply their own.
+        wall_time = getattr(self._loop, "wall_time", None)
+        return wall_time() if wall_time is not None else time.time()
+
+    def trigger(self, func, delta):
+        return self.schedule(TimerHandle(self, func, False), delta.total_seconds())
+
+    def async_trigger(self, coro_func, delta):
+        return self.schedule(TimerHandle(self, coro_func, True), delta.total_seconds())
+
+    def period(self, func, delta, repeat=None):
+        return self.schedule(TimerHandle(self, func, False, delta.total_seconds(), repeat), 0)
+
+    def async_period(self, coro_func, delta, repeat=None):
+        return self.schedule(TimerHandle(self, coro_func, True, delta.total_seconds(), repeat), 0)
+
+    def schedule(self, handle, delay):
+        if handle._remaining is not None and handle._remaining <= 0:
+            handle.cancelled = True
+            return handle
+        self.arm(handle, self._loop.time() + delay)
+        return handle
+
+    def arm(self, handle, deadline):
+        if self._timers_stopped:
+            return
+        handle._deadline = deadline
+        if handle._queued is not None and handle._queued <= deadline:
+            return
+        handle._queued = deadline
+        heapq.heappush(self._timer_heap, (deadline, next(self._timer_seq), handle))
+        if len(self._timer_heap) >= self._timer_compact_at:
+            self.timer_compact()
+        self.timer_wakeup()
+
+    def timer_compact(self):
+        live = []
+        for entry in self._timer_heap:
+            (deadline, _, handle) = entry
+            if handle._queued != deadline:
+                continue
+            if handle._deadline is None:
+                handle._queued = None
+                continue
+            live.append(entry)
+        heapq.heapify(live)
+        self._timer_heap = live
+        self._timer_compact_at = max(TIMER_COMPACT_MIN, len(live) * 2)
+
+    def timer_wakeup(self):
+        if not self._timer_heap:
+            return
+        deadline = self._timer_heap[0][0]
+        if self._timer_wakeup is not None:
+            if self._timer_wakeup_at <= deadline:
+                return
+            self._timer_wakeup.cancel()
+        self._timer_wakeup_at = deadline
+        self._timer_wakeup = self._loop.call_at(deadline, self.timer_expired)
+
+    def timer_expired(self):
+        # call_at may run a little before its deadline; everything it was set for is due.
+        now = max(self._loop.time(), self._timer_wakeup_at)
+        self._timer_wakeup = None
+        # Timers armed by the callbacks below wait for the next wakeup.
+        last = next(self._timer_seq)
+        while self._timer_heap and self._timer_heap[0][0] <= now and self._timer_heap[0][1] < last:
+            (deadline, _, handle) = heapq.heappop(self._timer_heap)
+            if handle._queued != deadline:
+                continue
+            handle._queued = None
+            if handle._deadline is None:
+                continue
+            if handle._deadline > now:
+                handle._queued = handle._deadline
+                heapq.heappush(self._timer_heap, (handle._deadline, next(self._timer_seq), handle))
+                continue
+            handle._deadline = None
+            handle.fire()
+        self.timer_wakeup()
+
+    def stop_timers(self):
+        self._timers_stopped = True
+        for (_, _, handle) in self._timer_heap:
+            handle.cancel()
+        self._timer_heap = []
+        if self._timer_wakeup is not None:
+            self._timer_wakeup.cancel()
+            self._timer_wakeup = None
+
+    def timers_pending(self):
+        return sum(1 for (deadline, _, handle) in self._timer_heap
+                   if handle._queued == deadline and handle._deadline is not None)